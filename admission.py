@@ -0,0 +1,225 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+from contextlib import contextmanager, asynccontextmanager
+from taskqueue import walktime_workers
+
+logging.basicConfig(level=logging.ERROR)
+
+# Overload protection settings. Slack gives up on a request after 3 seconds, so a Home tab render that has waited
+# longer than ADMISSION_DEADLINE (in seconds, from its arrival) for a slot gets the cheap degraded response instead.
+admission_deadline = float(os.environ.get("ADMISSION_DEADLINE", 2.5))
+# /walktime is acknowledged right away and answered through its response_url, which stays valid for 30 minutes,
+# so a lookup only gets the degraded response once it has waited this long (in seconds) for a worker and a slot
+walktime_admission_deadline = float(os.environ.get("WALKTIME_ADMISSION_DEADLINE", 60))
+# Home tab renders allowed at once, per process
+home_tab_concurrency = int(os.environ.get("HOME_TAB_CONCURRENCY", 4))
+
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+# Name -> limit or breaker, for the /metrics/admission endpoint
+_registry = {}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a dependency whose circuit breaker is open
+    """
+    pass
+
+
+class ConcurrencyLimit():
+    """
+    Bounds how many calls of a handler run at once. Callers wait for a slot until their deadline,
+    counted from when the request arrived, so time already spent queued elsewhere counts against it.
+    """
+
+    def __init__(self, limit, deadline, name):
+        self.limit = limit
+        self.deadline = deadline
+        self.name = name
+        self._slots = threading.BoundedSemaphore(limit)
+        # Created on first use by admit_async, in the event loop of async_app.py
+        self._async_slots = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "admitted": 0,
+            "expired": 0,
+            "degraded": 0
+        }
+        _registry[name] = self
+
+    @contextmanager
+    def admit(self, received_at=None):
+        """
+        Context manager waiting for a slot. Yields whether the call was admitted before its deadline;
+        calls that weren't should serve their degraded response.
+
+        Arguments:
+          received_at -- time.monotonic() when the request arrived, defaults to now
+        """
+        remaining = self.deadline - (time.monotonic() - received_at) if received_at is not None else self.deadline
+        admitted = remaining > 0 and self._slots.acquire(timeout=remaining)
+        self._count("admitted" if admitted else "expired")
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self._slots.release()
+
+    @asynccontextmanager
+    async def admit_async(self, received_at=None):
+        """
+        asyncio counterpart of admit, for async_app.py. Waiting for a slot doesn't block the event loop.
+        The slots are separate from those of admit, as a process only serves one of the two modes.
+
+        Arguments:
+          received_at -- time.monotonic() when the request arrived, defaults to now
+        """
+        remaining = self.deadline - (time.monotonic() - received_at) if received_at is not None else self.deadline
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.limit)
+        admitted = False
+        if remaining > 0:
+            try:
+                await asyncio.wait_for(self._async_slots.acquire(), remaining)
+                admitted = True
+            except asyncio.TimeoutError:
+                pass
+        self._count("admitted" if admitted else "expired")
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self._async_slots.release()
+
+    def degraded(self):
+        """
+        Counts a degraded response, whether the call wasn't admitted or a dependency failed
+        """
+        self._count("degraded")
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class CircuitBreaker():
+    """
+    Stops calling a failing dependency: after failure_threshold failures in a row, calls raise CircuitOpenError
+    right away for reset_timeout seconds. Then a single trial call is let through, which closes the circuit
+    if it succeeds and opens it again if it fails. A trial that ends without either, e.g. because it was cancelled,
+    or that hasn't ended after reset_timeout seconds, lets another trial through.
+    Exceptions for which is_failure returns False (e.g. a rejected request) count as successful calls.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, name, is_failure=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self.is_failure = is_failure
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_started_at = 0.0
+        self._stats = {
+            "failures": 0,
+            "opened": 0,
+            "short_circuited": 0
+        }
+        _registry[name] = self
+
+    def allow(self):
+        """
+        Raises CircuitOpenError unless a call may be made now. Every allowed call must be followed by
+        record_success, record_failure or abandon.
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            now = time.monotonic()
+            if ((self._state == OPEN and now - self._opened_at >= self.reset_timeout)
+                    or (self._state == HALF_OPEN and now - self._trial_started_at >= self.reset_timeout)):
+                # This caller makes the trial call
+                self._state = HALF_OPEN
+                self._trial_started_at = now
+                return
+            self._stats["short_circuited"] += 1
+        raise CircuitOpenError(f"{self.name} circuit breaker is open")
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+
+    def record_failure(self, error):
+        if self.is_failure is not None and not self.is_failure(error):
+            # The dependency answered, it just didn't like the request
+            self.record_success()
+            return
+        with self._lock:
+            self._failures += 1
+            self._stats["failures"] += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                logging.error(f"Opening {self.name} circuit breaker after {self._failures} failures: {error}")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._stats["opened"] += 1
+
+    def abandon(self):
+        """
+        Records that an allowed call ended without telling whether the dependency works, e.g. it was cancelled.
+        If it was the trial call, the next call makes another trial.
+        """
+        with self._lock:
+            if self._state == HALF_OPEN:
+                # Still older than reset_timeout, so the next allow() starts a trial right away
+                self._state = OPEN
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Returns fn(*args, **kwargs), or raises CircuitOpenError without calling it while the circuit is open
+
+        Arguments:
+          fn -- function calling the dependency
+        """
+        self.allow()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        except BaseException:
+            self.abandon()
+            raise
+        self.record_success()
+        return result
+
+    def stats(self):
+        """
+        Returns the breaker counters and its state: 0 closed, 1 half open, 2 open
+        """
+        with self._lock:
+            return dict(self._stats, state=self._state)
+
+
+def stats():
+    """
+    Returns the counters of every concurrency limit and circuit breaker, as {"<name>.<counter>": value}
+    """
+    return {f"{name}.{key}": value for name, item in list(_registry.items()) for key, value in item.stats().items()}
+
+
+home_tab_limit = ConcurrencyLimit(home_tab_concurrency, admission_deadline, name="home_tab")
+# /walktime lookups already run on at most WALKTIME_WORKERS threads behind a bounded queue (see taskqueue.py),
+# so a slot is always free and only the deadline applies: lookups that waited too long in the queue are degraded
+walktime_limit = ConcurrencyLimit(walktime_workers, walktime_admission_deadline, name="walktime")
@@ -1,22 +1,114 @@
 from slack_bolt.adapter.flask import SlackRequestHandler
-from flask import Flask, request
+from flask import Flask, request, jsonify, abort
 import os
+import time
+import hmac
 from posix import environ
-from slack_bolt import App, Respond
+from slack_bolt import App, Respond, BoltResponse
 import weather
 import logging
-from pgdatabase import PGDatabase
+from pgdatabase import PGDatabase, pool_stats, mark_written, size_pool
+import prefscache
+import locations
+import bestwalks
+import prefetch
+import idempotency
+from admission import home_tab_limit, walktime_limit, home_tab_concurrency
+import admission
+from taskqueue import walktime_executor, walktime_workers, QueueFullError
+from instrumentation import timer, timed, traced
+from slackcalls import slack_calls
+from views import home_tab_json, walktime_blocks, read_home_tab_form, read_walktime_day, empty_user_prefs
+
+# Set LAZY_STARTUP to "true" to skip the Slack token check at import. It then happens on the first request,
+# so a new worker is ready as soon as the modules are imported.
+lazy_startup = os.environ.get("LAZY_STARTUP", "false").lower() in ("1", "true", "yes")
+# The /metrics/* endpoints are served on the public app, so they require this token in an X-Metrics-Token header.
+# They are disabled when it isn't set.
+metrics_token = os.environ.get("METRICS_TOKEN")
+
+# A connection for every thread that queries Postgres, so none waits for another to finish: the gunicorn threads
+# (WEB_THREADS, as in the Procfile), the /walktime workers, the Slack listener threads rendering the Home tab,
+# and 3 background threads (2 forecast store refreshers and the prefetch demand flusher).
+# The preferences cache listener has its own connection.
+size_pool(int(os.environ.get("WEB_THREADS", 2)) + walktime_workers + home_tab_concurrency + 3)
 
 app = App(
     token=os.environ.get("SLACK_BOT_TOKEN"),
-    signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
+    signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
+    # Without the check at startup, Bolt calls auth.test on the first request instead
+    token_verification_enabled=not lazy_startup
 )
 
 # Log level should not be hardcoded
 logging.basicConfig(level=logging.ERROR)
 
+# The preferences cache listener, which keeps this worker's cache coherent with writes from other workers,
+# starts on the first cache read (see prefscache.get), never at import: with gunicorn --preload the modules
+# are imported in the parent process, and its thread wouldn't survive the fork into the workers.
 
+
+@app.middleware
+def record_received_at(context, next):
+    """
+    Stores when the request arrived as context["received_at"], which admission deadlines are counted from
+    (see admission.py)
+    """
+    context["received_at"] = time.monotonic()
+    next()
+
+
+@app.middleware
+def skip_duplicate_requests(body, request, context, logger, next):
+    """
+    Acknowledges retries and duplicate deliveries of requests that were already handled, without handling them again
+    (see idempotency.py)
+
+    Arguments:
+      body -- Slack Bolt body
+      request -- Slack Bolt request
+      context -- Slack Bolt context
+      logger -- Slack Bolt logger
+      next -- Slack Bolt function calling the next middleware
+    """
+    retry_num = request.headers.get("x-slack-retry-num", [None])[0]
+    if not idempotency.claim(body, retry_num):
+        return BoltResponse(status=200, body="")
+    # Released by handle_errors if a listener fails
+    context["claimed"] = True
+    next()
+
+
+@app.error
+def handle_errors(error, body, context, logger):
+    """
+    Logs errors raised by middleware and listeners, and releases the request's claim (see skip_duplicate_requests)
+    so that Slack's retries of it are handled
+
+    Arguments:
+      error -- the exception raised
+      body -- Slack Bolt body
+      context -- Slack Bolt context
+      logger -- Slack Bolt logger
+    """
+    logger.exception(f"Error handling request: {error}")
+    if context.get("claimed"):
+        idempotency.release(body)
+
+
+@timed("prefs.get")
 def get_user_prefs(user_and_team_id):
+    """
+    Retrieves the user preferences, formatted as a dictionary, from the preferences cache or the database
+
+    Arguments:
+      user_and_team_id -- The Slack user ID and team ID separated by an underscore
+    """
+
+    return prefscache.get(user_and_team_id, lambda: read_user_prefs(user_and_team_id))
+
+
+def read_user_prefs(user_and_team_id):
     """
     Retrieves the user preferences from the database, formatted as a dictionary
 
@@ -24,215 +116,112 @@ def get_user_prefs(user_and_team_id):
       user_and_team_id -- The Slack user ID and team ID separated by an underscore
     """
 
-    db = PGDatabase()
-    db.query("SELECT location, ideal_temp, units from userprefs.userprefs where user_and_team_id = %s;", (user_and_team_id,))
-    result = db.cursor.fetchone()
-    db.close()
+    with PGDatabase(readonly=True, sticky_key=user_and_team_id) as db:
+        db.query("SELECT location, ideal_temp, units, canonical_location from userprefs.userprefs where user_and_team_id = %s;", (user_and_team_id,))
+        result = db.cursor.fetchone()
     if result is not None:
         logging.debug(result)
         return {
             "location": result[0],
             "ideal_temp": result[1],
-            "units": result[2]
+            "units": result[2],
+            "canonical_location": result[3]
         }
     else:
         return {
             "location": '',
             "ideal_temp": int(),
-            "units": ''
+            "units": '',
+            "canonical_location": None
         }
 
 
-def home_tab_content(user_prefs, update_status):
+@app.event("app_home_opened")
+@traced("home_tab")
+def render_home_tab(client, event, context, logger):
     """
-    Returns the home tab view content based on user preferences and whether the last action was successful
+    Event handling for when the user opens the home tab. This function retrieves user preferences and attempts to publish the home tab.
+    When too many renders are already running, or the preferences can't be read, it falls back to render_degraded_home_tab.
 
     Arguments:
-      user_prefs -- user preferences (dictionary)
-      update_status -- update status used to relay success/failure
+      client -- Slack Bolt client
+      event -- Slack Bolt event
+      context -- Slack Bolt context
+      logger -- Slack Bolt logger
     """
 
-    view = {
-        "type": "home",
-        "callback_id": "home_view",
-
-        # body of the view
-        "blocks": [
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "*Weather App Settings*"
-                }
-            },
-            {
-                "type": "divider"
-            },
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "Enter your location to set your default weather location!"
-                }
-            },
-            {
-                "type": "input",
-                "element": {
-                    "type": "plain_text_input",
-                    "action_id": "location_submit",
-                    "initial_value": user_prefs["location"] or '',
-                    "placeholder": {
-                        "type": "plain_text",
-                        "text": "examples: 90210 | Beverly Hills, CA | 34.0736,118.4004"
-                    }
-                },
-                "label": {
-                    "type": "plain_text",
-                    "text": "Location",
-                    "emoji": False
-                },
-                "block_id": "location_block"
-            },
-            {
-                "type": "input",
-                "element": {
-                    "type": "plain_text_input",
-                    "action_id": "ideal_temperature_submit",
-                    "initial_value": str(user_prefs["ideal_temp"]) if user_prefs["ideal_temp"] else '',
-                    "placeholder": {
-                        "type": "plain_text",
-                        "text": "00"
-                    }
-                },
-                "label": {
-                    "type": "plain_text",
-                    "text": "Your ideal walking temperature",
-                    "emoji": False
-                },
-                "block_id": "ideal_temp_block"
-            },
-            {
-                "type": "input",
-                "element": {
-                    "type": "static_select",
-                    "placeholder": {
-                        "type": "plain_text",
-                        "text": "Temperature Units",
-                        "emoji": True
-                    },
-                    "options": [
-                        {
-                            "text": {
-                                "type": "plain_text",
-                                "text": "Fahrenheit (°F)",
-                                "emoji": True
-                            },
-                            "value": "f"
-                        },
-                        {
-                            "text": {
-                                "type": "plain_text",
-                                "text": "Celsius (°C)",
-                                "emoji": True
-                            },
-                            "value": "c"
-                        }
-                    ],
-                    "action_id": "units_submit",
-                    "initial_option": {
-                        "value": user_prefs["units"] if user_prefs["units"] else "f",
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Celsius (°C)" if user_prefs["units"] == "c" else "Fahrenheit (°F)",
-                            "emoji": True
-                        }
-                    }
-                },
-                "label": {
-                    "type": "plain_text",
-                    "text": "Temperature Units",
-                    "emoji": True
-                },
-                "block_id": "units_block"
-            },
-            {
-                "type": "actions",
-                "elements": [
-                    {
-                        "type": "button",
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Save Preferences",
-                            "emoji": True
-                        },
-                        "value": "save_preferences",
-                        "action_id": "save_preferences",
-                        "style": "primary"
-                    }
-                ],
-                "block_id": "save_preferences"
-            }
-        ]
-    }
-
-    if update_status == "successful_update":
-        view["blocks"].append({
-            "type": "section",
-            "text": {
-                "type": "plain_text",
-                "text": ":white_check_mark: Preferences updated successfully!",
-                "emoji": True
-            }
-        })
-    if update_status == "error_update":
-        view["blocks"].append({
-            "type": "section",
-            "text": {
-                "type": "plain_text",
-                "text": ":exclamation: Error updating preferences! Reload the Home tab and try again.",
-                "emoji": True
-            }
-        })
-    if update_status == "error_update_ideal_temp":
-        view["blocks"].append({
-            "type": "section",
-            "text": {
-                "type": "plain_text",
-                "text": ":exclamation: Error updating preferences! Ideal Temperature must be an integer (e.g., 72, NOT 72.5 or 72F)",
-                "emoji": True
-            }
-        })
-
-    return view
+    user_and_team_id = f"{event['user']}_{event['view']['team_id']}"
+    with home_tab_limit.admit(context.get("received_at")) as admitted:
+        if not admitted:
+            logger.warning(f"Home tab render for {user_and_team_id} not admitted in time, serving the degraded Home tab")
+            return render_degraded_home_tab(client, event, logger)
+        try:
+            user_prefs = get_user_prefs(user_and_team_id)
+        except Exception as e:
+            logger.error(f"Error retrieving user preferences: {e}")
+            return render_degraded_home_tab(client, event, logger)
+        logger.debug(user_prefs)
+        try:
+            publish_home_tab(client, event["user"], event["view"]["team_id"], user_prefs, update_status=None, current_view=event.get("view"))
 
+        except Exception as e:
+            logger.error(f"Error publishing home tab: {e}")
 
-@app.event("app_home_opened")
-def render_home_tab(client, event, logger):
+
+def render_degraded_home_tab(client, event, logger):
     """
-    Event handling for when the user opens the home tab. This function retrieves user preferences and attempts to publish the home tab
+    Publishes the Home tab without reading the database: from the preferences cache if the user's preferences are in it.
+    Otherwise the view the user already has is left alone, and a user who has none gets an empty form saying we're busy.
 
     Arguments:
       client -- Slack Bolt client
       event -- Slack Bolt event
       logger -- Slack Bolt logger
     """
-
-    user_and_team_id = f"{event['user']}_{event['view']['team_id']}"
-    user_prefs = get_user_prefs(user_and_team_id)
-    logger.debug(user_prefs)
+    home_tab_limit.degraded()
+    user_id = event["user"]
+    team_id = event["view"]["team_id"]
+    user_prefs = prefscache.peek(f"{user_id}_{team_id}")
+    update_status = None
+    if user_prefs is None:
+        if event["view"].get("private_metadata"):
+            # The user still sees the Home tab we published last
+            return
+        user_prefs = empty_user_prefs
+        update_status = "degraded"
     try:
-        # views.publish is the method that your app uses to push a view to the Home tab
-        client.views_publish(
-            # the user that opened your app's app home
-            user_id=event["user"],
-            # the view object that appears in the app home
-            view=home_tab_content(user_prefs=user_prefs, update_status=None)
-        )
-
+        publish_home_tab(client, user_id, team_id, user_prefs, update_status=update_status, current_view=event.get("view"))
     except Exception as e:
         logger.error(f"Error publishing home tab: {e}")
 
 
+def publish_home_tab(client, user_id, team_id, user_prefs, update_status, current_view=None):
+    """
+    Queues the Home tab for a user to be published (see slackcalls.py), unless the view they already have is identical.
+    A queued Home tab that hasn't been sent yet is replaced rather than published twice.
+    Returns whether the view was queued.
+
+    Arguments:
+      client -- Slack Bolt client
+      user_id -- the Slack user ID whose Home tab to publish
+      team_id -- the user's Slack team ID
+      user_prefs -- user preferences (dictionary)
+      update_status -- update status used to relay success/failure
+      current_view -- the view the user currently has, from the app_home_opened event
+    """
+    view_json, view_hash = home_tab_json(user_prefs=user_prefs, update_status=update_status)
+    if current_view is not None and current_view.get("private_metadata") == view_hash:
+        logging.debug(f"Home tab for {user_id} is unchanged, skipping views.publish")
+        return False
+    # views.publish is the method that your app uses to push a view to the Home tab.
+    # The view is already serialized, so send it form-encoded rather than re-encoding it as JSON.
+    def publish():
+        with timer("slack.api", method="views.publish"):
+            return client.api_call("views.publish", data={"user_id": user_id, "view": view_json})
+    slack_calls.submit("views.publish", team_id, publish, coalesce_key=("views.publish", user_id))
+    return True
+
+
 def get_desired_action(actions, action_id):
     for action in actions:
         if action["action_id"] == action_id:
@@ -240,28 +229,53 @@ def get_desired_action(actions, action_id):
 
 
 def update_user_info(user_and_team_id, user_id, team_id, location, units, ideal_temp):
-    db = PGDatabase()
-    db.query("""INSERT INTO userprefs.userprefs (user_and_team_id, user_id, team_id, location, ideal_temp, units)
-                          VALUES (%s, %s, %s, %s, %s, %s)
-                          ON CONFLICT (user_and_team_id) DO UPDATE SET location = %s, ideal_temp = %s, units = %s
-               """,
-             (
-                 # VALUES
-                 user_and_team_id,
-                 user_id,
-                 team_id,
-                 location,
-                 ideal_temp,
-                 units,
-                 # DO UPDATE SET
-                 location,
-                 ideal_temp,
-                 units
-             ),)
-    db.close()
+    # Resolve the location once here, so reads never have to
+    canonical_location = locations.try_resolve_location(location)
+    try:
+        write_user_info(user_and_team_id, user_id, team_id, location, units, ideal_temp, canonical_location)
+    except Exception:
+        # We can't tell whether the write landed, so make the next read go to the database
+        prefscache.invalidate(user_and_team_id)
+        raise
+    finally:
+        # Replicas may not have the write yet, so this user's next reads go to the primary
+        mark_written(user_and_team_id)
+    prefscache.write_through(user_and_team_id, {
+        "location": location,
+        "ideal_temp": int(ideal_temp) if ideal_temp is not None else None,
+        "units": units,
+        "canonical_location": canonical_location
+    })
+
+
+def write_user_info(user_and_team_id, user_id, team_id, location, units, ideal_temp, canonical_location):
+    with PGDatabase() as db:
+        db.query("""INSERT INTO userprefs.userprefs (user_and_team_id, user_id, team_id, location, ideal_temp, units, canonical_location)
+                              VALUES (%s, %s, %s, %s, %s, %s, %s)
+                              ON CONFLICT (user_and_team_id) DO UPDATE SET location = %s, ideal_temp = %s, units = %s, canonical_location = %s
+                   """,
+                 (
+                     # VALUES
+                     user_and_team_id,
+                     user_id,
+                     team_id,
+                     location,
+                     ideal_temp,
+                     units,
+                     canonical_location,
+                     # DO UPDATE SET
+                     location,
+                     ideal_temp,
+                     units,
+                     canonical_location
+                 ),)
+        if prefscache.prefs_cache_notify:
+            # Delivered to the other workers when the transaction commits
+            db.query("SELECT pg_notify(%s, %s);", (prefscache.notify_channel, prefscache.notify_payload(user_and_team_id)))
 
 
 @app.action("save_preferences")
+@traced("save_preferences")
 def handle_actions(ack, body, client, logger):
     """
     Handles the updates that need to occur when the user presses "Save Preferences" in the Home tab
@@ -279,20 +293,10 @@ def handle_actions(ack, body, client, logger):
     team_id = body["user"]["team_id"]
 
     # Information that the user put into the Home tab. We read the view state.
-    location = body["view"]["state"]["values"]["location_block"]["location_submit"]["value"]
-    # Check if the user selected anything
-    if body["view"]["state"]["values"]["units_block"]["units_submit"]["selected_option"]:
-        units = body["view"]["state"]["values"]["units_block"]["units_submit"]["selected_option"]["value"]
-    else:
-        units = None
-    ideal_temp = body["view"]["state"]["values"]["ideal_temp_block"]["ideal_temperature_submit"]["value"]
-    update_status = "successful_update"
-
-    # If the ideal temperature isn't an integer, we throw it out and let the user know
-    # TODO: Accept floating point numbers
-    if not ideal_temp.isdigit():
-        ideal_temp = None
-        update_status = "error_update_ideal_temp"
+    user_prefs, update_status = read_home_tab_form(body["view"]["state"])
+    location = user_prefs["location"]
+    units = user_prefs["units"]
+    ideal_temp = user_prefs["ideal_temp"]
 
     # Try to update the user preferences in the database
     try:
@@ -304,120 +308,147 @@ def handle_actions(ack, body, client, logger):
             ideal_temp=ideal_temp,
             units=units
         )
-
-        # The no-error view
-        client.views_publish(
-            user_id=user_id,
-            view=home_tab_content(
-                user_prefs={
-                    "ideal_temp": ideal_temp,
-                    "units": units,
-                    "location": location
-                },
-                update_status=update_status))
     except Exception as e:
         # We would publish this alternative view with an error message if there's some kind of error.
+        logger.error(f"Error updating user preferences: {e}")
         update_status = "error_update"
-        client.views_publish(
-            user_id=user_id,
-            view=home_tab_content(
-                user_prefs={
-                    "ideal_temp": ideal_temp,
-                    "units": units,
-                    "location": location
-                },
-                update_status=update_status))
 
+    try:
+        publish_home_tab(client, user_id, team_id, user_prefs, update_status=update_status)
+    except QueueFullError as e:
+        # The Slack call queue is shedding load; the Home tab is rendered again the next time it is opened
+        logger.warning(e)
+    except Exception as e:
+        logger.error(f"Error publishing home tab: {e}")
 
-@app.command("/walktime")
-def handle_walktime(ack, body, logger, respond: Respond):
+
+def send_response(respond, team_id, **kwargs):
     """
-    Handles the /walktime slash command
+    Queues a response to a slash command to be sent with retries (see slackcalls.py)
+
+    Arguments:
+      respond -- Slack Bolt response
+      team_id -- Slack team ID of the command
+      kwargs -- arguments for respond, e.g. text or blocks
+    """
+    def send():
+        with timer("slack.api", method="respond"):
+            return respond(**kwargs)
+    slack_calls.submit("respond", team_id, send)
+
+
+@traced("walktime")
+def respond_walktime(body, logger, respond: Respond, received_at=None):
+    """
+    Looks up the best walk for the user who ran /walktime and responds with it.
+    This runs on a background worker after the slash command has been acknowledged.
+    When the lookup isn't admitted in time or WeatherAPI is failing, it falls back to respond_degraded_walktime.
 
     Arguments:
-      ack: Slack Bolt acknowledge function
       body: Slack Bolt body
       logger: Slack Bolt logger
       respond: Slack Bolt response
+      received_at: time.monotonic() when the command arrived
     """
-    ack()
-    logger.debug(body)
     user_and_team_id = f"{body['user_id']}_{body['team_id']}"
+    day = read_walktime_day(body.get("text"))
+
+    with walktime_limit.admit(received_at) as admitted:
+        if not admitted:
+            logger.warning(f"/walktime for {user_and_team_id} not admitted in time, serving the degraded response")
+            return respond_degraded_walktime(body, logger, respond, day)
+
+        # Try to retrieve the user preferences from the database, falling back to the defaults
+        user_prefs = {}
+        try:
+            user_prefs = get_user_prefs(user_and_team_id)
+            logger.debug(user_prefs)
+        except Exception as e:
+            logger.error(f"Error retrieving user preferences: {e}")
+        # Learn when this location is busy, see prefetch.py
+        prefetch.record(user_prefs)
+
+        # Try to retrieve the best walk base on user preferences
+        try:
+            best_walk = bestwalks.get_best_walk(user_prefs, day=day)
+        except ValueError as e:
+            send_response(respond, body["team_id"], text="""
+We were unable to find the best walk for the location specified.
+This problem might occur if there are no more hours left in the forecast for that location.
+        """)
+            logger.error(e)
+            return
+        except Exception as e:
+            logger.error(f"Error retrieving the best walk: {e}")
+            return respond_degraded_walktime(body, logger, respond, day, user_prefs)
 
-    # Try to retrieve the user preferences from the database
     try:
-        user_prefs = get_user_prefs(user_and_team_id)
-        logger.debug(user_prefs)
+        blocks = walktime_blocks(
+            best_walk=best_walk,
+            units=user_prefs.get("units"),
+            team_id=body["team_id"],
+            api_app_id=body["api_app_id"]
+        )
+        send_response(respond, body["team_id"], blocks=blocks)
     except Exception as e:
-        logger.error(f"Error retrieving user preferences: {e}")
+        logger.error(f"Error responding to slash command: {e}")
 
-    # Try to retrieve the best walk base on user preferences
-    try:
-        best_walk = weather.get_best_walk(user_prefs)
-    except ValueError as e:
-        respond(
-            """
-We were unable to find the best walk for today. 
-This problem might occur if there are no more hours left in the day for the location specified.
-Support for walking information beyond today's date may be added in the future!
-        """)
-        logger.error(e)
-
-    # Shorthand for disgusting ternary operator usage that we'll use later
-    c = user_prefs['units'] == "c"
-
-    response_intro_markdown = f"""
-  The best time to walk in *{best_walk['location']['name']}* is *<!date^{best_walk['best_walk_hour']['time_epoch']}^{{time}}|{best_walk['best_walk_hour']['time']} (local time)>*:
-  \n\n
-  """
-
-    # The output below changes based on whether the user's units are set to C or F. /walktime arbitrarily defaults to Fahrenheit
-    response_weather_markdown = f"""
-*{best_walk['best_walk_hour']['condition']['text']}*
-*{best_walk['best_walk_hour']['temp_c'] if c else best_walk['best_walk_hour']['temp_f']}{'°C' if c else '°F'}*
-Feels like {best_walk['best_walk_hour']['feelslike_c'] if c else best_walk['best_walk_hour']['feelslike_f']}{'°C' if c else '°F'}, 
-Chance of Rain: {best_walk['best_walk_hour']['chance_of_rain']}%
-  """
-
-    response_footnotes = f"""
-Note: Walking time is shown in your current Slack timezone. This time will be offset by a time zone difference if your configured location is in a different time zone.
-\n\n
-Set your location and other preferences in the <slack://app?team={body['team_id']}&id={body['api_app_id']}&tab=home|Home tab of this App>.
-  """
 
+def respond_degraded_walktime(body, logger, respond: Respond, day, user_prefs=None):
+    """
+    Responds to /walktime without touching the database or WeatherAPI: with the last best walk served for the
+    user's preferences (see bestwalks.last_known), or by asking them to try again later
+
+    Arguments:
+      body: Slack Bolt body
+      logger: Slack Bolt logger
+      respond: Slack Bolt response
+      day: first forecast day to search
+      user_prefs: the user's preferences, if they were already read
+    """
+    walktime_limit.degraded()
+    if user_prefs is None:
+        user_prefs = prefscache.peek(f"{body['user_id']}_{body['team_id']}") or {}
+    best_walk = bestwalks.last_known(user_prefs, day)
+    if best_walk is None:
+        send_response(respond, body["team_id"], text="Walk Time is busy right now! Please try `/walktime` again in a minute.")
+        return
     try:
-        respond(blocks=[
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": response_intro_markdown
-                }
-            },
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": response_weather_markdown
-                },
-                "accessory": {
-                    "type": "image",
-                    "image_url": f"https:{best_walk['best_walk_hour']['condition']['icon']}",
-                    "alt_text": "Current condition icon"
-                }
-            },
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": response_footnotes
-                }
-            }
-        ])
+        blocks = walktime_blocks(
+            best_walk=best_walk,
+            units=user_prefs.get("units"),
+            team_id=body["team_id"],
+            api_app_id=body["api_app_id"],
+            stale=True
+        )
+        send_response(respond, body["team_id"], blocks=blocks)
     except Exception as e:
         logger.error(f"Error responding to slash command: {e}")
 
 
+@app.command("/walktime")
+def handle_walktime(ack, body, context, logger, respond: Respond):
+    """
+    Handles the /walktime slash command. The command is acknowledged right away and the
+    best walk is computed on a background worker, which delivers it through respond.
+
+    Arguments:
+      ack: Slack Bolt acknowledge function
+      body: Slack Bolt body
+      context: Slack Bolt context
+      logger: Slack Bolt logger
+      respond: Slack Bolt response
+    """
+    ack()
+    logger.debug(body)
+    try:
+        walktime_executor.submit(respond_walktime, body, logger, respond, context.get("received_at"))
+    except QueueFullError as e:
+        # Shed load rather than queue work that would finish after the user has given up
+        logger.warning(e)
+        respond("Walk Time is busy right now! Please try `/walktime` again in a minute.")
+
+
 # Development server
 if __name__ == "__main__":
     app.start(port=int(os.environ.get("PORT", 3000)))
@@ -431,3 +462,52 @@ handler = SlackRequestHandler(app)
 @flask_app.route("/slack/events", methods=["POST"])
 def slack_events():
     return handler.handle(request)
+
+
+@flask_app.before_request
+def require_metrics_token():
+    """
+    Rejects requests for the /metrics/* endpoints without the METRICS_TOKEN
+    """
+    if not request.path.startswith("/metrics/"):
+        return
+    if not metrics_token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("X-Metrics-Token", "").encode(), metrics_token.encode()):
+        abort(403)
+
+
+# Connection pool stats, polled by the custom Datadog check in datadog/checks.d/walktime.py
+@flask_app.route("/metrics/dbpool", methods=["GET"])
+def dbpool_metrics():
+    return jsonify(pool_stats())
+
+
+# Preferences cache stats, including the hit ratio, polled by the same check
+@flask_app.route("/metrics/prefscache", methods=["GET"])
+def prefscache_metrics():
+    return jsonify(prefscache.stats())
+
+
+# Outgoing Slack call queue stats, polled by the same check
+@flask_app.route("/metrics/slackcalls", methods=["GET"])
+def slackcalls_metrics():
+    return jsonify(slack_calls.stats())
+
+
+# Duplicate request stats, polled by the same check
+@flask_app.route("/metrics/idempotency", methods=["GET"])
+def idempotency_metrics():
+    return jsonify(idempotency.stats())
+
+
+# Admission control and circuit breaker stats, polled by the same check
+@flask_app.route("/metrics/admission", methods=["GET"])
+def admission_metrics():
+    return jsonify(admission.stats())
+
+
+# Shared forecast stats for this worker, polled by the same check
+@flask_app.route("/metrics/sharedforecasts", methods=["GET"])
+def sharedforecasts_metrics():
+    return jsonify(weather.shared_forecasts.stats() if weather.shared_forecasts is not None else {})
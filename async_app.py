@@ -0,0 +1,375 @@
+from slack_bolt.async_app import AsyncApp, AsyncRespond
+from slack_bolt.response import BoltResponse
+from slack_bolt.adapter.asgi.async_handler import AsyncSlackRequestHandler
+import os
+import time
+import asyncio
+import logging
+import async_weather
+from async_pgdatabase import AsyncPGDatabase, close_pool
+import prefscache
+import locations
+import bestwalks
+import prefetch
+import idempotency
+from admission import home_tab_limit
+from instrumentation import timer, timed, traced
+from views import home_tab_json, walktime_blocks, read_home_tab_form, read_walktime_day, empty_user_prefs
+
+# asyncio deployment of the app, selected with APP_MODE=async (see Procfile).
+# The handlers mirror app.py, but database and WeatherAPI calls are awaited instead of
+# holding a thread, so one process can hold many in-flight lookups.
+# Home tab renders go through the same admission control (see admission.py). Unlike app.py, Slack calls are
+# awaited directly rather than going through the Slack call queue (slackcalls.py), and preferences are always
+# read from the primary: async mode doesn't support DATABASE_REPLICA_URLS.
+app = AsyncApp(
+    token=os.environ.get("SLACK_BOT_TOKEN"),
+    signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
+)
+
+# Log level should not be hardcoded
+logging.basicConfig(level=logging.ERROR)
+
+# The preferences cache listener, which keeps this process's cache coherent with writes from other processes,
+# starts on the first cache read (see prefscache.peek), not at import in the gunicorn --preload parent
+
+
+@app.middleware
+async def record_received_at(context, next):
+    """
+    Stores when the request arrived as context["received_at"], which admission deadlines are counted from
+    (see admission.py)
+    """
+    context["received_at"] = time.monotonic()
+    await next()
+
+
+@app.middleware
+async def skip_duplicate_requests(body, request, context, logger, next):
+    """
+    Acknowledges retries and duplicate deliveries of requests that were already handled, without handling them again
+    (see idempotency.py)
+
+    Arguments:
+      body -- Slack Bolt body
+      request -- Slack Bolt request
+      context -- Slack Bolt context
+      logger -- Slack Bolt logger
+      next -- Slack Bolt function calling the next middleware
+    """
+    retry_num = request.headers.get("x-slack-retry-num", [None])[0]
+    # The shared check is a database round trip, so it runs on a thread
+    if not await asyncio.to_thread(idempotency.claim, body, retry_num):
+        return BoltResponse(status=200, body="")
+    # Released by handle_errors if a listener fails
+    context["claimed"] = True
+    await next()
+
+
+@app.error
+async def handle_errors(error, body, context, logger):
+    """
+    Logs errors raised by middleware and listeners, and releases the request's claim (see skip_duplicate_requests)
+    so that Slack's retries of it are handled
+
+    Arguments:
+      error -- the exception raised
+      body -- Slack Bolt body
+      context -- Slack Bolt context
+      logger -- Slack Bolt logger
+    """
+    logger.exception(f"Error handling request: {error}")
+    if context.get("claimed"):
+        await asyncio.to_thread(idempotency.release, body)
+
+
+@timed("prefs.get")
+async def get_user_prefs(user_and_team_id):
+    """
+    Retrieves the user preferences, formatted as a dictionary, from the preferences cache or the database
+
+    Arguments:
+      user_and_team_id -- The Slack user ID and team ID separated by an underscore
+    """
+
+    user_prefs = prefscache.peek(user_and_team_id)
+    if user_prefs is None:
+        # A save that lands while we read wins over what we read
+        flight = prefscache.begin_load(user_and_team_id)
+        try:
+            user_prefs = await read_user_prefs(user_and_team_id)
+        finally:
+            prefscache.end_load(user_and_team_id, flight, user_prefs)
+    return user_prefs
+
+
+async def read_user_prefs(user_and_team_id):
+    """
+    Retrieves the user preferences from the database, formatted as a dictionary
+
+    Arguments:
+      user_and_team_id -- The Slack user ID and team ID separated by an underscore
+    """
+
+    async with AsyncPGDatabase() as db:
+        result = await db.fetchrow("SELECT location, ideal_temp, units, canonical_location from userprefs.userprefs where user_and_team_id = $1;", user_and_team_id)
+    if result is not None:
+        logging.debug(result)
+        return {
+            "location": result[0],
+            "ideal_temp": result[1],
+            "units": result[2],
+            "canonical_location": result[3]
+        }
+    else:
+        return {
+            "location": '',
+            "ideal_temp": int(),
+            "units": '',
+            "canonical_location": None
+        }
+
+
+async def update_user_info(user_and_team_id, user_id, team_id, location, units, ideal_temp):
+    ideal_temp = int(ideal_temp) if ideal_temp is not None else None
+    # Location resolution only happens on save, so it runs on a thread rather than being ported to asyncio
+    canonical_location = await asyncio.to_thread(locations.try_resolve_location, location)
+    try:
+        await write_user_info(user_and_team_id, user_id, team_id, location, units, ideal_temp, canonical_location)
+    except Exception:
+        # We can't tell whether the write landed, so make the next read go to the database
+        prefscache.invalidate(user_and_team_id)
+        raise
+    prefscache.write_through(user_and_team_id, {
+        "location": location,
+        "ideal_temp": ideal_temp,
+        "units": units,
+        "canonical_location": canonical_location
+    })
+
+
+async def write_user_info(user_and_team_id, user_id, team_id, location, units, ideal_temp, canonical_location):
+    async with AsyncPGDatabase() as db:
+        await db.execute("""INSERT INTO userprefs.userprefs (user_and_team_id, user_id, team_id, location, ideal_temp, units, canonical_location)
+                              VALUES ($1, $2, $3, $4, $5, $6, $7)
+                              ON CONFLICT (user_and_team_id) DO UPDATE SET location = $4, ideal_temp = $5, units = $6, canonical_location = $7
+                         """,
+                         user_and_team_id,
+                         user_id,
+                         team_id,
+                         location,
+                         ideal_temp,
+                         units,
+                         canonical_location)
+        if prefscache.prefs_cache_notify:
+            # Delivered to the other processes when the transaction commits
+            await db.execute("SELECT pg_notify($1, $2);", prefscache.notify_channel, prefscache.notify_payload(user_and_team_id))
+
+
+@app.event("app_home_opened")
+@traced("home_tab")
+async def render_home_tab(client, event, context, logger):
+    """
+    Event handling for when the user opens the home tab. This function retrieves user preferences and attempts to publish the home tab.
+    When too many renders are already running, or the preferences can't be read, it falls back to render_degraded_home_tab.
+
+    Arguments:
+      client -- Slack Bolt client
+      event -- Slack Bolt event
+      context -- Slack Bolt context
+      logger -- Slack Bolt logger
+    """
+
+    user_and_team_id = f"{event['user']}_{event['view']['team_id']}"
+    async with home_tab_limit.admit_async(context.get("received_at")) as admitted:
+        if not admitted:
+            logger.warning(f"Home tab render for {user_and_team_id} not admitted in time, serving the degraded Home tab")
+            return await render_degraded_home_tab(client, event, logger)
+        try:
+            user_prefs = await get_user_prefs(user_and_team_id)
+        except Exception as e:
+            logger.error(f"Error retrieving user preferences: {e}")
+            return await render_degraded_home_tab(client, event, logger)
+        logger.debug(user_prefs)
+        try:
+            await publish_home_tab(client, event["user"], user_prefs, update_status=None, current_view=event.get("view"))
+
+        except Exception as e:
+            logger.error(f"Error publishing home tab: {e}")
+
+
+async def render_degraded_home_tab(client, event, logger):
+    """
+    asyncio counterpart of app.render_degraded_home_tab: publishes the Home tab from the preferences cache if the
+    user's preferences are in it. Otherwise the view the user already has is left alone, and a user who has none
+    gets an empty form saying we're busy.
+
+    Arguments:
+      client -- Slack Bolt client
+      event -- Slack Bolt event
+      logger -- Slack Bolt logger
+    """
+    home_tab_limit.degraded()
+    user_id = event["user"]
+    user_prefs = prefscache.peek(f"{user_id}_{event['view']['team_id']}")
+    update_status = None
+    if user_prefs is None:
+        if event["view"].get("private_metadata"):
+            # The user still sees the Home tab we published last
+            return
+        user_prefs = empty_user_prefs
+        update_status = "degraded"
+    try:
+        await publish_home_tab(client, user_id, user_prefs, update_status=update_status, current_view=event.get("view"))
+    except Exception as e:
+        logger.error(f"Error publishing home tab: {e}")
+
+
+async def publish_home_tab(client, user_id, user_prefs, update_status, current_view=None):
+    """
+    Publishes the Home tab for a user, unless the view they already have is identical.
+    Returns whether the view was published.
+
+    Arguments:
+      client -- Slack Bolt client
+      user_id -- the Slack user ID whose Home tab to publish
+      user_prefs -- user preferences (dictionary)
+      update_status -- update status used to relay success/failure
+      current_view -- the view the user currently has, from the app_home_opened event
+    """
+    view_json, view_hash = home_tab_json(user_prefs=user_prefs, update_status=update_status)
+    if current_view is not None and current_view.get("private_metadata") == view_hash:
+        logging.debug(f"Home tab for {user_id} is unchanged, skipping views.publish")
+        return False
+    with timer("slack.api", method="views.publish"):
+        await client.api_call("views.publish", data={"user_id": user_id, "view": view_json})
+    return True
+
+
+@app.action("save_preferences")
+@traced("save_preferences")
+async def handle_actions(ack, body, client, logger):
+    """
+    Handles the updates that need to occur when the user presses "Save Preferences" in the Home tab
+
+    Arguments:
+      ack -- Slack Bolt acknowledgement function
+      body -- Slack Bolt body
+      client -- Slack Bolt client
+      logger -- Slack Bolt logger
+    """
+    await ack()
+    logger.debug(body)
+    user_id = body["user"]["id"]
+    team_id = body["user"]["team_id"]
+    user_prefs, update_status = read_home_tab_form(body["view"]["state"])
+
+    try:
+        await update_user_info(
+            user_and_team_id=f"{user_id}_{team_id}",
+            user_id=user_id,
+            team_id=team_id,
+            **user_prefs
+        )
+    except Exception as e:
+        logger.error(f"Error updating user preferences: {e}")
+        update_status = "error_update"
+
+    try:
+        await publish_home_tab(client, user_id, user_prefs, update_status=update_status)
+    except Exception as e:
+        logger.error(f"Error publishing home tab: {e}")
+
+
+@app.command("/walktime")
+@traced("walktime")
+async def handle_walktime(ack, body, logger, respond: AsyncRespond):
+    """
+    Handles the /walktime slash command. Bolt sends the acknowledgement as soon as ack() is
+    awaited, so the lookup below does not hold up the HTTP response.
+
+    Arguments:
+      ack: Slack Bolt acknowledge function
+      body: Slack Bolt body
+      logger: Slack Bolt logger
+      respond: Slack Bolt response
+    """
+    await ack()
+    logger.debug(body)
+    user_and_team_id = f"{body['user_id']}_{body['team_id']}"
+
+    # Try to retrieve the user preferences from the database, falling back to the defaults
+    user_prefs = {}
+    try:
+        user_prefs = await get_user_prefs(user_and_team_id)
+        logger.debug(user_prefs)
+    except Exception as e:
+        logger.error(f"Error retrieving user preferences: {e}")
+    # Learn when this location is busy, see prefetch.py
+    prefetch.record(user_prefs)
+
+    # Try to retrieve the best walk base on user preferences
+    try:
+        day = read_walktime_day(body.get("text"))
+        # The precomputed best walk is a single indexed lookup, see bestwalks.py
+        best_walk = await asyncio.to_thread(bestwalks.try_lookup, user_prefs, day)
+        if best_walk is None:
+            best_walk = await async_weather.get_best_walk(user_prefs, day=day)
+        bestwalks.remember(user_prefs, day, best_walk)
+        stale = False
+    except ValueError as e:
+        await respond(
+            """
+We were unable to find the best walk for the location specified.
+This problem might occur if there are no more hours left in the forecast for that location.
+        """)
+        logger.error(e)
+        return
+    except Exception as e:
+        # e.g. WeatherAPI is failing and its circuit breaker is open (see admission.py)
+        logger.error(f"Error retrieving the best walk: {e}")
+        best_walk = bestwalks.last_known(user_prefs, day)
+        stale = True
+        if best_walk is None:
+            await respond("Walk Time is busy right now! Please try `/walktime` again in a minute.")
+            return
+
+    try:
+        blocks = walktime_blocks(
+            best_walk=best_walk,
+            units=user_prefs.get("units"),
+            team_id=body["team_id"],
+            api_app_id=body["api_app_id"],
+            stale=stale
+        )
+        with timer("slack.api", method="respond"):
+            await respond(blocks=blocks)
+    except Exception as e:
+        logger.error(f"Error responding to slash command: {e}")
+
+
+# Development server
+if __name__ == "__main__":
+    app.start(port=int(os.environ.get("PORT", 3000)))
+
+# Production Heroku Deployment, served by an ASGI server such as uvicorn
+
+handler = AsyncSlackRequestHandler(app)
+
+
+async def api(scope, receive, send):
+    """
+    ASGI entry point. Slack requests go to the Bolt handler; on shutdown the WeatherAPI session
+    and database pool are closed cleanly.
+    """
+    if scope["type"] != "lifespan":
+        return await handler(scope, receive, send)
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_weather.close_session()
+            await close_pool()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
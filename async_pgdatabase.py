@@ -0,0 +1,111 @@
+import os
+import time
+import asyncio
+import asyncpg
+import logging
+from instrumentation import timer, timed
+
+logging.basicConfig(level=logging.ERROR)
+
+# The asyncio pool is not limited by thread count, so it defaults to more connections than the threaded pool
+async_pool_min_size = int(os.environ.get("ASYNC_DBPOOL_MIN_SIZE", 1))
+async_pool_max_size = int(os.environ.get("ASYNC_DBPOOL_MAX_SIZE", 10))
+# Connections older than this (in seconds) are closed instead of being returned to the pool, as in PGDatabase
+async_pool_max_lifetime = float(os.environ.get("DBPOOL_MAX_LIFETIME", 1800))
+# Connections left idle in the pool for longer than this (in seconds) are closed
+async_pool_max_idle = float(os.environ.get("ASYNC_DBPOOL_MAX_IDLE", 300))
+async_pool_acquire_timeout = float(os.environ.get("DBPOOL_ACQUIRE_TIMEOUT", 5))
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+
+class AgedConnection(asyncpg.Connection):
+    """
+    asyncpg connection that remembers when it was opened, since asyncpg pools only limit idle time
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.opened_at = time.monotonic()
+
+
+async def get_pool():
+    """
+    Returns the process-wide asyncpg pool, creating it on first use from the same
+    environment variables as PGDatabase
+    """
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                uri = os.environ.get("DATABASE_URL")
+                if uri is not None:
+                    connect_kwargs = {"dsn": uri}
+                else:
+                    connect_kwargs = {
+                        "database": os.environ.get("DBNAME"),
+                        "user": os.environ.get("DBUSER"),
+                        "host": os.environ.get("DBHOST"),
+                        "port": os.environ.get("DBPORT"),
+                        "password": os.environ.get("DBPASSWORD")
+                    }
+                _pool = await asyncpg.create_pool(
+                    min_size=min(async_pool_min_size, async_pool_max_size),
+                    max_size=async_pool_max_size,
+                    max_inactive_connection_lifetime=async_pool_max_idle,
+                    connection_class=AgedConnection,
+                    **connect_kwargs
+                )
+    return _pool
+
+
+class AsyncPGDatabase():
+    """
+    asyncio counterpart of PGDatabase. Use as an async context manager; the work done inside
+    the block runs in a single transaction on a pooled connection.
+    Note that asyncpg uses $1, $2, ... placeholders instead of %s.
+    """
+
+    async def __aenter__(self):
+        self.pool = await get_pool()
+        with timer("db.acquire"):
+            self.conn = await self.pool.acquire(timeout=async_pool_acquire_timeout)
+        self.transaction = self.conn.transaction()
+        await self.transaction.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                await self.transaction.commit()
+            else:
+                await self.transaction.rollback()
+        finally:
+            if time.monotonic() - self.conn.opened_at > async_pool_max_lifetime:
+                # Closing hands the connection's slot back to the pool, which opens a new one when needed
+                try:
+                    await self.conn.close(timeout=async_pool_acquire_timeout)
+                except Exception as e:
+                    logging.warning(f"Unable to close expired database connection: {e}")
+            await self.pool.release(self.conn)
+        return False
+
+    @timed("db.query")
+    async def execute(self, query, *args):
+        logging.debug(query)
+        logging.debug(args)
+        return await self.conn.execute(query, *args)
+
+    @timed("db.query")
+    async def fetchrow(self, query, *args):
+        logging.debug(query)
+        logging.debug(args)
+        return await self.conn.fetchrow(query, *args)
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
@@ -0,0 +1,177 @@
+import asyncio
+import time
+import aiohttp
+import logging
+import weather
+import forecaststore
+from forecast import Forecast
+from instrumentation import timed
+
+logging.basicConfig(level=logging.ERROR)
+
+# Status codes worth retrying, mirroring the retry policy of weather.create_session
+retry_statuses = (429, 500, 502, 503, 504)
+
+_session = None
+# Normalized location -> Future of the in-flight upstream request
+_flights = {}
+# Normalized location -> Task refreshing its stale stored forecast. Holding the task keeps it from being
+# garbage collected mid-run, and a location is only refreshed once at a time.
+_refreshes = {}
+
+
+def get_session():
+    """
+    Returns the keep-alive aiohttp session used for WeatherAPI requests, creating it inside the running event loop
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=weather.weather_pool_size, keepalive_timeout=30),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=weather.weather_connect_timeout,
+                sock_read=weather.weather_read_timeout
+            ),
+            headers={
+                "Accept": "application/json",
+                "Accept-Encoding": "gzip, deflate"
+            }
+        )
+    return _session
+
+
+@timed("weather.fetch")
+async def fetch_weather(location):
+    """
+    Retrieves hourly weather conditions from WeatherAPI.com without blocking the event loop, bypassing the forecast cache.
+    Returns the response parsed into a Forecast and the Forecast's size in bytes.
+
+    Arguments:
+      location -- A string representing your location. Weather API can handle a lot of things like city name, postal code, or coordinates
+    """
+    params = {
+        'key': weather.weather_api_key or '',
+        'q': location,
+        'days': weather.forecast_days,
+        'alerts': "no"
+    }
+    for attempt in range(weather.weather_retries + 1):
+        last_attempt = attempt == weather.weather_retries
+        try:
+            async with get_session().get(weather.weatherurl, params=params) as response:
+                if response.status == 200:
+                    # Parsed as the body downloads, like weather.fetch_weather
+                    weather_info = await Forecast.from_async_stream(response.content)
+                    return weather_info, weather_info.nbytes
+                body = await response.read()
+                retry_after = response.headers.get("Retry-After", "")
+                # Like weather.CappedRetry, a long Retry-After fails the fetch instead of waiting
+                too_long = retry_after.isdigit() and int(retry_after) > weather.weather_max_retry_after
+                if response.status not in retry_statuses or last_attempt or too_long:
+                    raise weather.WeatherAPIError(response.status, body.decode(errors="replace"))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if last_attempt:
+                raise
+            retry_after = ""
+        delay = min(weather.weather_retry_backoff * (2 ** attempt), weather.weather_max_retry_after)
+        if retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        await asyncio.sleep(delay)
+
+
+async def guarded_fetch_weather(location):
+    """
+    fetch_weather behind the same circuit breaker as weather.guarded_fetch_weather
+
+    Arguments:
+      location -- A string representing your location. Weather API can handle a lot of things like city name, postal code, or coordinates
+    """
+    weather.weather_breaker.allow()
+    try:
+        result = await fetch_weather(location)
+    except Exception as e:
+        weather.weather_breaker.record_failure(e)
+        raise
+    except BaseException:
+        # Cancelled, which says nothing about WeatherAPI
+        weather.weather_breaker.abandon()
+        raise
+    weather.weather_breaker.record_success()
+    return result
+
+
+async def get_weather(location):
+    """
+    asyncio counterpart of weather.get_weather, sharing the same forecast cache.
+    Concurrent requests for the same location wait on a single upstream request.
+
+    Arguments:
+      location -- A string representing your location. Weather API can handle a lot of things like city name, postal code, or coordinates
+    """
+    key = weather.normalize_location(location)
+    cached = weather.forecast_cache.peek(key)
+    if cached is not None:
+        return cached
+    flight = _flights.get(key)
+    if flight is None:
+        flight = asyncio.ensure_future(_load(key))
+        _flights[key] = flight
+        flight.add_done_callback(lambda _: _flights.pop(key, None))
+    return await asyncio.shield(flight)
+
+
+async def _load(key):
+    """
+    asyncio counterpart of weather.load_forecast. The forecast store is read and written on a thread.
+    Forecasts shared by other workers are used, but misses don't wait for another worker's fetch.
+    """
+    if weather.shared_forecasts is not None:
+        value = weather.shared_forecasts.peek(key)
+        if value is not None:
+            weather.forecast_cache.put(key, value, value.nbytes, value.expires_at - time.time())
+            return value
+    if forecaststore.forecast_store_enabled:
+        stored = await asyncio.to_thread(forecaststore.try_read, key)
+        if stored is not None:
+            value, size, age = stored
+            freshness = forecaststore.classify(age)
+            if freshness != forecaststore.EXPIRED:
+                if freshness == forecaststore.STALE and key not in _refreshes:
+                    _refreshes[key] = asyncio.ensure_future(_refresh(key))
+                    _refreshes[key].add_done_callback(lambda _: _refreshes.pop(key, None))
+                weather.forecast_cache.put(key, value, size, forecaststore.cache_ttl(age))
+                return value
+    value, size = await guarded_fetch_weather(key)
+    await asyncio.to_thread(weather.share_forecast, key, value, size)
+    if forecaststore.forecast_store_enabled:
+        await asyncio.to_thread(forecaststore.try_write, key, value)
+    return value
+
+
+async def _refresh(key):
+    try:
+        value, size = await guarded_fetch_weather(key)
+        await asyncio.to_thread(weather.share_forecast, key, value, size)
+        await asyncio.to_thread(forecaststore.try_write, key, value)
+    except Exception as e:
+        logging.error(f"Background forecast refresh for {key} failed: {e}")
+
+
+async def get_best_walk(prefs, day=0, top_k=None):
+    """
+    asyncio counterpart of weather.get_best_walk
+
+    Arguments:
+      prefs -- User preferences as a dictionary
+      day -- first forecast day to search, 0 for today and 1 for tomorrow
+      top_k -- number of best hours to return, defaults to WALKTIME_TOP_K
+    """
+    user_prefs = weather.safe_user_prefs_defaults(prefs)
+    return weather.search_best_walk(await get_weather(weather.forecast_location(user_prefs)), user_prefs, day, top_k)
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
@@ -0,0 +1,431 @@
+"""
+Benchmarks for the /walktime and Home tab pipelines.
+
+The Flask app is served on a local port and driven with signed Slack requests, while a local
+stand-in server plays both WeatherAPI (replaying a recorded forecast) and the Slack Web API
+(receiving views.publish calls and /walktime responses). A request's end-to-end latency runs
+from sending it to the stand-in receiving its Home tab or its response, so work done after
+the acknowledgement is included.
+
+Usage:
+  python benchmark.py                      # pipelines and micro-benchmarks
+  python benchmark.py --concurrency 8 --requests 500 --locations 50 --teams 1
+  python benchmark.py --forecast recorded.json --weather-latency 150
+  python benchmark.py --database postgres  # use the database configured in the environment
+  python benchmark.py --record 90210 > recorded.json  # record a forecast with WEATHERAPI_KEY
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import copy
+import hashlib
+import argparse
+import threading
+import timeit
+import subprocess
+import logging
+from urllib.parse import urlparse, parse_qs, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+signing_secret = "benchmark-signing-secret"
+
+
+def synthetic_forecast(days=3):
+    """
+    Builds a WeatherAPI-shaped forecast, including the fields the app never reads, for when no recording is given
+    """
+    start = int(time.time()) // 86400 * 86400
+    forecast_days = []
+    for day in range(days):
+        hours = []
+        for hour in range(24):
+            epoch = start + day * 86400 + hour * 3600
+            hours.append({
+                "time_epoch": epoch,
+                "time": time.strftime("%Y-%m-%d %H:%M", time.gmtime(epoch)),
+                "temp_c": 8 + hour * 0.6, "temp_f": 46.4 + hour * 1.08,
+                "is_day": int(6 <= hour < 20),
+                "condition": {"text": "Partly cloudy", "icon": "//cdn.weatherapi.com/weather/64x64/day/116.png", "code": 1003},
+                "wind_mph": (hour * 7) % 40, "wind_kph": (hour * 11) % 64, "wind_degree": hour * 15, "wind_dir": "WSW",
+                "pressure_mb": 1015.0, "pressure_in": 29.98, "precip_mm": 0.0, "precip_in": 0.0, "humidity": 60,
+                "cloud": 40, "feelslike_c": 7 + hour * 0.7, "feelslike_f": 44.6 + hour * 1.26, "windchill_c": 7.0,
+                "windchill_f": 44.6, "heatindex_c": 9.0, "heatindex_f": 48.2, "dewpoint_c": 3.0, "dewpoint_f": 37.4,
+                "will_it_rain": int(hour % 5 == 0), "chance_of_rain": (hour * 13) % 100, "will_it_snow": 0,
+                "chance_of_snow": 0, "vis_km": 10.0, "vis_miles": 6.0, "gust_mph": 12.1, "gust_kph": 19.4, "uv": 3.0
+            })
+        forecast_days.append({
+            "date": time.strftime("%Y-%m-%d", time.gmtime(start + day * 86400)),
+            "date_epoch": start + day * 86400,
+            "day": {"maxtemp_c": 22.0, "mintemp_c": 8.0, "avgtemp_c": 15.0, "maxwind_mph": 20.0, "totalprecip_mm": 0.0,
+                    "avghumidity": 60.0, "daily_chance_of_rain": 40, "condition": {"text": "Partly cloudy", "code": 1003}},
+            "astro": {"sunrise": "06:58 AM", "sunset": "06:12 PM", "moonrise": "09:14 PM", "moonset": "11:41 AM",
+                      "moon_phase": "Waning Gibbous", "moon_illumination": "72"},
+            "hour": hours
+        })
+    return {
+        "location": {"name": "Beverly Hills", "region": "California", "country": "USA", "lat": 34.09, "lon": -118.41,
+                     "tz_id": "America/Los_Angeles", "localtime_epoch": int(time.time()), "localtime": ""},
+        "current": {"last_updated_epoch": int(time.time()), "temp_c": 15.0, "temp_f": 59.0, "feelslike_c": 14.0,
+                    "feelslike_f": 57.2, "wind_mph": 8.1, "condition": {"text": "Sunny", "code": 1000}},
+        "forecast": {"forecastday": forecast_days}
+    }
+
+
+def replay_forecast(recorded):
+    """
+    Shifts a recorded forecast so that its first day is today, keeping hours in the future
+    """
+    forecast = copy.deepcopy(recorded)
+    days = forecast["forecast"]["forecastday"]
+    offset = (int(time.time()) // 86400 - days[0]["hour"][0]["time_epoch"] // 86400) * 86400
+    for day in days:
+        for hour in day["hour"]:
+            hour["time_epoch"] += offset
+    forecast["location"]["localtime_epoch"] = int(time.time())
+    return forecast
+
+
+class StandIn():
+    """
+    Local stand-in for WeatherAPI and the Slack Web API. Records when each benchmark request completes.
+    """
+
+    def __init__(self, forecast, weather_latency):
+        self.forecast_body = json.dumps(forecast).encode()
+        self.weather_latency = weather_latency
+        self.weather_calls = 0
+        self.completed = {}
+        self.condition = threading.Condition()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stand_in.weather_calls += 1
+                time.sleep(stand_in.weather_latency)
+                self.reply(stand_in.forecast_body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                path = urlparse(self.path).path
+                if path.startswith("/respond/"):
+                    stand_in.complete(path[len("/respond/"):])
+                elif path == "/api/auth.test":
+                    self.reply(json.dumps({"ok": True, "user_id": "UBENCH", "bot_id": "BBENCH", "team_id": "TBENCH"}).encode())
+                    return
+                elif path == "/api/views.publish":
+                    stand_in.complete(parse_qs(body)["user_id"][0])
+                self.reply(b'{"ok": true}')
+
+            def reply(self, body):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%i" % self.server.server_port
+
+    def complete(self, request_id):
+        with self.condition:
+            self.completed[request_id] = time.perf_counter()
+            self.condition.notify_all()
+
+    def wait(self, request_id, timeout):
+        """
+        Returns when a request completed, or None if it didn't within timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while request_id not in self.completed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.completed.pop(request_id)
+
+
+def load_app(stand_in, database, db_latency):
+    """
+    Imports app.py against the stand-in. With database="stub", preferences live in memory.
+    """
+    os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-benchmark")
+    os.environ["SLACK_SIGNING_SECRET"] = signing_secret
+    if database == "stub":
+        os.environ["FORECAST_STORE"] = "false"
+        os.environ["PREFS_CACHE_NOTIFY"] = "false"
+        os.environ["BEST_WALKS"] = "false"
+        os.environ["PREFETCH_DEMAND"] = "false"
+
+    # Bolt checks the token with auth.test on import, so point every Slack client at the stand-in
+    from slack_sdk import WebClient
+    web_client_init = WebClient.__init__
+
+    def stand_in_init(self, *args, **kwargs):
+        kwargs["base_url"] = stand_in.url + "/api/"
+        web_client_init(self, *args, **kwargs)
+    WebClient.__init__ = stand_in_init
+
+    import app
+    import weather
+    weather.weatherurl = stand_in.url + "/v1/forecast.json"
+    weather.session.mount("http://", weather.session.get_adapter("https://"))
+
+    if database == "stub":
+        stored_prefs = {}
+
+        def read_user_prefs(user_and_team_id):
+            time.sleep(db_latency)
+            return stored_prefs.get(user_and_team_id, {"location": '', "ideal_temp": int(), "units": '', "canonical_location": None})
+
+        def write_user_info(user_and_team_id, user_id, team_id, location, units, ideal_temp, canonical_location):
+            time.sleep(db_latency)
+            stored_prefs[user_and_team_id] = {"location": location, "ideal_temp": ideal_temp, "units": units, "canonical_location": canonical_location}
+
+        app.read_user_prefs = read_user_prefs
+        app.write_user_info = write_user_info
+        app.locations.try_resolve_location = lambda location: None
+    return app
+
+
+def sign(body):
+    timestamp = str(int(time.time()))
+    signature = hmac.new(signing_secret.encode(), f"v0:{timestamp}:{body}".encode(), hashlib.sha256).hexdigest()
+    return {
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": f"v0={signature}"
+    }
+
+
+def walktime_request(request_id, stand_in, team_id, location):
+    body = urlencode({
+        "token": "benchmark", "team_id": team_id, "user_id": f"U{request_id}", "command": "/walktime", "text": "",
+        "api_app_id": "ABENCH", "response_url": f"{stand_in.url}/respond/{request_id}", "trigger_id": request_id
+    })
+    return body, "application/x-www-form-urlencoded", request_id
+
+
+def home_tab_request(request_id, stand_in, team_id, location):
+    body = json.dumps({
+        "type": "event_callback", "team_id": team_id, "api_app_id": "ABENCH", "event_id": f"Ev{request_id}",
+        "event": {"type": "app_home_opened", "user": f"U{request_id}", "tab": "home",
+                  "view": {"team_id": team_id, "private_metadata": ""}}
+    })
+    return body, "application/json", f"U{request_id}"
+
+
+def save_preferences_request(request_id, stand_in, team_id, location):
+    payload = {
+        "type": "block_actions", "team": {"id": team_id}, "api_app_id": "ABENCH", "trigger_id": request_id,
+        "user": {"id": f"U{request_id}", "team_id": team_id},
+        "actions": [{"action_id": "save_preferences", "block_id": "save", "type": "button"}],
+        "view": {"type": "home", "team_id": team_id, "state": {"values": {
+            "location_block": {"location_submit": {"type": "plain_text_input", "value": location}},
+            "units_block": {"units_submit": {"type": "radio_buttons", "selected_option": {"value": "f"}}},
+            "ideal_temp_block": {"ideal_temperature_submit": {"type": "plain_text_input", "value": "70"}}
+        }}}
+    }
+    return urlencode({"payload": json.dumps(payload)}), "application/x-www-form-urlencoded", f"U{request_id}"
+
+
+pipelines = {
+    "walktime": walktime_request,
+    "home_tab": home_tab_request,
+    "save_preferences": save_preferences_request
+}
+
+
+def percentile(samples, fraction):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not samples:
+        return float("nan")
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def run_pipeline(name, app_url, stand_in, args):
+    """
+    Sends args.requests requests of one kind with args.concurrency clients and returns the results
+    """
+    import requests
+    build_request = pipelines[name]
+    local = threading.local()
+
+    def send(index):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        request_id = f"{name}{index}"
+        body, content_type, completion_id = build_request(request_id, stand_in, f"T{index % args.teams}", f"location {index % args.locations}")
+        started = time.perf_counter()
+        response = local.session.post(app_url, data=body, headers=dict(sign(body), **{"Content-Type": content_type}))
+        acked = time.perf_counter()
+        if response.status_code != 200:
+            return None
+        completed = stand_in.wait(completion_id, args.timeout)
+        if completed is None:
+            return None
+        return acked - started, completed - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as clients:
+        results = list(clients.map(send, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    succeeded = [result for result in results if result is not None]
+    ack = sorted(result[0] for result in succeeded)
+    end_to_end = sorted(result[1] for result in succeeded)
+    return {
+        "pipeline": name,
+        "requests": args.requests,
+        "failed": len(results) - len(succeeded),
+        "throughput": len(succeeded) / elapsed,
+        "ack_p50_ms": percentile(ack, 0.50) * 1000,
+        "p50_ms": percentile(end_to_end, 0.50) * 1000,
+        "p95_ms": percentile(end_to_end, 0.95) * 1000,
+        "p99_ms": percentile(end_to_end, 0.99) * 1000
+    }
+
+
+def micro_benchmarks(forecast):
+    """
+    Times the scoring and view functions in isolation. Returns microseconds per call.
+    """
+    import weather
+    import views
+    from forecast import Forecast
+
+    parsed = Forecast.from_response(forecast)
+    hours = forecast["forecast"]["forecastday"][0]["hour"]
+    prefs = weather.safe_user_prefs_defaults({"location": "90210", "units": "f", "ideal_temp": 70})
+    conditions = weather.parse_hourly_conditions(parsed, 0)
+    many_prefs = [weather.safe_user_prefs_defaults({"units": "fc"[i % 2], "ideal_temp": 50 + i % 30}) for i in range(1000)]
+    user_prefs = {"location": "90210", "units": "f", "ideal_temp": 70}
+    candidates = {
+        "get_weather_score (24 hours)": lambda: [weather.get_weather_score(hour, prefs) for hour in hours],
+        "get_weather_scores (24 hours)": lambda: weather.get_weather_scores(weather.hours_to_columns(hours), 70, "f"),
+        "find_best_walk": lambda: weather.find_best_walk(conditions, prefs),
+        "search_best_walk": lambda: weather.search_best_walk(parsed, prefs),
+        "find_best_walks (1000 users)": lambda: weather.find_best_walks(conditions, many_prefs),
+        "Forecast.from_response": lambda: Forecast.from_response(forecast),
+        "home_tab_content": lambda: views.home_tab_content(user_prefs, "successful_update"),
+        "home_tab_json": lambda: views.home_tab_json(user_prefs, "successful_update")
+    }
+    results = []
+    for name, func in candidates.items():
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=5, number=number)) / number
+        results.append({"benchmark": name, "us_per_call": best * 1e6})
+    return results
+
+
+def measure_startup(runs):
+    """
+    Times importing app.py with LAZY_STARTUP in fresh interpreters, as a new worker would.
+    Returns the import times in milliseconds, sorted.
+    """
+    env = dict(os.environ, LAZY_STARTUP="true", SLACK_BOT_TOKEN="xoxb-benchmark", SLACK_SIGNING_SECRET=signing_secret)
+    script = "import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)"
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", script], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]) * 1000)
+    return sorted(timings)
+
+
+def record(location):
+    """
+    Prints a live WeatherAPI response for location, for use with --forecast
+    """
+    import requests
+    response = requests.get("https://api.weatherapi.com/v1/forecast.json", params={
+        "key": os.environ.get("WEATHERAPI_KEY"), "q": location, "days": os.environ.get("FORECAST_DAYS", 3), "alerts": "no"
+    }, timeout=10)
+    response.raise_for_status()
+    print(response.text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the /walktime and Home tab pipelines against local stand-ins")
+    parser.add_argument("--pipelines", default=",".join(pipelines), help="comma-separated pipelines to run")
+    parser.add_argument("--requests", type=int, default=200, help="requests per pipeline")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent clients")
+    parser.add_argument("--teams", type=int, default=50,
+                        help="distinct Slack teams; Slack calls are rate limited per team (see slackcalls.py)")
+    parser.add_argument("--locations", type=int, default=20, help="distinct locations in save_preferences requests")
+    parser.add_argument("--forecast", help="recorded WeatherAPI response to replay (see --record)")
+    parser.add_argument("--weather-latency", type=float, default=50, help="simulated WeatherAPI latency in ms")
+    parser.add_argument("--database", choices=("stub", "postgres"), default="stub",
+                        help="keep preferences in memory, or use the database configured in the environment")
+    parser.add_argument("--db-latency", type=float, default=1, help="simulated query latency of the stub database in ms")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for a request to complete")
+    parser.add_argument("--no-micro", action="store_true", help="skip the micro-benchmarks")
+    parser.add_argument("--startup-budget", type=float, default=750,
+                        help="import time budget for app.py in ms; the benchmark fails when the median exceeds it")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--record", metavar="LOCATION", help="print a live WeatherAPI response and exit")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record)
+        return
+
+    if args.forecast:
+        with open(args.forecast) as recorded:
+            forecast = replay_forecast(json.load(recorded))
+    else:
+        forecast = synthetic_forecast()
+
+    stand_in = StandIn(forecast, args.weather_latency / 1000)
+    app = load_app(stand_in, args.database, args.db_latency / 1000)
+
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app_server = make_server("127.0.0.1", 0, app.flask_app, threaded=True)
+    threading.Thread(target=app_server.serve_forever, daemon=True).start()
+    app_url = "http://127.0.0.1:%i/slack/events" % app_server.server_port
+
+    results = {"pipelines": [], "micro": []}
+    for name in args.pipelines.split(","):
+        results["pipelines"].append(run_pipeline(name, app_url, stand_in, args))
+    results["weather_calls"] = stand_in.weather_calls
+    if not args.no_micro:
+        results["micro"] = micro_benchmarks(forecast)
+        startup = measure_startup(5)
+        results["startup"] = {"p50_ms": percentile(startup, 0.5), "max_ms": startup[-1], "budget_ms": args.startup_budget}
+    app_server.shutdown()
+    over_budget = "startup" in results and results["startup"]["p50_ms"] > args.startup_budget
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 1 if over_budget else 0
+    print(f"{'pipeline':<18}{'requests':>9}{'failed':>8}{'req/s':>9}{'ack p50':>10}{'p50':>9}{'p95':>9}{'p99':>9}  (ms)")
+    for result in results["pipelines"]:
+        print(f"{result['pipeline']:<18}{result['requests']:>9}{result['failed']:>8}{result['throughput']:>9.1f}"
+              f"{result['ack_p50_ms']:>10.2f}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}")
+    print(f"WeatherAPI requests: {results['weather_calls']}")
+    if results["micro"]:
+        print()
+        print(f"{'micro-benchmark':<34}{'us/call':>10}")
+        for result in results["micro"]:
+            print(f"{result['benchmark']:<34}{result['us_per_call']:>10.1f}")
+        startup = results["startup"]
+        print()
+        print(f"app.py import (LAZY_STARTUP): p50 {startup['p50_ms']:.0f} ms, max {startup['max_ms']:.0f} ms, "
+              f"budget {startup['budget_ms']:.0f} ms{' - OVER BUDGET' if over_budget else ''}")
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import argparse
+import logging
+import weather
+from cache import TTLCache
+from pgdatabase import PGDatabase
+
+logging.basicConfig(level=logging.ERROR)
+
+# Precomputed best walks. Run `python bestwalks.py` after each forecast refresh (e.g. every 15 minutes from
+# Heroku Scheduler) and set BEST_WALKS to "true", so /walktime reads its answer from userprefs.best_walks
+# instead of scoring the forecast. Without the job the lookup would only cost every request a query.
+best_walks_enabled = os.environ.get("BEST_WALKS", "false").lower() in ("1", "true", "yes")
+# Precomputed results are never served for longer than this (in seconds), however far off their hours are
+best_walks_ttl = float(os.environ.get("BEST_WALKS_TTL", 3600))
+# Forecast days precomputed, matching the days /walktime can ask for (today and tomorrow)
+best_walks_days = int(os.environ.get("BEST_WALKS_DAYS", 2))
+# The last best walk served for each preference tuple is kept in memory for this long (in seconds),
+# and served when WeatherAPI or the workers are overloaded (see admission.py)
+last_best_walks_ttl = float(os.environ.get("LAST_BEST_WALKS_TTL", 12 * 3600))
+last_best_walks_max_entries = int(os.environ.get("LAST_BEST_WALKS_MAX_ENTRIES", 10000))
+
+# Every entry counts as one "byte", so the byte bound is the entry bound
+last_best_walks = TTLCache(
+    ttl=last_best_walks_ttl,
+    max_entries=last_best_walks_max_entries,
+    max_bytes=last_best_walks_max_entries
+)
+
+
+def preference_key(user_prefs):
+    """
+    Returns the (location, units, ideal_temp) tuple that determines a user's best walk
+
+    Arguments:
+      user_prefs -- User preferences as a dictionary, already passed through safe_user_prefs_defaults
+    """
+    return (
+        weather.normalize_location(weather.forecast_location(user_prefs)),
+        user_prefs["units"],
+        int(user_prefs["ideal_temp"])
+    )
+
+
+def distinct_preferences():
+    """
+    Returns every distinct preference tuple among users, grouped by location: {location: {key: user_prefs}}
+    """
+    groups = {}
+    with PGDatabase(readonly=True) as db:
+        rows = db.stream(
+            """SELECT min(location), canonical_location, units, ideal_temp FROM userprefs.userprefs
+               GROUP BY coalesce(canonical_location, lower(trim(location))), canonical_location, units, ideal_temp;""")
+        for location, canonical_location, units, ideal_temp in rows:
+            user_prefs = weather.safe_user_prefs_defaults({
+                "location": location,
+                "canonical_location": canonical_location,
+                "units": units,
+                "ideal_temp": ideal_temp
+            })
+            key = preference_key(user_prefs)
+            groups.setdefault(key[0], {})[key] = user_prefs
+    return groups
+
+
+def expiry(best_walk_info, now):
+    """
+    Returns until when a best walk stays correct: dropping past hours can't change the best of the hours
+    that are left, so it holds until the first of its top hours has passed, or for BEST_WALKS_TTL
+    """
+    first_hour = min(hour["time_epoch"] for hour in best_walk_info["top_walk_hours"])
+    return min(first_hour, now + best_walks_ttl)
+
+
+def compute():
+    """
+    Computes the best walks for every distinct preference tuple and stores them in userprefs.best_walks.
+    Each location's forecast is fetched once and all of its tuples are scored together.
+    Returns the number of locations, results stored and locations skipped.
+    """
+    stats = {"locations": 0, "results": 0, "skipped": 0}
+    rows = []
+    for location, prefs_by_key in distinct_preferences().items():
+        stats["locations"] += 1
+        keys = list(prefs_by_key)
+        try:
+            forecast = weather.get_weather(location)
+            now = time.time()
+            for day in range(best_walks_days):
+                try:
+                    best_walks = weather.search_best_walks(forecast, list(prefs_by_key.values()), day, weather.walk_top_k)
+                except ValueError:
+                    # No hours left from this day on, so requests fall back to computing it
+                    continue
+                for (_, units, ideal_temp), best_walk_info in zip(keys, best_walks):
+                    rows.append((location, units, ideal_temp, day, expiry(best_walk_info, now), json.dumps(best_walk_info)))
+        except Exception as e:
+            logging.error(f"Unable to compute the best walks for {location}: {e}")
+            stats["skipped"] += 1
+    with PGDatabase() as db:
+        stats["results"] = db.execute_values(
+            """INSERT INTO userprefs.best_walks (location, units, ideal_temp, day, expires_at, result)
+               VALUES %s
+               ON CONFLICT (location, units, ideal_temp, day) DO UPDATE SET expires_at = EXCLUDED.expires_at, result = EXCLUDED.result;""",
+            rows,
+            template="(%s, %s, %s, %s, to_timestamp(%s), %s::jsonb)"
+        )
+        db.query("DELETE FROM userprefs.best_walks WHERE expires_at < now() - interval '1 day';")
+    return stats
+
+
+def lookup(user_prefs, day=0):
+    """
+    Returns the precomputed best walk for a user, or None if there is none that is still correct
+
+    Arguments:
+      user_prefs -- User preferences as a dictionary
+      day -- first forecast day to search, 0 for today and 1 for tomorrow
+    """
+    location, units, ideal_temp = preference_key(weather.safe_user_prefs_defaults(user_prefs))
+    with PGDatabase(readonly=True) as db:
+        db.query("""SELECT result::text FROM userprefs.best_walks
+                    WHERE location = %s AND units = %s AND ideal_temp = %s AND day = %s AND expires_at > now();""",
+                 (location, units, ideal_temp, day))
+        result = db.cursor.fetchone()
+    return json.loads(result[0]) if result is not None else None
+
+
+def try_lookup(user_prefs, day=0):
+    if not best_walks_enabled:
+        return None
+    try:
+        return lookup(user_prefs, day)
+    except Exception as e:
+        logging.error(f"Unable to read precomputed best walk: {e}")
+        return None
+
+
+def get_best_walk(prefs, day=0):
+    """
+    Returns the best walk for a user: the precomputed one when available, otherwise computed from the forecast
+
+    Arguments:
+      prefs -- User preferences as a dictionary
+      day -- first forecast day to search, 0 for today and 1 for tomorrow
+    """
+    best_walk_info = try_lookup(prefs, day)
+    if best_walk_info is None:
+        best_walk_info = weather.get_best_walk(prefs, day=day)
+    remember(prefs, day, best_walk_info)
+    return best_walk_info
+
+
+def remember(user_prefs, day, best_walk_info):
+    """
+    Keeps a best walk that was just served, for last_known
+
+    Arguments:
+      user_prefs -- User preferences as a dictionary
+      day -- first forecast day searched
+      best_walk_info -- the best walk served
+    """
+    key = (preference_key(weather.safe_user_prefs_defaults(user_prefs)), day)
+    last_best_walks.put(key, best_walk_info, 1)
+
+
+def last_known(user_prefs, day=0):
+    """
+    Returns the last best walk served for the same preferences without touching the database or WeatherAPI,
+    keeping only the hours that haven't passed yet. Returns None if there is none or all of its hours have passed.
+
+    Arguments:
+      user_prefs -- User preferences as a dictionary
+      day -- first forecast day to search, 0 for today and 1 for tomorrow
+    """
+    key = (preference_key(weather.safe_user_prefs_defaults(user_prefs)), day)
+    best_walk_info = last_best_walks.peek(key)
+    if best_walk_info is None:
+        return None
+    now = time.time()
+    # An hour is still good to walk in until it ends
+    top_walk_hours = [hour for hour in best_walk_info["top_walk_hours"] if hour["time_epoch"] + 3600 > now]
+    if not top_walk_hours:
+        return None
+    return dict(best_walk_info, best_walk_hour=top_walk_hours[0], top_walk_hours=top_walk_hours)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precomputes the best walks for every distinct set of preferences")
+    parser.add_argument("--every", type=float, help="keep running, recomputing every EVERY seconds")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+    while True:
+        started = time.monotonic()
+        stats = compute()
+        logging.info(f"Stored {stats['results']} best walks for {stats['locations']} locations "
+                     f"({stats['skipped']} skipped) in {time.monotonic() - started:.1f}s")
+        if not args.every:
+            break
+        time.sleep(max(0, args.every - (time.monotonic() - started)))
@@ -0,0 +1,162 @@
+import os
+import sys
+import csv
+import time
+import argparse
+import logging
+from slack_sdk import WebClient
+from pgdatabase import PGDatabase, mark_written
+import prefscache
+import locations
+
+logging.basicConfig(level=logging.ERROR)
+
+# Preference records written per statement by bulk imports
+bulk_batch_size = int(os.environ.get("BULK_BATCH_SIZE", 1000))
+
+upsert_query = """INSERT INTO userprefs.userprefs (user_and_team_id, user_id, team_id, location, ideal_temp, units, canonical_location)
+                  VALUES %s
+                  ON CONFLICT (user_and_team_id) DO UPDATE SET location = EXCLUDED.location, ideal_temp = EXCLUDED.ideal_temp,
+                      units = EXCLUDED.units, canonical_location = EXCLUDED.canonical_location;"""
+# Used for defaults, which must not overwrite preferences users already saved
+insert_query = """INSERT INTO userprefs.userprefs (user_and_team_id, user_id, team_id, location, ideal_temp, units, canonical_location)
+                  VALUES %s
+                  ON CONFLICT (user_and_team_id) DO NOTHING;"""
+
+
+def parse_record(record):
+    """
+    Returns the userprefs row of a preference record, without its canonical location.
+    Raises ValueError if the record is malformed.
+
+    Arguments:
+      record -- dictionary with user_id, team_id, location, units and ideal_temp
+    """
+    user_id = (record.get("user_id") or '').strip()
+    team_id = (record.get("team_id") or '').strip()
+    if not user_id or not team_id:
+        raise ValueError("missing user_id or team_id")
+    units = record.get("units") or None
+    if units not in (None, "f", "c"):
+        raise ValueError(f"units must be f or c, not {units!r}")
+    ideal_temp = record.get("ideal_temp")
+    if ideal_temp in (None, ''):
+        ideal_temp = None
+    else:
+        try:
+            ideal_temp = int(ideal_temp)
+        except (TypeError, ValueError):
+            raise ValueError(f"ideal_temp must be a whole number, not {ideal_temp!r}")
+    return (f"{user_id}_{team_id}", user_id, team_id, record.get("location") or '', ideal_temp, units)
+
+
+def upsert_user_prefs(records, batch_size=None, overwrite=True):
+    """
+    Writes many users' preferences in a single transaction, batch_size rows per statement. When a user
+    appears more than once, their last record wins. Malformed records are skipped and counted as invalid.
+    Each distinct location is resolved once (see locations.py), before the transaction opens.
+    Returns the number of rows, invalid records, batches, seconds taken and rows per second.
+
+    Arguments:
+      records -- iterable of dictionaries with user_id, team_id, location, units and ideal_temp
+      batch_size -- rows per statement, defaults to BULK_BATCH_SIZE
+      overwrite -- whether to replace preferences users already have, or only fill in missing ones
+    """
+    batch_size = batch_size or bulk_batch_size
+    stats = {"rows": 0, "invalid": 0, "batches": 0}
+    started = time.monotonic()
+    # A user may only appear once per statement, so the last record for a user wins
+    users = {}
+    for number, record in enumerate(records, start=1):
+        try:
+            row = parse_record(record)
+        except ValueError as e:
+            logging.error(f"Skipping invalid preference record {number}: {e}")
+            stats["invalid"] += 1
+            continue
+        users[row[0]] = row
+    # Resolving may call WeatherAPI, which must not happen while the transaction holds its row locks
+    canonical_locations = {
+        location: locations.try_resolve_location(location) for location in {row[3] for row in users.values()} if location
+    }
+    rows = [row + (canonical_locations.get(row[3]),) for row in users.values()]
+    with PGDatabase() as db:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            db.execute_values(upsert_query if overwrite else insert_query, batch, batch_size=len(batch))
+            user_and_team_ids = [row[0] for row in batch]
+            if prefscache.prefs_cache_notify:
+                db.query("SELECT pg_notify(%s, %s || ' ' || user_and_team_id) FROM unnest(%s) AS user_and_team_id;",
+                         (prefscache.notify_channel, prefscache.process_token, user_and_team_ids))
+            stats["rows"] += len(batch)
+            stats["batches"] += 1
+            logging.info(f"Wrote {stats['rows']} user preferences")
+    # Only now that the transaction committed, so a concurrent read can't cache the old preferences again
+    for user_and_team_id in users:
+        # Replicas may not have the write yet, so these users' next reads go to the primary
+        mark_written(user_and_team_id)
+        prefscache.invalidate(user_and_team_id)
+    stats["seconds"] = time.monotonic() - started
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+
+def read_csv(file):
+    """
+    Reads preference records from a CSV file with a user_id,team_id,location,units,ideal_temp header
+
+    Arguments:
+      file -- open text file
+    """
+    for row in csv.DictReader(file):
+        yield row
+
+
+def team_defaults(client, location, units, ideal_temp):
+    """
+    Yields a preference record with the given defaults for every human member of the bot's workspace
+
+    Arguments:
+      client -- Slack Web API client
+      location -- default location
+      units -- default units ("f" or "c")
+      ideal_temp -- default ideal temperature
+    """
+    for page in client.users_list(limit=200):
+        for member in page["members"]:
+            if member.get("deleted") or member.get("is_bot") or member["id"] == "USLACKBOT":
+                continue
+            yield {
+                "user_id": member["id"],
+                "team_id": member["team_id"],
+                "location": location,
+                "units": units,
+                "ideal_temp": ideal_temp
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes user preferences in bulk")
+    parser.add_argument("--csv", help="CSV file with a user_id,team_id,location,units,ideal_temp header, - for stdin")
+    parser.add_argument("--team-defaults", action="store_true",
+                        help="give every member of the workspace the defaults below, keeping saved preferences")
+    parser.add_argument("--location", default="90210")
+    parser.add_argument("--units", default="f")
+    parser.add_argument("--ideal-temp", type=int, default=72)
+    parser.add_argument("--batch-size", type=int, default=bulk_batch_size)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    if args.team_defaults:
+        stats = upsert_user_prefs(
+            team_defaults(WebClient(token=os.environ.get("SLACK_BOT_TOKEN")), args.location, args.units, args.ideal_temp),
+            batch_size=args.batch_size,
+            overwrite=False
+        )
+    elif args.csv:
+        with (sys.stdin if args.csv == "-" else open(args.csv, newline='')) as file:
+            stats = upsert_user_prefs(read_csv(file), batch_size=args.batch_size)
+    else:
+        parser.error("one of --csv or --team-defaults is required")
+    logging.info(f"Wrote {stats['rows']} user preferences in {stats['batches']} batches, skipped {stats['invalid']} invalid records, "
+                 f"{stats['seconds']:.2f}s ({stats['rows_per_second']:.0f} rows/s)")
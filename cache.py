@@ -0,0 +1,192 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class _Flight():
+    """
+    An in-progress load that concurrent callers for the same key wait on
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        # Set when the key is written or invalidated during the load, whose result is then not cached
+        self.stale = False
+
+
+class TTLCache():
+    """
+    Thread-safe LRU cache whose entries expire after a fixed TTL.
+
+    The cache is bounded both by entry count and by the approximate size of the cached values.
+    Concurrent misses for the same key are deduplicated so only one caller runs the loader,
+    while the others wait for and share its result. A load that overlaps a put or invalidate of its key
+    read the value from before the write, so its result is returned to its callers but not cached.
+    """
+
+    def __init__(self, ttl, max_entries, max_bytes):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (expires_at, size, value), least recently used first
+        self._entries = OrderedDict()
+        self._flights = {}
+        # key -> loads done outside of get(), see begin_load
+        self._loads = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+
+    def get(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() to fill it on a miss
+
+        Arguments:
+          key -- cache key
+          loader -- function with no arguments returning a (value, size in bytes) tuple, or a
+            (value, size in bytes, TTL in seconds) tuple for a value that should expire sooner than the cache's TTL
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                self._remove(key)
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = _Flight()
+                self._flights[key] = flight
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value, size, *ttl = loader()
+            flight.value = value
+            with self._lock:
+                if not flight.stale:
+                    self._put(key, value, size, *ttl)
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def peek(self, key):
+        """
+        Returns the cached value for key, or None when it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value, size, ttl=None):
+        """
+        Stores a new value for key, e.g. a write-through. Loads of key in progress won't overwrite it.
+
+        Arguments:
+          ttl -- seconds until the value expires, if sooner than the cache's TTL
+        """
+        with self._lock:
+            self._mark_stale(key)
+            self._put(key, value, size, ttl)
+
+    def begin_load(self, key):
+        """
+        Registers a load of key done outside of get(), e.g. by the asyncio client.
+        Returns the flight to pass to end_load once the load is done.
+        """
+        flight = _Flight()
+        with self._lock:
+            self._loads.setdefault(key, []).append(flight)
+        return flight
+
+    def end_load(self, key, flight, loaded=None):
+        """
+        Caches the result of a load started with begin_load, unless key was written or invalidated meanwhile
+
+        Arguments:
+          key -- cache key
+          flight -- as returned by begin_load
+          loaded -- (value, size in bytes) or (value, size in bytes, TTL) tuple, or None if the load failed
+        """
+        with self._lock:
+            loads = self._loads[key]
+            loads.remove(flight)
+            if not loads:
+                del self._loads[key]
+            if loaded is not None and not flight.stale:
+                self._put(key, *loaded)
+
+    def _mark_stale(self, key):
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.stale = True
+        for flight in self._loads.get(key, ()):
+            flight.stale = True
+
+    def _put(self, key, value, size, ttl=None):
+        if key in self._entries:
+            self._remove(key)
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if size > self.max_bytes or ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def invalidate(self, key):
+        """
+        Drops the cached value for key, if any
+        """
+        with self._lock:
+            self._mark_stale(key)
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._flights) + list(self._loads):
+                self._mark_stale(key)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
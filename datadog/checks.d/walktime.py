@@ -0,0 +1,39 @@
+import requests
+
+try:
+    from datadog_checks.base import AgentCheck
+except ImportError:
+    from checks import AgentCheck
+
+__version__ = "1.0.0"
+
+# Counters that only ever go up are reported as monotonic counts, everything else as gauges
+MONOTONIC = (
+    "created", "discarded", "acquired", "acquire_timeouts", "acquire_wait_seconds",
+    "hits", "misses", "coalesced", "invalidations",
+    "submitted", "rejected", "sent", "retried", "failed",
+    "handled", "duplicates", "retries", "shared_duplicates", "shared_errors", "released",
+    "admitted", "expired", "degraded", "failures", "opened", "short_circuited",
+    "stores", "evictions", "unshareable", "torn_reads", "fetch_waits"
+)
+
+
+class WalkTimeCheck(AgentCheck):
+    """
+    Polls one of the app's /metrics/<namespace> endpoints and reports its stats as walktime.<namespace>.* metrics.
+    The instance's headers are sent with the request, e.g. the app's X-Metrics-Token.
+    """
+
+    def check(self, instance):
+        url = instance.get("url")
+        namespace = instance.get("namespace")
+        tags = instance.get("tags", [])
+        response = requests.get(url, headers=instance.get("headers", {}), timeout=instance.get("timeout", 2))
+        response.raise_for_status()
+        for name, value in response.json().items():
+            metric = f"walktime.{namespace}.{name}"
+            # Names may be qualified, e.g. "home_tab.admitted"
+            if name.rpartition(".")[2] in MONOTONIC:
+                self.monotonic_count(metric, value, tags=tags)
+            else:
+                self.gauge(metric, value, tags=tags)
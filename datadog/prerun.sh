@@ -6,3 +6,7 @@ sed -i "s/<YOUR USERNAME>/${DATABASE_USER}/" "$DD_CONF_DIR/conf.d/postgres.d/con
 sed -i "s/<YOUR PASSWORD>/${DATABASE_PASSWORD}/" "$DD_CONF_DIR/conf.d/postgres.d/conf.yaml"
 sed -i "s/<YOUR PORT>/${DATABASE_PORT}/" "$DD_CONF_DIR/conf.d/postgres.d/conf.yaml"
 sed -i "s/<YOUR DBNAME>/${DATABASE_DBNAME}/" "$DD_CONF_DIR/conf.d/postgres.d/conf.yaml"
+
+# Point the app metrics check at the web process
+sed -i "s/<YOUR APP PORT>/${PORT}/g" "$DD_CONF_DIR/conf.d/walktime.d/conf.yaml"
+sed -i "s|<YOUR METRICS TOKEN>|${METRICS_TOKEN}|g" "$DD_CONF_DIR/conf.d/walktime.d/conf.yaml"
@@ -0,0 +1,196 @@
+import sys
+import numpy as np
+import ijson
+
+# Hour fields kept from WeatherAPI responses; everything else is dropped when a response is parsed
+hour_fields = (
+    "time_epoch", "time", "temp_f", "temp_c", "feelslike_f", "feelslike_c",
+    "wind_mph", "chance_of_rain", "chance_of_snow", "will_it_rain"
+)
+# Numeric hour fields kept as arrays, so scoring needs no conversion
+column_fields = ("time_epoch", "chance_of_rain", "chance_of_snow", "feelslike_f", "feelslike_c", "wind_mph")
+location_fields = ("name", "region", "country", "lat", "lon", "tz_id", "localtime_epoch")
+current_fields = ("last_updated_epoch", "temp_f", "temp_c", "feelslike_f", "feelslike_c", "wind_mph")
+
+
+class HourRecord():
+    """
+    One forecast hour, holding only the fields that scoring and rendering need
+    """
+    __slots__ = hour_fields + ("condition_text", "condition_icon")
+
+    def __init__(self, hour):
+        for field in hour_fields:
+            setattr(self, field, hour.get(field, 0))
+        condition = hour.get("condition", {})
+        # Condition texts and icons repeat across hours and locations, so share the strings
+        self.condition_text = sys.intern(condition.get("text", ""))
+        self.condition_icon = sys.intern(condition.get("icon", ""))
+
+    def to_dict(self):
+        """
+        Returns the hour in WeatherAPI's format
+        """
+        hour = {field: getattr(self, field) for field in hour_fields}
+        hour["condition"] = {"text": self.condition_text, "icon": self.condition_icon}
+        return hour
+
+
+class ForecastDay():
+    """
+    One forecast day: its hour records plus their numeric fields as float arrays
+    """
+    __slots__ = ("date", "hours", "columns")
+
+    def __init__(self, day):
+        self.date = day.get("date")
+        self.hours = [HourRecord(hour) for hour in day["hour"]]
+        self.columns = {
+            field: np.fromiter((getattr(hour, field) for hour in self.hours), dtype=np.float64, count=len(self.hours))
+            for field in column_fields
+        }
+
+
+class Forecast():
+    """
+    Compact, read-only form of a WeatherAPI forecast response. Responses are parsed once, when they are
+    fetched, and only this form is cached, so a cached location costs a fraction of the full JSON.
+    """
+    __slots__ = ("location", "current", "days", "nbytes")
+
+    def __init__(self, location, current, days):
+        self.location = location
+        self.current = current
+        self.days = days
+        self.nbytes = self._estimate_size()
+
+    @classmethod
+    def from_response(cls, weather_info):
+        """
+        Parses a WeatherAPI forecast response, or the output of to_dict
+
+        Arguments:
+          weather_info -- decoded WeatherAPI forecast response
+        """
+        location = weather_info["location"]
+        current = weather_info.get("current", {})
+        return cls(
+            location={field: location[field] for field in location_fields if field in location},
+            current={field: current[field] for field in current_fields if field in current},
+            days=[ForecastDay(day) for day in weather_info["forecast"]["forecastday"]]
+        )
+
+    @classmethod
+    def from_stream(cls, stream):
+        """
+        Parses a WeatherAPI forecast response while it is read from stream, keeping only the fields Forecast needs.
+        Unlike from_response, the full document is never held in memory.
+
+        Arguments:
+          stream -- file-like object returning the raw JSON body
+        """
+        builder = ForecastBuilder()
+        for prefix, event, value in ijson.parse(stream, use_float=True):
+            builder.feed(prefix, event, value)
+        return builder.build()
+
+    @classmethod
+    async def from_async_stream(cls, stream):
+        """
+        asyncio counterpart of from_stream
+
+        Arguments:
+          stream -- object with an async read method returning the raw JSON body, such as aiohttp's response.content
+        """
+        builder = ForecastBuilder()
+        async for prefix, event, value in ijson.parse(stream, use_float=True):
+            builder.feed(prefix, event, value)
+        return builder.build()
+
+    def to_dict(self):
+        """
+        Returns the forecast in WeatherAPI's format, with only the fields that were kept
+        """
+        return {
+            "location": self.location,
+            "current": self.current,
+            "forecast": {
+                "forecastday": [
+                    {"date": day.date, "hour": [hour.to_dict() for hour in day.hours]} for day in self.days
+                ]
+            }
+        }
+
+    def _estimate_size(self):
+        size = sys.getsizeof(self.location) + sys.getsizeof(self.current)
+        for day in self.days:
+            size += sys.getsizeof(day.hours) + sum(column.nbytes for column in day.columns.values())
+            for hour in day.hours:
+                size += sys.getsizeof(hour) + sys.getsizeof(hour.time)
+        return size
+
+
+# ijson prefixes of the parts of a WeatherAPI response that Forecast keeps
+day_prefix = "forecast.forecastday.item"
+hour_prefix = day_prefix + ".hour.item"
+kept_values = {
+    **{"location." + field: ("location", field) for field in location_fields},
+    **{"current." + field: ("current", field) for field in current_fields},
+    day_prefix + ".date": ("day", "date"),
+    **{hour_prefix + "." + field: ("hour", field) for field in hour_fields},
+    hour_prefix + ".condition.text": ("condition", "text"),
+    hour_prefix + ".condition.icon": ("condition", "icon")
+}
+
+
+class ForecastBuilder():
+    """
+    Assembles a Forecast from ijson parser events. Values outside kept_values (day summaries, astronomy,
+    unused hour fields) are dropped as they are parsed; each day is converted as soon as it ends.
+    """
+
+    def __init__(self):
+        self.location = {}
+        self.current = {}
+        self.days = []
+        self.day = None
+        self.hour = None
+
+    def feed(self, prefix, event, value):
+        """
+        Consumes one (prefix, event, value) event from ijson.parse
+        """
+        target = kept_values.get(prefix)
+        if target is not None:
+            if event in ("start_map", "start_array"):
+                # Not a scalar, so not a field we know how to keep
+                return
+            part, field = target
+            if part == "hour":
+                self.hour[field] = value
+            elif part == "condition":
+                self.hour.setdefault("condition", {})[field] = value
+            elif part == "day":
+                self.day[field] = value
+            else:
+                getattr(self, part)[field] = value
+        elif prefix == hour_prefix:
+            if event == "start_map":
+                self.hour = {}
+            elif event == "end_map":
+                self.day["hour"].append(self.hour)
+                self.hour = None
+        elif prefix == day_prefix:
+            if event == "start_map":
+                self.day = {"hour": []}
+            elif event == "end_map":
+                self.days.append(ForecastDay(self.day))
+                self.day = None
+
+    def build(self):
+        """
+        Returns the parsed Forecast
+        """
+        if not self.location:
+            raise Exception("WeatherAPI response has no location")
+        return Forecast(location=self.location, current=self.current, days=self.days)
@@ -0,0 +1,155 @@
+import os
+import json
+import threading
+import logging
+from pgdatabase import PGDatabase
+from forecast import Forecast
+from taskqueue import BoundedExecutor, QueueFullError
+
+logging.basicConfig(level=logging.ERROR)
+
+# Persistent forecast store settings. Set FORECAST_STORE to "true" to also keep forecasts in Postgres,
+# so they survive restarts and are shared between dynos.
+forecast_store_enabled = os.environ.get("FORECAST_STORE", "false").lower() in ("1", "true", "yes")
+# Stored forecasts younger than this (in seconds) are served as is
+forecast_store_ttl = float(os.environ.get("FORECAST_STORE_TTL", os.environ.get("FORECAST_CACHE_TTL", 900)))
+# Stored forecasts younger than this are served while a fresh copy is fetched in the background
+forecast_store_max_stale = float(os.environ.get("FORECAST_STORE_MAX_STALE", 6 * 3600))
+# Stale forecasts are only cached in memory for this many seconds, so a failed refresh is soon tried again
+forecast_store_stale_cache_ttl = float(os.environ.get("FORECAST_STORE_STALE_CACHE_TTL", 60))
+
+FRESH = "fresh"
+STALE = "stale"
+EXPIRED = "expired"
+
+refresh_executor = BoundedExecutor(max_workers=2, max_queue_depth=64, name="forecast-refresh")
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def classify(age):
+    """
+    Returns whether a stored forecast of the given age (in seconds) is fresh, stale or expired
+    """
+    if age < forecast_store_ttl:
+        return FRESH
+    if age < forecast_store_max_stale:
+        return STALE
+    return EXPIRED
+
+
+def cache_ttl(age):
+    """
+    Returns how long (in seconds) a stored forecast of the given age may be cached in memory:
+    until it is no longer fresh, or FORECAST_STORE_STALE_CACHE_TTL if it already isn't
+    """
+    if age < forecast_store_ttl:
+        return forecast_store_ttl - age
+    return forecast_store_stale_cache_ttl
+
+
+def read(location):
+    """
+    Returns the stored forecast for a location as (Forecast, size in bytes, age in seconds), or None
+
+    Arguments:
+      location -- normalized location
+    """
+    with PGDatabase(readonly=True) as db:
+        db.query("""SELECT forecast::text, extract(epoch FROM now() - fetched_at)
+                    FROM userprefs.forecasts WHERE location = %s;""", (location,))
+        result = db.cursor.fetchone()
+    if result is None:
+        return None
+    weather_info = Forecast.from_response(json.loads(result[0]))
+    return weather_info, weather_info.nbytes, float(result[1])
+
+
+def write(location, weather_info):
+    """
+    Stores a freshly fetched forecast for a location
+
+    Arguments:
+      location -- normalized location
+      weather_info -- Forecast, only the fields it keeps are stored
+    """
+    with PGDatabase() as db:
+        db.query("""INSERT INTO userprefs.forecasts (location, fetched_at, forecast)
+                    VALUES (%s, now(), %s::jsonb)
+                    ON CONFLICT (location) DO UPDATE SET fetched_at = EXCLUDED.fetched_at, forecast = EXCLUDED.forecast;""",
+                 (location, json.dumps(weather_info.to_dict())))
+
+
+def try_read(location):
+    try:
+        return read(location)
+    except Exception as e:
+        logging.error(f"Unable to read stored forecast for {location}: {e}")
+        return None
+
+
+def try_write(location, weather_info):
+    try:
+        write(location, weather_info)
+    except Exception as e:
+        logging.error(f"Unable to store forecast for {location}: {e}")
+
+
+def load(location, fetch, on_refresh=None):
+    """
+    Loads a forecast through the store: fresh stored forecasts are returned as is, stale ones are returned
+    while fetch refreshes them in the background, and missing or expired ones are fetched and stored.
+    Returns the forecast, its size in bytes, and how long it may be cached (see cache_ttl), or None
+    for a freshly fetched forecast.
+
+    Arguments:
+      location -- normalized location
+      fetch -- function fetching a location's forecast from WeatherAPI, returning (forecast, size in bytes)
+      on_refresh -- called with (location, forecast, size in bytes) after a background refresh
+    """
+    if not forecast_store_enabled:
+        weather_info, size = fetch(location)
+        return weather_info, size, None
+    stored = try_read(location)
+    if stored is not None:
+        weather_info, size, age = stored
+        freshness = classify(age)
+        if freshness == STALE:
+            refresh(location, fetch, on_refresh)
+        if freshness != EXPIRED:
+            return weather_info, size, cache_ttl(age)
+    weather_info, size = fetch(location)
+    try_write(location, weather_info)
+    return weather_info, size, None
+
+
+def refresh(location, fetch, on_refresh=None):
+    """
+    Fetches and stores a location's forecast in the background, unless a refresh is already under way
+
+    Arguments:
+      location -- normalized location
+      fetch -- function fetching a location's forecast from WeatherAPI, returning (forecast, size in bytes)
+      on_refresh -- called with (location, forecast, size in bytes) after the refresh
+    """
+    with _refreshing_lock:
+        if location in _refreshing:
+            return
+        _refreshing.add(location)
+    try:
+        refresh_executor.submit(_refresh, location, fetch, on_refresh)
+    except QueueFullError:
+        # The next request for this location will try again
+        with _refreshing_lock:
+            _refreshing.discard(location)
+
+
+def _refresh(location, fetch, on_refresh):
+    try:
+        weather_info, size = fetch(location)
+        try_write(location, weather_info)
+        if on_refresh is not None:
+            on_refresh(location, weather_info, size)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(location)
@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+import logging
+from cache import TTLCache
+from pgdatabase import PGDatabase
+
+logging.basicConfig(level=logging.ERROR)
+
+# Slack redelivers events (with an X-Slack-Retry-Num header) when we take longer than 3 seconds to respond,
+# which happens exactly when we are overloaded. Requests are remembered by event or trigger ID for this long
+# (in seconds), so retries and duplicate deliveries are acknowledged without being handled again.
+idempotency_ttl = float(os.environ.get("IDEMPOTENCY_TTL", 3600))
+idempotency_max_entries = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", 10000))
+# Set to "true" to also share handled requests between processes through userprefs.handled_requests,
+# for retries delivered to another worker or dyno
+idempotency_shared = os.environ.get("IDEMPOTENCY_SHARED", "false").lower() in ("1", "true", "yes")
+
+# Every entry counts as one "byte", so the byte bound is the entry bound
+handled_requests = TTLCache(
+    ttl=idempotency_ttl,
+    max_entries=idempotency_max_entries,
+    max_bytes=idempotency_max_entries
+)
+
+_stats_lock = threading.Lock()
+_stats = {
+    "handled": 0,
+    "duplicates": 0,
+    "retries": 0,
+    "shared_duplicates": 0,
+    "shared_errors": 0,
+    "released": 0
+}
+_last_cleanup = 0.0
+
+
+def request_key(body):
+    """
+    Returns the key identifying a Slack request across deliveries, or None if it has none
+
+    Arguments:
+      body -- Slack Bolt body
+    """
+    if body.get("event_id"):
+        return f"event:{body['event_id']}"
+    if body.get("trigger_id"):
+        return f"trigger:{body['trigger_id']}"
+    return None
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def claim_shared(key):
+    """
+    Records a request in userprefs.handled_requests. Returns whether no other process handled it within
+    IDEMPOTENCY_TTL. If the database is unavailable the request is treated as new.
+
+    Arguments:
+      key -- request key, see request_key
+    """
+    global _last_cleanup
+    try:
+        with PGDatabase() as db:
+            db.query("""INSERT INTO userprefs.handled_requests (request_key, handled_at) VALUES (%s, now())
+                        ON CONFLICT (request_key) DO UPDATE SET handled_at = EXCLUDED.handled_at
+                            WHERE handled_requests.handled_at < now() - make_interval(secs => %s)
+                        RETURNING 1;""",
+                     (key, idempotency_ttl))
+            first = db.cursor.fetchone() is not None
+            now = time.monotonic()
+            if now - _last_cleanup > idempotency_ttl:
+                _last_cleanup = now
+                db.query("DELETE FROM userprefs.handled_requests WHERE handled_at < now() - make_interval(secs => %s);",
+                         (idempotency_ttl,))
+    except Exception as e:
+        logging.error(f"Unable to check for duplicate request {key}: {e}")
+        _count("shared_errors")
+        return True
+    if not first:
+        _count("shared_duplicates")
+    return first
+
+
+def claim(body, retry_num=None):
+    """
+    Returns whether a Slack request should be handled, i.e. it is the first delivery seen within IDEMPOTENCY_TTL.
+    Requests without an event or trigger ID are always handled.
+
+    Arguments:
+      body -- Slack Bolt body
+      retry_num -- the X-Slack-Retry-Num header, if any
+    """
+    if retry_num:
+        _count("retries")
+    key = request_key(body)
+    if key is None:
+        return True
+    first = []
+
+    def load():
+        # Concurrent deliveries of the same request wait here, and only this one is handled
+        first.append(claim_shared(key) if idempotency_shared else True)
+        return True, 1
+
+    handled_requests.get(key, load)
+    if first and first[0]:
+        _count("handled")
+        return True
+    _count("duplicates")
+    logging.info(f"Skipping duplicate delivery of {key} (retry {retry_num or 0})")
+    return False
+
+
+def release(body):
+    """
+    Forgets a request whose handling failed, so that Slack's retries of it are handled
+
+    Arguments:
+      body -- Slack Bolt body
+    """
+    key = request_key(body)
+    if key is None:
+        return
+    handled_requests.invalidate(key)
+    _count("released")
+    if not idempotency_shared:
+        return
+    try:
+        with PGDatabase() as db:
+            db.query("DELETE FROM userprefs.handled_requests WHERE request_key = %s;", (key,))
+    except Exception as e:
+        logging.error(f"Unable to release failed request {key}: {e}")
+        _count("shared_errors")
+
+
+def stats():
+    """
+    Returns the number of requests handled and of duplicates skipped, i.e. the work saved
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["entries"] = handled_requests.stats()["entries"]
+    return stats
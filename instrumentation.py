@@ -0,0 +1,185 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import functools
+import contextvars
+import inspect
+
+logging.basicConfig(level=logging.ERROR)
+
+# Stage timings are sent as DogStatsD histograms over UDP, to the Datadog agent by default.
+# Both settings are read once at import; when they are off, the hooks below are no-ops or leave functions undecorated.
+statsd_enabled = os.environ.get("STATSD_METRICS", "false").lower() in ("1", "true", "yes")
+statsd_host = os.environ.get("STATSD_HOST", os.environ.get("DD_AGENT_HOST", "127.0.0.1"))
+statsd_port = int(os.environ.get("STATSD_PORT", os.environ.get("DD_DOGSTATSD_PORT", 8125)))
+statsd_prefix = os.environ.get("STATSD_PREFIX", "walktime")
+# Adds a per-request trace ID to every log line
+trace_ids_enabled = os.environ.get("LOG_TRACE_IDS", "false").lower() in ("1", "true", "yes")
+
+current_trace_id_default = "-"
+current_trace_id = contextvars.ContextVar("trace_id", default=current_trace_id_default)
+
+
+class StatsdClient():
+    """
+    Minimal DogStatsD client. Sends are fire-and-forget: a missing agent never slows down or fails a request.
+    """
+
+    def __init__(self, host, port, prefix):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def histogram(self, name, value, tags=None):
+        """
+        Sends a histogram sample
+
+        Arguments:
+          name -- metric name, without the prefix
+          value -- sample value
+          tags -- dictionary of tags
+        """
+        line = f"{self.prefix}.{name}:{value:.3f}|h"
+        if tags:
+            line += "|#" + ",".join(f"{key}:{tag}" for key, tag in tags.items())
+        try:
+            self.socket.sendto(line.encode(), self.address)
+        except OSError as e:
+            logging.debug(f"Unable to send metric {name}: {e}")
+
+
+statsd = StatsdClient(statsd_host, statsd_port, statsd_prefix) if statsd_enabled else None
+
+
+class _NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class _Timer():
+    __slots__ = ("name", "tags", "start")
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        tags = dict(self.tags, outcome="error" if exc_type is not None else "ok")
+        statsd.histogram(self.name, elapsed_ms, tags)
+        return False
+
+
+def timer(name, **tags):
+    """
+    Context manager timing a block and sending its duration in milliseconds as a histogram.
+    When metrics are disabled it returns a shared no-op context manager.
+
+    Arguments:
+      name -- metric name, e.g. "db.query"
+      tags -- tags added to the metric
+    """
+    if statsd is None:
+        return _null_timer
+    return _Timer(name, tags)
+
+
+def timed(name, **tags):
+    """
+    Decorator timing every call of a function or coroutine function, like timer.
+    When metrics are disabled the function is returned undecorated.
+
+    Arguments:
+      name -- metric name, e.g. "view.build"
+      tags -- tags added to the metric
+    """
+    def decorator(func):
+        if statsd is None:
+            return func
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _Timer(name, tags):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(name, tags):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inherited_trace_id():
+    """
+    Returns the trace ID the current call runs under, or None outside of a traced call
+    """
+    trace_id = current_trace_id.get()
+    return trace_id if trace_id != current_trace_id_default else None
+
+
+def traced(handler):
+    """
+    Decorator for Slack handlers: each call gets a new trace ID, which appears in every log line it writes,
+    including those of the background work it hands to a BoundedExecutor or the Slack call queue.
+    A call that already runs under a trace ID, e.g. handed over that way, keeps it.
+    Its total duration is sent as the "request" histogram tagged with the handler name.
+    When both metrics and trace IDs are disabled the function is returned undecorated.
+
+    Arguments:
+      handler -- handler name used in the tag, e.g. "walktime"
+    """
+    def decorator(func):
+        if statsd is None and not trace_ids_enabled:
+            return func
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                token = current_trace_id.set(inherited_trace_id() or uuid.uuid4().hex[:16])
+                try:
+                    with timer("request", handler=handler):
+                        return await func(*args, **kwargs)
+                finally:
+                    current_trace_id.reset(token)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = current_trace_id.set(inherited_trace_id() or uuid.uuid4().hex[:16])
+            try:
+                with timer("request", handler=handler):
+                    return func(*args, **kwargs)
+            finally:
+                current_trace_id.reset(token)
+        return wrapper
+    return decorator
+
+
+class TraceIdFilter(logging.Filter):
+    """
+    Adds the current trace ID to log records as trace_id
+    """
+
+    def filter(self, record):
+        record.trace_id = current_trace_id.get()
+        return True
+
+
+if trace_ids_enabled:
+    for log_handler in logging.getLogger().handlers:
+        log_handler.addFilter(TraceIdFilter())
+        log_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:[trace %(trace_id)s] %(message)s"))
@@ -0,0 +1,115 @@
+import os
+import logging
+import weather
+from cache import TTLCache
+from pgdatabase import PGDatabase
+
+logging.basicConfig(level=logging.ERROR)
+
+# Resolved locations kept in memory, on top of the userprefs.locations table
+location_cache_size = int(os.environ.get("LOCATION_CACHE_SIZE", 10000))
+location_cache = TTLCache(
+    ttl=float(os.environ.get("LOCATION_CACHE_TTL", 86400)),
+    max_entries=location_cache_size,
+    max_bytes=location_cache_size
+)
+
+
+def canonical_query(location_info):
+    """
+    Returns the WeatherAPI query for a place: its coordinates, rounded like normalize_location does
+
+    Arguments:
+      location_info -- the "location" block of a WeatherAPI response
+    """
+    return weather.normalize_location("%f,%f" % (location_info["lat"], location_info["lon"]))
+
+
+def resolve_location(location):
+    """
+    Maps a free-form location ("90210", "Beverly Hills, CA", "34.0736,118.4004") to a canonical location,
+    so every user in the same place shares forecast fetches and batch scoring.
+    The mapping is stored in userprefs.locations, so each distinct input costs at most one WeatherAPI request.
+
+    Inputs that WeatherAPI resolves to the same place (same name, region and country) share the canonical
+    location of the first input seen for that place.
+
+    Arguments:
+      location -- A string representing your location. Weather API can handle a lot of things like city name, postal code, or coordinates
+    """
+    location_input = weather.normalize_location(location)
+    return location_cache.get(location_input, lambda: (_resolve(location_input), 1))
+
+
+def _resolve(location_input):
+    with PGDatabase(readonly=True) as db:
+        db.query("SELECT canonical_location FROM userprefs.locations WHERE location_input = %s;", (location_input,))
+        result = db.cursor.fetchone()
+    if result is not None:
+        return result[0]
+
+    # Resolving warms the forecast cache for this input as well
+    location_info = weather.get_weather(location_input).location
+    with PGDatabase() as db:
+        db.query("""SELECT canonical_location FROM userprefs.locations
+                    WHERE name = %s AND region = %s AND country = %s
+                    ORDER BY resolved_at LIMIT 1;""",
+                 (location_info["name"], location_info["region"], location_info["country"]))
+        result = db.cursor.fetchone()
+        canonical_location = result[0] if result is not None else canonical_query(location_info)
+        db.query("""INSERT INTO userprefs.locations (location_input, canonical_location, name, region, country, lat, lon)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (location_input) DO NOTHING;""",
+                 (
+                     location_input,
+                     canonical_location,
+                     location_info["name"],
+                     location_info["region"],
+                     location_info["country"],
+                     location_info["lat"],
+                     location_info["lon"]
+                 ))
+    logging.debug(f"Resolved location {location_input} to {canonical_location}")
+    return canonical_location
+
+
+def try_resolve_location(location):
+    """
+    Like resolve_location, but returns None instead of raising, so a WeatherAPI or database hiccup
+    never prevents saving preferences. Unresolved users fall back to their raw location.
+
+    Arguments:
+      location -- A string representing your location
+    """
+    if not location:
+        return None
+    try:
+        return resolve_location(location)
+    except Exception as e:
+        logging.error(f"Unable to resolve location {location}: {e}")
+        return None
+
+
+def backfill():
+    """
+    Resolves the canonical location of users who saved their preferences before locations were resolved.
+    Returns the number of users updated.
+    """
+    with PGDatabase() as db:
+        db.query("SELECT DISTINCT location FROM userprefs.userprefs WHERE canonical_location IS NULL AND location <> '';")
+        locations = [row[0] for row in db.cursor.fetchall()]
+    updated = 0
+    for location in locations:
+        canonical_location = try_resolve_location(location)
+        if canonical_location is None:
+            continue
+        with PGDatabase() as db:
+            db.query("UPDATE userprefs.userprefs SET canonical_location = %s WHERE location = %s AND canonical_location IS NULL;",
+                     (canonical_location, location))
+            updated += db.cursor.rowcount
+    return updated
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info(f"Resolved canonical locations for {backfill()} users")
@@ -1,36 +1,427 @@
 import os
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import psycopg2.extras
+import itertools
+from psycopg2 import sql
 import logging
+from instrumentation import timed
 
 logging.basicConfig(level=logging.ERROR)
 
+# Connection pool settings. The pool is shared by every thread in the process that queries Postgres,
+# so it should have a connection for each of them. The app sizes it for its threads with size_pool (see app.py);
+# setting DBPOOL_MAX_SIZE overrides that. Other processes default to one connection per gunicorn thread.
+pool_min_size = int(os.environ.get("DBPOOL_MIN_SIZE", 1))
+pool_max_size = int(os.environ.get("DBPOOL_MAX_SIZE", os.environ.get("WEB_THREADS", 2)))
+# Connections older than this (in seconds) are closed and replaced
+pool_max_lifetime = float(os.environ.get("DBPOOL_MAX_LIFETIME", 1800))
+# Connections idle for longer than this (in seconds) are pinged before reuse
+pool_healthcheck_idle = float(os.environ.get("DBPOOL_HEALTHCHECK_IDLE", 30))
+# How long a thread waits for a free connection before giving up
+pool_acquire_timeout = float(os.environ.get("DBPOOL_ACQUIRE_TIMEOUT", 5))
+
+# Optional read replicas, as a comma-separated list of connection URIs. Read-only queries go to a replica,
+# falling back to the other replicas and then the primary when one can't be reached.
+replica_uris = [uri.strip() for uri in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if uri.strip()]
+replica_connect_timeout = int(os.environ.get("DBREPLICA_CONNECT_TIMEOUT", 2))
+# An unreachable replica is skipped for this many seconds
+replica_retry_after = float(os.environ.get("DBREPLICA_RETRY_AFTER", 30))
+# Reads for a key written less than this many seconds ago go to the primary, covering replication lag
+replica_sticky_seconds = float(os.environ.get("DBREPLICA_STICKY_SECONDS", 10))
+
+# Errors that mean the connection itself is unusable, as opposed to a bad query
+connection_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class ConnectionPool():
+    """
+    Thread-safe pool of long-lived Postgres connections.
+
+    Wraps psycopg2's ThreadedConnectionPool so that callers block (up to a timeout) instead of
+    failing when every connection is checked out, and so that stale or broken connections are
+    replaced transparently on checkout.
+    """
+
+    def __init__(self, min_size, max_size, max_lifetime, healthcheck_idle, acquire_timeout, **connect_kwargs):
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.healthcheck_idle = healthcheck_idle
+        self.acquire_timeout = acquire_timeout
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min(min_size, max_size), max_size, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        # id(connection) -> (created_at, last_used_at)
+        self._times = {}
+        self._stats = {
+            "created": 0,
+            "discarded": 0,
+            "acquired": 0,
+            "acquire_timeouts": 0,
+            "acquire_wait_seconds": 0.0
+        }
+
+    def _healthy(self, conn):
+        """
+        Returns whether a pooled connection can be handed out again
+        """
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        created_at, last_used_at = self._times[id(conn)]
+        now = time.monotonic()
+        if now - created_at > self.max_lifetime:
+            return False
+        if now - last_used_at > self.healthcheck_idle:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                conn.rollback()
+            except connection_errors:
+                return False
+        return True
+
+    @timed("db.acquire")
+    def acquire(self):
+        """
+        Checks out a healthy connection, waiting up to acquire_timeout seconds for one to be free
+        """
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            with self._lock:
+                self._stats["acquire_timeouts"] += 1
+            raise psycopg2.pool.PoolError(
+                "Timed out after %.1fs waiting for a database connection" % self.acquire_timeout)
+        try:
+            while True:
+                conn = self._pool.getconn()
+                with self._lock:
+                    is_new = id(conn) not in self._times
+                    if is_new:
+                        now = time.monotonic()
+                        self._times[id(conn)] = (now, now)
+                        self._stats["created"] += 1
+                if is_new or self._healthy(conn):
+                    break
+                logging.debug("Discarding stale database connection")
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._stats["acquired"] += 1
+            self._stats["acquire_wait_seconds"] += time.monotonic() - started
+        return conn
+
+    def release(self, conn, discard=False):
+        """
+        Returns a connection to the pool. Broken connections (or discard=True) are closed instead.
+        """
+        try:
+            if discard or conn.closed:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    created_at, _ = self._times[id(conn)]
+                    self._times[id(conn)] = (created_at, time.monotonic())
+                self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    def _discard(self, conn):
+        with self._lock:
+            self._times.pop(id(conn), None)
+            self._stats["discarded"] += 1
+        self._pool.putconn(conn, close=True)
+
+    def stats(self):
+        """
+        Returns a snapshot of pool counters and gauges
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["open"] = len(self._times)
+        stats["in_use"] = len(self._pool._used)
+        stats["idle"] = len(self._pool._pool)
+        stats["max_size"] = self.max_size
+        return stats
+
+    def closeall(self):
+        with self._lock:
+            self._times.clear()
+        self._pool.closeall()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+# Pools inherited from the parent process by a forked worker (gunicorn --preload). Their connections share
+# sockets with the parent, so they are kept referenced, never used and never closed from this process.
+_inherited_pools = []
+
+
+def _reset_pools_after_fork():
+    global _pools_lock
+    _inherited_pools.extend(_pools.values())
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+
+def size_pool(threads):
+    """
+    Sizes the pools created from now on for the number of threads querying Postgres at once,
+    unless DBPOOL_MAX_SIZE is set
+
+    Arguments:
+      threads -- number of threads in the process that query Postgres
+    """
+    global pool_max_size
+    if "DBPOOL_MAX_SIZE" not in os.environ:
+        pool_max_size = threads
+
+
+def get_pool(**connect_kwargs):
+    """
+    Returns the process-wide pool for the given connection arguments, creating it on first use
+
+    Arguments:
+      connect_kwargs -- Keyword arguments passed to psycopg2.connect
+    """
+    key = tuple(sorted(connect_kwargs.items()))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(
+                    min_size=pool_min_size,
+                    max_size=pool_max_size,
+                    max_lifetime=pool_max_lifetime,
+                    healthcheck_idle=pool_healthcheck_idle,
+                    acquire_timeout=pool_acquire_timeout,
+                    **connect_kwargs
+                )
+                _pools[key] = pool
+    return pool
+
+
+def pool_stats():
+    """
+    Returns the stats of every connection pool in this process, summed together
+    """
+    totals = {}
+    for pool in list(_pools.values()):
+        for name, value in pool.stats().items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+_replica_down_until = {}
+_replica_turn = itertools.count()
+_recent_writes = {}
+_recent_writes_lock = threading.Lock()
+
+
+def mark_written(key):
+    """
+    Records that the data behind key (e.g. a user) just changed on the primary, so reads for it
+    skip the replicas for DBREPLICA_STICKY_SECONDS
+
+    Arguments:
+      key -- the sticky_key later passed to PGDatabase
+    """
+    now = time.monotonic()
+    with _recent_writes_lock:
+        if len(_recent_writes) > 10000:
+            for expired in [k for k, until in _recent_writes.items() if until <= now]:
+                del _recent_writes[expired]
+        _recent_writes[key] = now + replica_sticky_seconds
+
+
+def recently_written(key):
+    return _recent_writes.get(key, 0) > time.monotonic()
+
+
+def replica_candidates(replicas):
+    """
+    Returns the replicas to try, in round-robin order, leaving out the ones that recently failed
+    """
+    if not replicas:
+        return []
+    start = next(_replica_turn) % len(replicas)
+    now = time.monotonic()
+    return [uri for uri in replicas[start:] + replicas[:start] if _replica_down_until.get(uri, 0) <= now]
+
+
+def mark_replica_down(uri, error):
+    logging.warning(f"Database replica unavailable, skipping it for {replica_retry_after:.0f}s: {error}")
+    _replica_down_until[uri] = time.monotonic() + replica_retry_after
+
+
+def create_listener(channel):
+    """
+    Opens a dedicated connection, outside of the pool, that is subscribed to a NOTIFY channel.
+    Wait for it with select(), then call poll() and read its notifies list.
+
+    Arguments:
+      channel -- name of the NOTIFY channel to LISTEN on
+    """
+    uri = os.environ.get("DATABASE_URL")
+    if uri is not None:
+        conn = psycopg2.connect(uri)
+    else:
+        conn = psycopg2.connect(
+            database=os.environ.get("DBNAME"),
+            user=os.environ.get("DBUSER"),
+            host=os.environ.get("DBHOST"),
+            port=os.environ.get("DBPORT"),
+            password=os.environ.get("DBPASSWORD")
+        )
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("LISTEN {};").format(sql.Identifier(channel)))
+    return conn
+
 
 class PGDatabase():
+    """
+    A transaction on a pooled connection. Pass readonly=True for transactions that only read, so they
+    can be served by a replica (see DATABASE_REPLICA_URLS); pass the sticky_key given to mark_written
+    to send reads that must see a recent write to the primary.
+    """
+
     def __init__(
         self,
         database=os.environ.get("DBNAME"),
         user=os.environ.get("DBUSER"),
         host=os.environ.get("DBHOST"),
-        port=os.environ.get("PORT"),
+        port=os.environ.get("DBPORT"),
         password=os.environ.get("DBPASSWORD"),
-        uri=os.environ.get("DATABASE_URL")
+        uri=os.environ.get("DATABASE_URL"),
+        readonly=False,
+        sticky_key=None,
+        replicas=replica_uris
     ):
         if uri is not None:
-            self.conn = psycopg2.connect(uri)
+            self.primary_kwargs = {"dsn": uri}
+        else:
+            self.primary_kwargs = {
+                "database": database,
+                "user": user,
+                "host": host,
+                "port": port,
+                "password": password
+            }
+        self.replica = None
+        self.conn = None
+        if readonly and not (sticky_key is not None and recently_written(sticky_key)):
+            for replica in replica_candidates(replicas):
+                try:
+                    pool = get_pool(dsn=replica, connect_timeout=replica_connect_timeout)
+                    self.conn = pool.acquire()
+                except connection_errors as e:
+                    mark_replica_down(replica, e)
+                    continue
+                except psycopg2.pool.PoolError as e:
+                    # Busy rather than down, so it stays in rotation
+                    logging.warning(f"Database replica busy: {e}")
+                    continue
+                self.pool = pool
+                self.replica = replica
+                break
+        if self.conn is None:
+            self.pool = get_pool(**self.primary_kwargs)
+            self.conn = self.pool.acquire()
+        self.cursor = self.conn.cursor()
+        self._executed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
         else:
-            self.conn = psycopg2.connect(
-                database=database,
-                user=user,
-                host=host,
-                port=port,
-                password=password
-            )
+            self.close_rollback()
+        return False
+
+    def _reconnect(self):
+        """
+        Swaps a broken connection for a fresh one from the pool. A broken replica connection is swapped
+        for a primary connection instead.
+        """
+        self.pool.release(self.conn, discard=True)
+        self.conn = None
+        if self.replica is not None:
+            mark_replica_down(self.replica, "connection lost")
+            self.pool = get_pool(**self.primary_kwargs)
+            self.replica = None
+        self.conn = self.pool.acquire()
         self.cursor = self.conn.cursor()
 
+    @timed("db.query")
     def query(self, query, data=None):
         logging.debug(query)
         logging.debug(data)
-        self.cursor.execute(query, data)
+        try:
+            self.cursor.execute(query, data)
+        except connection_errors:
+            # Only retry when nothing else has run in this transaction, otherwise earlier
+            # statements would be silently lost along with the old connection
+            if self._executed or not self.conn.closed:
+                raise
+            logging.warning("Database connection lost, reconnecting")
+            self._reconnect()
+            self.cursor.execute(query, data)
+        self._executed = True
+
+    def stream(self, query, data=None, itersize=1000):
+        """
+        Runs a query on a server-side cursor and yields its rows, fetching itersize rows per round trip
+        instead of loading the whole result into memory
+
+        Arguments:
+          query -- SQL query
+          data -- query parameters
+          itersize -- number of rows fetched per round trip
+        """
+        logging.debug(query)
+        logging.debug(data)
+        with self.conn.cursor(name=f"stream_{id(self)}") as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, data)
+            self._executed = True
+            for row in cursor:
+                yield row
+
+    def execute_values(self, query, rows, template=None, batch_size=1000):
+        """
+        Runs a query with a single VALUES %s placeholder for every batch_size rows, expanding it to the rows
+        of the batch, so each batch costs one round trip. rows may be any iterable, including a generator.
+        Returns the number of rows sent.
+
+        Arguments:
+          query -- SQL query containing a single VALUES %s
+          rows -- iterable of row tuples
+          template -- row template, e.g. "(%s, %s, now())", defaults to one %s per value
+          batch_size -- number of rows sent per statement
+        """
+        logging.debug(query)
+        rows = iter(rows)
+        sent = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return sent
+            psycopg2.extras.execute_values(self.cursor, query, batch, template=template, page_size=len(batch))
+            self._executed = True
+            sent += len(batch)
 
     def commit(self):
         self.conn.commit()
@@ -38,12 +429,30 @@ class PGDatabase():
     def rollback(self):
         self.conn.rollback()
 
+    def _release(self):
+        if not self.cursor.closed:
+            self.cursor.close()
+        self.pool.release(self.conn)
+        self.conn = None
+
     def close(self):
-        self.conn.commit()
-        self.cursor.close()
-        self.conn.close()
+        if self.conn is None:
+            return
+        try:
+            self.conn.commit()
+        except connection_errors:
+            self.pool.release(self.conn, discard=True)
+            self.conn = None
+            raise
+        self._release()
 
     def close_rollback(self):
-        self.conn.rollback()
-        self.cursor.close()
-        self.conn.close()
+        if self.conn is None:
+            return
+        try:
+            self.conn.rollback()
+        except connection_errors:
+            self.pool.release(self.conn, discard=True)
+            self.conn = None
+            raise
+        self._release()
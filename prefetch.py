@@ -0,0 +1,201 @@
+import os
+import time
+import argparse
+import threading
+import logging
+from collections import Counter, deque
+import weather
+import forecaststore
+from admission import CircuitOpenError
+from pgdatabase import PGDatabase
+
+logging.basicConfig(level=logging.ERROR)
+
+# Forecast prefetching. The app counts /walktime requests per location and time of day in userprefs.location_demand,
+# and `python prefetch.py --every 300` fetches the forecasts of the locations expected to be busy shortly,
+# so the first request of a peak is served from the forecast store instead of waiting on WeatherAPI.
+# Set to "true" in the app, along with FORECAST_STORE, once userprefs.location_demand exists.
+prefetch_demand_enabled = os.environ.get("PREFETCH_DEMAND", "false").lower() in ("1", "true", "yes")
+# Requests are counted per location and per slot of this many minutes of the (UTC) day
+prefetch_bucket_minutes = int(os.environ.get("PREFETCH_BUCKET_MINUTES", 15))
+# Counts are written to Postgres this often (in seconds)
+prefetch_flush_interval = float(os.environ.get("PREFETCH_FLUSH_INTERVAL", 60))
+# Older requests count for less: a request counts half as much after this many days
+prefetch_half_life_days = float(os.environ.get("PREFETCH_HALF_LIFE_DAYS", 7))
+# Forecasts are warmed for the demand expected within this many minutes
+prefetch_lead_minutes = int(os.environ.get("PREFETCH_LEAD_MINUTES", 30))
+# Locations expected to get fewer (decayed) requests than this in those minutes aren't warmed
+prefetch_min_demand = float(os.environ.get("PREFETCH_MIN_DEMAND", 1))
+# WeatherAPI calls the prefetcher may make per hour
+prefetch_budget = int(os.environ.get("PREFETCH_BUDGET", 100))
+
+_counts = Counter()
+_counts_lock = threading.Lock()
+_flusher = None
+# When the prefetcher called WeatherAPI within the last hour, for the budget
+_recent_fetches = deque()
+
+
+def _reset_after_fork():
+    # Requests counted by the parent are flushed by the parent; the flusher thread doesn't survive a fork
+    global _counts_lock, _flusher
+    _counts.clear()
+    _counts_lock = threading.Lock()
+    _flusher = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def time_bucket(timestamp):
+    """
+    Returns the slot of the (UTC) day a Unix timestamp falls in
+    """
+    return int(timestamp % 86400) // (prefetch_bucket_minutes * 60)
+
+
+def record(user_prefs):
+    """
+    Counts a request for the forecast of a user's location. Counts are written to Postgres in the background.
+
+    Arguments:
+      user_prefs -- User preferences as a dictionary
+    """
+    global _flusher
+    if not prefetch_demand_enabled:
+        return
+    location = weather.normalize_location(weather.forecast_location(weather.safe_user_prefs_defaults(user_prefs)))
+    with _counts_lock:
+        _counts[(location, time_bucket(time.time()))] += 1
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_periodically, name="prefetch-demand", daemon=True)
+            _flusher.start()
+
+
+def flush():
+    """
+    Adds the requests counted since the last flush to userprefs.location_demand, decaying the older counts
+    """
+    with _counts_lock:
+        counts = dict(_counts)
+        _counts.clear()
+    if not counts:
+        return
+    try:
+        with PGDatabase() as db:
+            db.execute_values(
+                f"""INSERT INTO userprefs.location_demand (location, bucket, requests, updated_at)
+                    VALUES %s
+                    ON CONFLICT (location, bucket) DO UPDATE SET
+                        requests = location_demand.requests
+                            * power(0.5, extract(epoch FROM now() - location_demand.updated_at) / {prefetch_half_life_days * 86400:f})
+                            + EXCLUDED.requests,
+                        updated_at = EXCLUDED.updated_at;""",
+                ((location, bucket, requests) for (location, bucket), requests in counts.items()),
+                template="(%s, %s, %s, now())"
+            )
+    except Exception as e:
+        logging.error(f"Unable to store forecast demand, retrying later: {e}")
+        with _counts_lock:
+            _counts.update(counts)
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(prefetch_flush_interval)
+        flush()
+
+
+def expected_demand(now):
+    """
+    Returns [(location, demand)] for the buckets within PREFETCH_LEAD_MINUTES of now, busiest first,
+    leaving out locations below PREFETCH_MIN_DEMAND
+
+    Arguments:
+      now -- Unix timestamp
+    """
+    buckets = sorted({time_bucket(now + minutes * 60) for minutes in range(0, prefetch_lead_minutes + 1, prefetch_bucket_minutes)})
+    with PGDatabase(readonly=True) as db:
+        db.query(
+            """SELECT location, sum(requests * power(0.5, extract(epoch FROM now() - updated_at) / %s)) AS demand
+               FROM userprefs.location_demand WHERE bucket = ANY(%s)
+               GROUP BY location HAVING sum(requests * power(0.5, extract(epoch FROM now() - updated_at) / %s)) >= %s
+               ORDER BY demand DESC;""",
+            (prefetch_half_life_days * 86400, buckets, prefetch_half_life_days * 86400, prefetch_min_demand))
+        return [(location, float(demand)) for location, demand in db.cursor.fetchall()]
+
+
+def stored_ages(locations):
+    """
+    Returns {location: age in seconds} of the stored forecasts of locations
+    """
+    with PGDatabase(readonly=True) as db:
+        db.query("""SELECT location, extract(epoch FROM now() - fetched_at) FROM userprefs.forecasts
+                    WHERE location = ANY(%s);""", (list(locations),))
+        return {location: float(age) for location, age in db.cursor.fetchall()}
+
+
+def remaining_budget(now):
+    """
+    Returns how many WeatherAPI calls the prefetcher may still make in the hour up to now
+    """
+    while _recent_fetches and _recent_fetches[0] <= now - 3600:
+        _recent_fetches.popleft()
+    return prefetch_budget - len(_recent_fetches)
+
+
+def warm():
+    """
+    Fetches the forecasts of the locations expected to be busy within PREFETCH_LEAD_MINUTES, busiest first,
+    into the forecast store. A stored forecast is only replaced once it is no longer fresh, i.e. at most once
+    per FORECAST_STORE_TTL, which matches how often WeatherAPI updates its forecasts.
+    Returns the number of locations expected to be busy, warmed, already fresh, skipped for the budget and failed.
+    """
+    now = time.time()
+    demand = expected_demand(now)
+    ages = stored_ages(location for location, _ in demand)
+    stats = {"locations": len(demand), "warmed": 0, "fresh": 0, "over_budget": 0, "failed": 0}
+    for location, _ in demand:
+        age = ages.get(location)
+        if age is not None and forecaststore.classify(age) == forecaststore.FRESH:
+            stats["fresh"] += 1
+            continue
+        if remaining_budget(time.time()) <= 0:
+            stats["over_budget"] += 1
+            continue
+        _recent_fetches.append(time.time())
+        try:
+            weather_info, _ = weather.guarded_fetch_weather(location)
+            forecaststore.write(location, weather_info)
+            stats["warmed"] += 1
+        except CircuitOpenError as e:
+            # WeatherAPI wasn't called
+            _recent_fetches.pop()
+            logging.error(f"Unable to prefetch the forecast for {location}: {e}")
+            stats["failed"] += 1
+        except Exception as e:
+            logging.error(f"Unable to prefetch the forecast for {location}: {e}")
+            stats["failed"] += 1
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetches the forecasts of locations expected to be busy shortly")
+    parser.add_argument("--every", type=float, help="keep running, warming every EVERY seconds")
+    args = parser.parse_args()
+    if not forecaststore.forecast_store_enabled:
+        parser.error("prefetched forecasts are kept in the forecast store, which is disabled (FORECAST_STORE)")
+    logging.getLogger().setLevel(logging.INFO)
+    while True:
+        started = time.monotonic()
+        try:
+            stats = warm()
+            logging.info(f"Warmed {stats['warmed']} of {stats['locations']} busy locations ({stats['fresh']} fresh, "
+                         f"{stats['over_budget']} over budget, {stats['failed']} failed) in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            if not args.every:
+                raise
+            logging.error(f"Unable to prefetch forecasts: {e}")
+        if not args.every:
+            break
+        time.sleep(max(0, args.every - (time.monotonic() - started)))
@@ -0,0 +1,155 @@
+import os
+import select
+import threading
+import time
+import uuid
+import logging
+from cache import TTLCache
+from pgdatabase import create_listener, mark_written
+
+logging.basicConfig(level=logging.ERROR)
+
+# User preferences cache settings. Entries expire after the TTL even without invalidation,
+# which bounds how stale another worker's cache can get when NOTIFY is disabled.
+prefs_cache_ttl = float(os.environ.get("PREFS_CACHE_TTL", 300))
+prefs_cache_max_entries = int(os.environ.get("PREFS_CACHE_MAX_ENTRIES", 10000))
+# Set to "true" to keep the caches of all workers coherent through Postgres LISTEN/NOTIFY
+prefs_cache_notify = os.environ.get("PREFS_CACHE_NOTIFY", "false").lower() in ("1", "true", "yes")
+notify_channel = "userprefs_changed"
+# Identifies this process in NOTIFY payloads, so it can ignore its own writes
+process_token = uuid.uuid4().hex
+
+# Every entry counts as one "byte", so the byte bound is the entry bound
+prefs_cache = TTLCache(
+    ttl=prefs_cache_ttl,
+    max_entries=prefs_cache_max_entries,
+    max_bytes=prefs_cache_max_entries
+)
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _reset_listener_after_fork():
+    # The listener thread doesn't survive a fork; the next cache read starts a new one
+    global _listener, _listener_lock
+    _listener = None
+    _listener_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_listener_after_fork)
+
+
+def get(user_and_team_id, loader):
+    """
+    Returns a copy of the cached preferences for a user, calling loader() to read them on a miss
+
+    Arguments:
+      user_and_team_id -- The Slack user ID and team ID separated by an underscore
+      loader -- function with no arguments returning the user's preferences
+    """
+    if _listener is None:
+        start_listener()
+    return dict(prefs_cache.get(user_and_team_id, lambda: (loader(), 1)))
+
+
+def peek(user_and_team_id):
+    """
+    Returns a copy of the cached preferences for a user, or None on a miss
+    """
+    if _listener is None:
+        start_listener()
+    prefs = prefs_cache.peek(user_and_team_id)
+    return dict(prefs) if prefs is not None else None
+
+
+def begin_load(user_and_team_id):
+    """
+    Registers a read of a user's preferences done outside of get, e.g. by the asyncio app.
+    Returns the flight to pass to end_load.
+    """
+    if _listener is None:
+        start_listener()
+    return prefs_cache.begin_load(user_and_team_id)
+
+
+def end_load(user_and_team_id, flight, user_prefs=None):
+    """
+    Caches preferences read after begin_load, unless they were saved or invalidated while they were read
+
+    Arguments:
+      user_and_team_id -- The Slack user ID and team ID separated by an underscore
+      flight -- as returned by begin_load
+      user_prefs -- the preferences read, or None if the read failed
+    """
+    prefs_cache.end_load(user_and_team_id, flight, (dict(user_prefs), 1) if user_prefs is not None else None)
+
+
+def write_through(user_and_team_id, user_prefs):
+    """
+    Stores freshly saved preferences, so the next read doesn't go to the database
+
+    Arguments:
+      user_and_team_id -- The Slack user ID and team ID separated by an underscore
+      user_prefs -- the preferences as they were written to the database
+    """
+    # The entry must be invalidated when another process changes these preferences
+    if _listener is None:
+        start_listener()
+    prefs_cache.put(user_and_team_id, dict(user_prefs), 1)
+
+
+def invalidate(user_and_team_id):
+    prefs_cache.invalidate(user_and_team_id)
+
+
+def notify_payload(user_and_team_id):
+    """
+    Returns the NOTIFY payload announcing that a user's preferences changed
+    """
+    return f"{process_token} {user_and_team_id}"
+
+
+def stats():
+    return prefs_cache.stats()
+
+
+def start_listener():
+    """
+    Starts the background thread that invalidates preferences changed by other processes.
+    Does nothing unless PREFS_CACHE_NOTIFY is enabled, or if the thread is already running.
+    """
+    global _listener
+    if not prefs_cache_notify:
+        return
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = threading.Thread(target=_listen, name="prefscache-listener", daemon=True)
+            _listener.start()
+
+
+def _listen():
+    while True:
+        try:
+            conn = create_listener(notify_channel)
+            # Anything could have changed while we weren't listening
+            prefs_cache.clear()
+            try:
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        token, _, user_and_team_id = notify.payload.partition(" ")
+                        if token != process_token:
+                            prefs_cache.invalidate(user_and_team_id)
+                            # The reload must not come from a replica that hasn't caught up yet
+                            mark_written(user_and_team_id)
+            finally:
+                conn.close()
+        except Exception as e:
+            logging.error(f"Preferences cache listener failed, reconnecting: {e}")
+            # Without notifications the cache could serve stale preferences
+            prefs_cache.clear()
+            time.sleep(5)
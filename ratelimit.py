@@ -0,0 +1,70 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket allowing rate calls per second on average, with bursts of up to burst calls
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns how many seconds the caller must wait before using it.
+        Reservations queue up, so concurrent callers are spaced out rather than all woken at once.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def wait(self):
+        """
+        Blocks until a call is allowed
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class KeyedRateLimiter():
+    """
+    A separate TokenBucket per key (e.g. per Slack team), created on first use.
+    At most max_keys buckets are kept; the least recently used are dropped first.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bucket(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def wait(self, key):
+        """
+        Blocks until a call for key is allowed
+        """
+        self.bucket(key).wait()
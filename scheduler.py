@@ -0,0 +1,212 @@
+import os
+import logging
+from slack_sdk import WebClient
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+import weather
+from pgdatabase import PGDatabase
+from ratelimit import KeyedRateLimiter
+from taskqueue import BoundedExecutor
+from views import walktime_blocks
+from instrumentation import timer
+
+logging.basicConfig(level=logging.ERROR)
+
+# Proactive walk time notifications. Run `python scheduler.py` from a scheduled job (e.g. Heroku Scheduler).
+scheduler_senders = int(os.environ.get("SCHEDULER_SENDERS", 8))
+# chat.postMessage calls per second, and burst size, allowed per Slack team
+scheduler_team_rate = float(os.environ.get("SCHEDULER_TEAM_RATE", 1))
+scheduler_team_burst = int(os.environ.get("SCHEDULER_TEAM_BURST", 5))
+# Users read from Postgres per query. Every location's users are read by the same query, however many there are.
+scheduler_batch_rows = int(os.environ.get("SCHEDULER_BATCH_ROWS", 1000))
+# Users scored together per location; larger groups are split
+scheduler_max_group = int(os.environ.get("SCHEDULER_MAX_GROUP", 5000))
+
+
+def create_client():
+    """
+    Builds the Slack Web API client used to post notifications. Rate limited calls are retried after Retry-After.
+    """
+    client = WebClient(token=os.environ.get("SLACK_BOT_TOKEN"))
+    client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=2))
+    return client
+
+
+def get_app_id(client):
+    """
+    Returns this app's ID, used to link to the Home tab. Set SLACK_APP_ID to skip the API lookups.
+
+    Arguments:
+      client -- Slack Web API client
+    """
+    app_id = os.environ.get("SLACK_APP_ID")
+    if app_id:
+        return app_id
+    bot_id = client.auth_test()["bot_id"]
+    return client.bots_info(bot=bot_id)["bot"]["app_id"]
+
+
+def forecast_key(location, canonical_location):
+    """
+    Returns the normalized location that a user's forecast comes from, as group_by_location computes it
+    """
+    user_prefs = weather.safe_user_prefs_defaults({"location": location, "canonical_location": canonical_location})
+    return weather.normalize_location(weather.forecast_location(user_prefs))
+
+
+def distinct_locations():
+    """
+    Returns {normalized forecast location: {(location, canonical_location): number of users}} for every user
+    """
+    with PGDatabase(readonly=True) as db:
+        db.query("""SELECT location, canonical_location, count(*) FROM userprefs.userprefs
+                    GROUP BY location, canonical_location;""")
+        rows = db.cursor.fetchall()
+    locations = {}
+    for location, canonical_location, users in rows:
+        locations.setdefault(forecast_key(location, canonical_location), {})[(location, canonical_location)] = users
+    return locations
+
+
+def read_users(pairs):
+    """
+    Returns the (user_id, team_id, location, ideal_temp, units, canonical_location) rows of the users whose
+    (location, canonical_location) is a key of pairs, ordered by its value
+
+    Arguments:
+      pairs -- {(location, canonical_location): normalized forecast location}
+    """
+    # Uses userprefs_location_idx (see the README), so a batch doesn't scan the whole table
+    with PGDatabase(readonly=True) as db:
+        db.query("""SELECT user_id, team_id, location, ideal_temp, units, canonical_location FROM userprefs.userprefs
+                    WHERE location = ANY(%s) OR (%s AND location IS NULL);""",
+                 ([location for location, _ in pairs if location is not None],
+                  any(location is None for location, _ in pairs)))
+        rows = db.cursor.fetchall()
+    # A location can also be in other batches with another canonical location
+    rows = [row for row in rows if (row[2], row[5]) in pairs]
+    rows.sort(key=lambda row: pairs[(row[2], row[5])])
+    return rows
+
+
+def stream_user_prefs():
+    """
+    Yields (user_id, team_id, location, ideal_temp, units, canonical_location) for every user, ordered by
+    the normalized location their forecast comes from, so users in the same place arrive together.
+    The distinct locations are read first, then the users of about SCHEDULER_BATCH_ROWS at a time,
+    each batch in a short query of its own, so no transaction stays open while notifications are sent.
+    """
+    locations = distinct_locations()
+    batch = {}
+    users = 0
+    for key in sorted(locations):
+        for pair, count in locations[key].items():
+            batch[pair] = key
+            users += count
+        if users >= scheduler_batch_rows:
+            yield from read_users(batch)
+            batch = {}
+            users = 0
+    if batch:
+        yield from read_users(batch)
+
+
+def group_by_location(rows, max_group=None):
+    """
+    Groups consecutive user preference rows by the normalized location their forecast comes from.
+    Yields the location and a list of (user_id, team_id, user_prefs) for the users there.
+
+    Arguments:
+      rows -- (user_id, team_id, location, ideal_temp, units, canonical_location) rows, ordered by location
+      max_group -- maximum users per group, defaults to SCHEDULER_MAX_GROUP
+    """
+    max_group = max_group or scheduler_max_group
+    group_location = None
+    group = []
+    for user_id, team_id, location, ideal_temp, units, canonical_location in rows:
+        user_prefs = weather.safe_user_prefs_defaults({
+            "location": location,
+            "ideal_temp": ideal_temp,
+            "units": units,
+            "canonical_location": canonical_location
+        })
+        normalized = weather.normalize_location(weather.forecast_location(user_prefs))
+        if group and (normalized != group_location or len(group) >= max_group):
+            yield group_location, group
+            group = []
+        group_location = normalized
+        group.append((user_id, team_id, user_prefs))
+    if group:
+        yield group_location, group
+
+
+def send_walk(client, limiter, api_app_id, user_id, team_id, units, best_walk):
+    """
+    Posts a user's best walk to them, waiting for their team's rate limit
+
+    Arguments:
+      client -- Slack Web API client
+      limiter -- per-team rate limiter
+      api_app_id -- this app's ID, used to link to the Home tab
+      user_id -- Slack user ID to message
+      team_id -- the user's Slack team ID
+      units -- the user's temperature units
+      best_walk -- best walk information as returned by weather.search_best_walks
+    """
+    limiter.wait(team_id)
+    blocks = walktime_blocks(best_walk=best_walk, units=units, team_id=team_id, api_app_id=api_app_id)
+    with timer("slack.api", method="chat.postMessage"):
+        client.chat_postMessage(
+            channel=user_id,
+            text=f"The best time to walk in {best_walk['location']['name']} is {best_walk['best_walk_hour']['time']} (local time)",
+            blocks=blocks
+        )
+
+
+def run(client=None, rows=None, day=0):
+    """
+    Computes every user's best walk and posts it to them.
+    Each location's forecast is fetched once and scored for all of its users at the same time.
+    Returns counts of the users and locations processed and the messages sent.
+
+    Arguments:
+      client -- Slack Web API client, defaults to create_client()
+      rows -- user preference rows, defaults to stream_user_prefs()
+      day -- first forecast day to search, 0 for today and 1 for tomorrow
+    """
+    client = client or create_client()
+    api_app_id = get_app_id(client)
+    limiter = KeyedRateLimiter(scheduler_team_rate, scheduler_team_burst)
+    senders = BoundedExecutor(
+        max_workers=scheduler_senders,
+        max_queue_depth=scheduler_senders * 4,
+        name="scheduler"
+    )
+    stats = {"users": 0, "locations": 0, "skipped": 0}
+    try:
+        for location, group in group_by_location(rows if rows is not None else stream_user_prefs()):
+            stats["locations"] += 1
+            stats["users"] += len(group)
+            try:
+                best_walks = weather.search_best_walks(
+                    weather.get_weather(location),
+                    [user_prefs for _, _, user_prefs in group],
+                    day
+                )
+            except Exception as e:
+                logging.error(f"Unable to find the best walks for {location}: {e}")
+                stats["skipped"] += len(group)
+                continue
+            for (user_id, team_id, user_prefs), best_walk in zip(group, best_walks):
+                # Waits for the senders to catch up, so memory stays bounded however many users there are
+                senders.submit_wait(send_walk, client, limiter, api_app_id, user_id, team_id, user_prefs["units"], best_walk)
+    finally:
+        senders.shutdown(wait=True)
+    sender_stats = senders.stats()
+    stats["sent"] = sender_stats["completed"]
+    stats["failed"] = sender_stats["failed"]
+    return stats
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info(f"Walk time notifications: {run()}")
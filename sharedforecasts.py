@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import zlib
+import fcntl
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+import numpy as np
+from forecast import column_fields
+
+logging.basicConfig(level=logging.ERROR)
+
+# Cross-process forecast cache. Set SHARED_FORECASTS to "true" to share parsed forecasts between the worker
+# processes of a dyno through a memory-mapped file, so a location is fetched once per dyno instead of once per worker.
+shared_forecasts_enabled = os.environ.get("SHARED_FORECASTS", "false").lower() in ("1", "true", "yes")
+# The file lives in shared memory where available. Its name gets a suffix identifying the record layout,
+# so processes running different versions never share a file.
+shared_forecasts_path = os.environ.get(
+    "SHARED_FORECASTS_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "walktime-forecasts")
+)
+# Number of records in the file. Each location has exactly one record it can be stored in,
+# and replaces whichever location was stored there before.
+shared_forecasts_slots = int(os.environ.get("SHARED_FORECASTS_SLOTS", 1024))
+# While one process fetches a location the others wait for its result, for at most this many seconds
+shared_forecasts_fetch_timeout = float(os.environ.get("SHARED_FORECASTS_FETCH_TIMEOUT", 30))
+# How often waiting processes check whether the fetch is done (in seconds)
+shared_forecasts_poll_interval = 0.02
+
+hours_per_day = 24
+# Hour fields stored as numbers; the rest of HourRecord is stored as fixed-width UTF-8 strings.
+# Numbers are all stored as float64 like Forecast's columns, so the columns of a record are plain views of it.
+int_hour_fields = ("time_epoch", "chance_of_rain", "chance_of_snow", "will_it_rain")
+float_hour_fields = ("temp_f", "temp_c", "feelslike_f", "feelslike_c", "wind_mph")
+number_hour_fields = int_hour_fields + float_hour_fields
+string_hour_fields = ("time", "condition_text", "condition_icon")
+hour_dtype = np.dtype(
+    [(field, "<f8") for field in number_hour_fields]
+    + [("time", "S16"), ("condition_text", "S64"), ("condition_icon", "S96")]
+)
+
+
+def record_dtype(max_days):
+    """
+    Returns the layout of one record: a sequence number, the location, when it expires, and its forecast.
+    The location and current conditions dictionaries are small and stored as JSON.
+    "fetching" and "fetching_until" mark a location some process is fetching for the record right now.
+
+    Arguments:
+      max_days -- forecast days a record can hold
+    """
+    return np.dtype([
+        ("seq", "<u8"),
+        ("key", "S128"),
+        ("expires_at", "<f8"),
+        ("days", "<u2"),
+        ("hours", "<u2", (max_days,)),
+        ("dates", "S10", (max_days,)),
+        ("meta", "S1024"),
+        ("hour", hour_dtype, (max_days, hours_per_day)),
+        ("fetching", "S128"),
+        ("fetching_until", "<f8")
+    ])
+
+
+class SharedHour():
+    """
+    One hour of a shared forecast, with the interface of forecast.HourRecord.
+    Fields are read from the record when accessed.
+    """
+    __slots__ = ("_row",)
+
+    def __init__(self, row):
+        self._row = row
+
+    def __getattr__(self, name):
+        if name in int_hour_fields:
+            return int(self._row[name])
+        if name in float_hour_fields:
+            return float(self._row[name])
+        if name in string_hour_fields:
+            return self._row[name].decode()
+        raise AttributeError(name)
+
+    def to_dict(self):
+        """
+        Returns the hour in WeatherAPI's format
+        """
+        hour = {field: getattr(self, field) for field in number_hour_fields}
+        hour["time"] = self.time
+        hour["condition"] = {"text": self.condition_text, "icon": self.condition_icon}
+        return hour
+
+
+class SharedHours():
+    """
+    Read-only sequence of the SharedHours of a day, created as they are accessed
+    """
+    __slots__ = ("_rows",)
+
+    def __init__(self, rows):
+        self._rows = rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        return SharedHour(self._rows[index])
+
+    def __iter__(self):
+        return (SharedHour(row) for row in self._rows)
+
+
+class SharedForecastDay():
+    """
+    One day of a shared forecast, with the interface of forecast.ForecastDay. Its columns are views of the record.
+    """
+    __slots__ = ("date", "hours", "columns")
+
+    def __init__(self, date, rows):
+        self.date = date
+        self.hours = SharedHours(rows)
+        self.columns = {field: rows[field] for field in column_fields}
+
+
+class SharedForecast():
+    """
+    A forecast read from a record, with the interface of forecast.Forecast. It holds a private copy of the record
+    and only views of it, so reading a shared forecast costs one copy of the record and no parsing.
+    """
+    __slots__ = ("_record", "_meta", "days", "nbytes", "expires_at")
+
+    def __init__(self, record):
+        self._record = record
+        self._meta = None
+        # Unix timestamp
+        self.expires_at = float(record["expires_at"])
+        self.days = [
+            SharedForecastDay(record["dates"][day].decode(), record["hour"][day, :record["hours"][day]])
+            for day in range(int(record["days"]))
+        ]
+        self.nbytes = record.nbytes
+
+    @property
+    def location(self):
+        return self._decode_meta()["location"]
+
+    @property
+    def current(self):
+        return self._decode_meta()["current"]
+
+    def _decode_meta(self):
+        if self._meta is None:
+            self._meta = json.loads(bytes(self._record["meta"]))
+        return self._meta
+
+    def to_dict(self):
+        """
+        Returns the forecast in WeatherAPI's format
+        """
+        return {
+            "location": self.location,
+            "current": self.current,
+            "forecast": {
+                "forecastday": [
+                    {"date": day.date, "hour": [hour.to_dict() for hour in day.hours]} for day in self.days
+                ]
+            }
+        }
+
+
+class SharedForecastCache():
+    """
+    Forecasts shared between the processes on one machine through a memory-mapped file of fixed-size records.
+
+    Reads take no locks: a record's sequence number is odd while it is being written, so a reader copies the
+    record and only uses the copy if the sequence number was even and unchanged. Writes to a record are
+    serialized across processes with a byte-range lock on it. On a miss, the first process marks the record
+    as being fetched and fetches without holding the lock, while concurrent misses for the location
+    poll for its result instead of each fetching it.
+    """
+
+    def __init__(self, path, slots, max_days, ttl):
+        self.slots = slots
+        self.max_days = max_days
+        self.ttl = ttl
+        self.dtype = record_dtype(max_days)
+        layout = zlib.crc32(repr((self.dtype.descr, slots)).encode())
+        self.path = f"{path}-{layout:08x}"
+        self.file = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), "r+b")
+        size = slots * self.dtype.itemsize
+        with self._file_lock(0, 0):
+            # Extending the file fills it with zeros, i.e. empty records
+            if os.fstat(self.file.fileno()).st_size < size:
+                os.ftruncate(self.file.fileno(), size)
+        self.records = np.memmap(self.file, dtype=self.dtype, mode="r+", shape=(slots,))
+        self.seqs = self.records["seq"]
+        # fcntl locks are held per process, so threads of one process also need their own locks
+        self._thread_locks = [threading.Lock() for _ in range(64)]
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "unshareable": 0,
+            "torn_reads": 0,
+            "fetch_waits": 0
+        }
+
+    @contextmanager
+    def _file_lock(self, offset, length=1):
+        fcntl.lockf(self.file.fileno(), fcntl.LOCK_EX, length, offset)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.file.fileno(), fcntl.LOCK_UN, length, offset)
+
+    @contextmanager
+    def _write_lock(self, index):
+        with self._thread_locks[index % len(self._thread_locks)], self._file_lock(index * self.dtype.itemsize):
+            yield
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _slot(self, key):
+        key_bytes = key.encode()
+        return zlib.crc32(key_bytes) % self.slots, key_bytes
+
+    def _read(self, index, key_bytes):
+        for _ in range(3):
+            seq = int(self.seqs[index])
+            if seq & 1:
+                # Being written right now
+                self._count("torn_reads")
+                time.sleep(0.001)
+                continue
+            # Indexing the copied array gives a record that views the copy, as do its fields
+            record = self.records[index:index + 1].copy()[0]
+            if int(self.seqs[index]) != seq:
+                self._count("torn_reads")
+                continue
+            if record["key"] != key_bytes or time.time() >= record["expires_at"]:
+                return None
+            return SharedForecast(record)
+        return None
+
+    def _encode(self, key_bytes, weather_info, ttl=None):
+        """
+        Returns the record for a forecast expiring after ttl seconds (at most the cache's TTL),
+        or None if it doesn't fit in one
+        """
+        if len(key_bytes) > 128 or len(weather_info.days) > self.max_days:
+            return None
+        meta = json.dumps({"location": weather_info.location, "current": weather_info.current}).encode()
+        if len(meta) > 1024:
+            return None
+        record = np.zeros((), dtype=self.dtype)
+        record["key"] = key_bytes
+        record["expires_at"] = time.time() + (self.ttl if ttl is None else min(ttl, self.ttl))
+        record["meta"] = meta
+        record["days"] = len(weather_info.days)
+        for day, forecast_day in enumerate(weather_info.days):
+            if len(forecast_day.hours) > hours_per_day or len((forecast_day.date or "").encode()) > 10:
+                return None
+            record["hours"][day] = len(forecast_day.hours)
+            record["dates"][day] = (forecast_day.date or "").encode()
+            for index, hour in enumerate(forecast_day.hours):
+                strings = (hour.time.encode(), hour.condition_text.encode(), hour.condition_icon.encode())
+                # numpy would silently truncate strings that are too long
+                if any(len(value) > hour_dtype[field].itemsize for value, field in zip(strings, hour_dtype.names[-3:])):
+                    return None
+                record["hour"][day, index] = tuple(getattr(hour, field) for field in number_hour_fields) + strings
+        return record
+
+    def _write(self, index, record):
+        seq = int(self.seqs[index])
+        # An odd number left behind by a writer that died is reused
+        writing = seq if seq & 1 else seq + 1
+        if self.records[index]["key"] not in (b"", record["key"]):
+            self._count("evictions")
+        # Keep the mark of a fetch in progress for another location
+        record["fetching"] = self.records["fetching"][index]
+        record["fetching_until"] = self.records["fetching_until"][index]
+        self.seqs[index] = writing
+        record["seq"] = writing
+        self.records[index] = record
+        self.seqs[index] = writing + 1
+        self._count("stores")
+
+    def peek(self, key):
+        """
+        Returns the shared forecast for a location, or None if there is none younger than the TTL. Never blocks.
+
+        Arguments:
+          key -- normalized location
+        """
+        index, key_bytes = self._slot(key)
+        weather_info = self._read(index, key_bytes)
+        self._count("hits" if weather_info is not None else "misses")
+        return weather_info
+
+    def load(self, key, loader):
+        """
+        Returns the shared forecast for a location, its size in bytes and the seconds until it expires.
+        On a miss, loader() is called by one process while the others wait for it
+        (up to SHARED_FORECASTS_FETCH_TIMEOUT), and its result is shared. No lock is held while loader() runs.
+
+        Arguments:
+          key -- normalized location
+          loader -- function with no arguments returning a (Forecast, size in bytes, TTL in seconds or None) tuple
+        """
+        weather_info = self.peek(key)
+        if weather_info is not None:
+            return weather_info, weather_info.nbytes, weather_info.expires_at - time.time()
+        index, key_bytes = self._slot(key)
+        waited = False
+        while True:
+            with self._write_lock(index):
+                # Another process may have stored it meanwhile
+                weather_info = self._read(index, key_bytes)
+                if weather_info is not None:
+                    return weather_info, weather_info.nbytes, weather_info.expires_at - time.time()
+                fetching = (self.records["fetching"][index] == key_bytes
+                            and self.records["fetching_until"][index] > time.time())
+                if not fetching:
+                    # A mark left by a process that died or gave up expires, and this process takes over
+                    self.records["fetching"][index] = key_bytes
+                    self.records["fetching_until"][index] = time.time() + shared_forecasts_fetch_timeout
+                    break
+            if not waited:
+                waited = True
+                self._count("fetch_waits")
+            time.sleep(shared_forecasts_poll_interval)
+        try:
+            weather_info, size, ttl = loader()
+        except BaseException:
+            with self._write_lock(index):
+                self._unmark_fetching(index, key_bytes)
+            raise
+        with self._write_lock(index):
+            self._store(index, key_bytes, weather_info, ttl)
+            self._unmark_fetching(index, key_bytes)
+        return weather_info, size, ttl
+
+    def _unmark_fetching(self, index, key_bytes):
+        if self.records["fetching"][index] == key_bytes:
+            self.records["fetching"][index] = b""
+            self.records["fetching_until"][index] = 0.0
+
+    def store(self, key, weather_info):
+        """
+        Shares a forecast fetched outside of load, e.g. by a background refresh
+
+        Arguments:
+          key -- normalized location
+          weather_info -- Forecast
+        """
+        index, key_bytes = self._slot(key)
+        with self._write_lock(index):
+            self._store(index, key_bytes, weather_info)
+
+    def _store(self, index, key_bytes, weather_info, ttl=None):
+        try:
+            record = self._encode(key_bytes, weather_info, ttl)
+        except (TypeError, ValueError, OverflowError) as e:
+            logging.debug(f"Unable to share forecast for {key_bytes.decode()}: {e}")
+            record = None
+        if record is None:
+            self._count("unshareable")
+            return
+        self._write(index, record)
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
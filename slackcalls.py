@@ -0,0 +1,233 @@
+import os
+import time
+import threading
+import logging
+import contextvars
+from collections import OrderedDict
+from urllib.error import URLError
+from slack_sdk.errors import SlackApiError
+from ratelimit import KeyedRateLimiter
+from taskqueue import QueueFullError
+
+logging.basicConfig(level=logging.ERROR)
+
+# Outgoing Slack API call settings. Calls are queued and sent by background workers,
+# paced per team and per method so that bursts wait instead of being rejected with HTTP 429.
+slack_call_workers = int(os.environ.get("SLACK_CALL_WORKERS", 4))
+slack_call_queue_depth = int(os.environ.get("SLACK_CALL_QUEUE_DEPTH", 1000))
+slack_call_retries = int(os.environ.get("SLACK_CALL_RETRIES", 3))
+slack_call_retry_backoff = float(os.environ.get("SLACK_CALL_RETRY_BACKOFF", 1))
+# Calls per second and burst size allowed per team, by method. views.publish is a Tier 4 method (100+ per minute).
+method_limits = {
+    "views.publish": (float(os.environ.get("SLACK_PUBLISH_RATE", 1.5)), int(os.environ.get("SLACK_PUBLISH_BURST", 20))),
+    "chat.postMessage": (1, 5),
+    # response_url calls aren't rate limited by method, but each URL only accepts a few responses
+    "respond": (10, 20)
+}
+default_limit = (1, 5)
+
+
+class _Call():
+    __slots__ = ("key", "method", "team_id", "fn", "context", "attempts", "not_before", "reserved")
+
+    def __init__(self, key, method, team_id, fn, context):
+        self.key = key
+        self.method = method
+        self.team_id = team_id
+        self.fn = fn
+        # The submitter's context, which fn runs in, e.g. for its trace ID
+        self.context = context
+        self.attempts = 0
+        self.not_before = 0.0
+        self.reserved = False
+
+
+def retry_delay(error, attempts):
+    """
+    Returns how long to wait before retrying a failed call, or None if it shouldn't be retried
+
+    Arguments:
+      error -- the exception raised by the call, or the unsuccessful response
+      attempts -- number of attempts made so far
+    """
+    backoff = slack_call_retry_backoff * (2 ** (attempts - 1))
+    response = error.response if isinstance(error, SlackApiError) else error
+    status_code = getattr(response, "status_code", None)
+    if status_code == 429:
+        retry_after = (getattr(response, "headers", None) or {}).get("Retry-After", "")
+        return max(backoff, float(retry_after)) if str(retry_after).isdigit() else backoff
+    if status_code is not None and status_code >= 500:
+        return backoff
+    if isinstance(error, (URLError, ConnectionError, TimeoutError)):
+        return backoff
+    return None
+
+
+class SlackCallQueue():
+    """
+    Queue of outgoing Slack API calls, sent by background workers.
+
+    Each call waits for its team's bucket for the method (see method_limits). Calls rejected with HTTP 429,
+    5xx responses or connection errors are retried with exponential backoff, honouring Retry-After.
+    Calls submitted with a coalesce_key replace a queued call with the same key, so a user who triggers
+    several Home tab publishes in a burst only gets the latest view. A call is never sent while another call
+    with its key is in flight, so an older view can't land after a newer one.
+    """
+
+    def __init__(self, workers, max_queue_depth, max_retries, name="slack-calls"):
+        self.max_queue_depth = max_queue_depth
+        self.max_retries = max_retries
+        self.workers = workers
+        self.name = name
+        self.limiters = {}
+        self._pending = OrderedDict()
+        # Keys of the calls being sent by a worker
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self._next_id = 0
+        self._stats = {
+            "submitted": 0,
+            "coalesced": 0,
+            "rejected": 0,
+            "sent": 0,
+            "retried": 0,
+            "failed": 0
+        }
+        # Workers start with the first call, so importing this module (e.g. in a gunicorn --preload
+        # parent process) doesn't start threads, and a forked worker starts its own
+        self._workers = None
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._pending.clear()
+        self._in_flight.clear()
+        self._condition = threading.Condition()
+        self._workers = None
+
+    def _start_workers(self):
+        self._workers = [
+            threading.Thread(target=self._work, name=f"{self.name}-{index}", daemon=True) for index in range(self.workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, method, team_id, fn, coalesce_key=None):
+        """
+        Queues fn() to be called by a worker. Raises QueueFullError if the queue is full.
+
+        Arguments:
+          method -- Slack API method name, used for rate limiting, e.g. "views.publish"
+          team_id -- Slack team ID, used for rate limiting
+          fn -- function with no arguments making the call; it may raise SlackApiError or return a response
+          coalesce_key -- calls with the same key replace each other while queued, and wait for each other
+            while in flight, e.g. ("views.publish", user_id)
+        """
+        with self._condition:
+            if self._workers is None:
+                self._start_workers()
+            self._stats["submitted"] += 1
+            if coalesce_key is not None and coalesce_key in self._pending:
+                # Keep the queued call's place and rate limit reservation, but send the newer content
+                self._pending[coalesce_key].fn = fn
+                self._pending[coalesce_key].context = contextvars.copy_context()
+                self._stats["coalesced"] += 1
+                return
+            if len(self._pending) >= self.max_queue_depth:
+                self._stats["rejected"] += 1
+                raise QueueFullError("Slack call queue is full (%i queued)" % self.max_queue_depth)
+            if coalesce_key is None:
+                coalesce_key = self._next_id
+                self._next_id += 1
+            self._pending[coalesce_key] = _Call(coalesce_key, method, team_id, fn, contextvars.copy_context())
+            self._condition.notify()
+
+    def limiter(self, method):
+        limiter = self.limiters.get(method)
+        if limiter is None:
+            rate, burst = method_limits.get(method, default_limit)
+            limiter = self.limiters.setdefault(method, KeyedRateLimiter(rate, burst))
+        return limiter
+
+    def _next_call(self):
+        """
+        Waits for the oldest call that is due and has no call with its key in flight,
+        and moves it from the queue to the calls in flight
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                next_due = None
+                for call in self._pending.values():
+                    if call.key in self._in_flight:
+                        # Waits for _done, which notifies
+                        continue
+                    if call.not_before <= now:
+                        del self._pending[call.key]
+                        self._in_flight.add(call.key)
+                        return call
+                    next_due = call.not_before if next_due is None else min(next_due, call.not_before)
+                self._condition.wait(None if next_due is None else next_due - now)
+
+    def _done(self, call, outcome):
+        with self._condition:
+            self._in_flight.discard(call.key)
+            self._stats[outcome] += 1
+            self._condition.notify_all()
+
+    def _requeue(self, call, delay):
+        with self._condition:
+            self._in_flight.discard(call.key)
+            self._condition.notify_all()
+            if call.key in self._pending:
+                # A newer call with the same key was queued meanwhile, and replaces this one
+                return
+            call.not_before = time.monotonic() + delay
+            self._pending[call.key] = call
+            self._condition.notify()
+
+    def _work(self):
+        while True:
+            call = self._next_call()
+            if not call.reserved:
+                call.reserved = True
+                delay = self.limiter(call.method).bucket(call.team_id).reserve()
+                if delay > 0:
+                    # Other teams' calls go ahead while this one waits for its turn
+                    self._requeue(call, delay)
+                    continue
+            call.attempts += 1
+            try:
+                result = call.context.run(call.fn)
+                status_code = getattr(result, "status_code", 200)
+                error = result if status_code == 429 or status_code >= 500 else None
+            except Exception as e:
+                error = e
+            if error is None:
+                self._done(call, "sent")
+                continue
+            delay = retry_delay(error, call.attempts)
+            if delay is not None and call.attempts <= self.max_retries:
+                # Logged in the submitter's context too, so the failure carries its trace ID
+                call.context.run(logging.warning, f"Slack {call.method} call failed, retrying in {delay:.1f}s: {error}")
+                with self._condition:
+                    self._stats["retried"] += 1
+                self._requeue(call, delay)
+                continue
+            call.context.run(logging.error, f"Slack {call.method} call failed: {error}")
+            self._done(call, "failed")
+
+    def stats(self):
+        """
+        Returns a snapshot of queue counters, including how many calls are queued
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        return stats
+
+
+slack_calls = SlackCallQueue(
+    workers=slack_call_workers,
+    max_queue_depth=slack_call_queue_depth,
+    max_retries=slack_call_retries
+)
@@ -0,0 +1,111 @@
+import os
+import threading
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.ERROR)
+
+# Background work settings. Workers run the slow part of slash commands after they are acknowledged.
+walktime_workers = int(os.environ.get("WALKTIME_WORKERS", 4))
+walktime_queue_depth = int(os.environ.get("WALKTIME_QUEUE_DEPTH", 32))
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a task is submitted to a BoundedExecutor that has no room left
+    """
+    pass
+
+
+class BoundedExecutor():
+    """
+    Thread pool with a bounded backlog.
+
+    At most max_workers tasks run at once and at most max_queue_depth more wait for a worker.
+    Submitting beyond that raises QueueFullError immediately instead of blocking the caller,
+    so request threads never stall behind background work.
+    """
+
+    def __init__(self, max_workers, max_queue_depth, name="worker"):
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue_depth)
+        self._lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0
+        }
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedules fn(*args, **kwargs) on a worker thread and returns its Future.
+        It runs in a copy of the caller's context, so e.g. its log lines keep the caller's trace ID.
+
+        Arguments:
+          fn -- function to run in the background
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise QueueFullError(
+                "Background queue is full (%i running, %i queued)" % (self.max_workers, self.max_queue_depth))
+        return self._start(fn, args, kwargs)
+
+    def submit_wait(self, fn, *args, **kwargs):
+        """
+        Like submit, but waits for room in the backlog instead of raising QueueFullError.
+        For batch producers that should slow down to the pace of the workers.
+
+        Arguments:
+          fn -- function to run in the background
+        """
+        self._slots.acquire()
+        return self._start(fn, args, kwargs)
+
+    def _start(self, fn, args, kwargs):
+        """
+        Hands a task to the thread pool once a backlog slot has been taken
+        """
+        with self._lock:
+            self._stats["submitted"] += 1
+        context = contextvars.copy_context()
+        try:
+            future = self._executor.submit(context.run, fn, *args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._stats["submitted"] -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._task_done(future, context))
+        return future
+
+    def _task_done(self, future, context):
+        self._slots.release()
+        error = future.exception()
+        with self._lock:
+            self._stats["failed" if error is not None else "completed"] += 1
+        if error is not None:
+            context.run(logging.error, f"Background task failed: {error}")
+
+    def stats(self):
+        """
+        Returns a snapshot of executor counters, including how many tasks are running or queued
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = stats["submitted"] - stats["completed"] - stats["failed"]
+        return stats
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+walktime_executor = BoundedExecutor(
+    max_workers=walktime_workers,
+    max_queue_depth=walktime_queue_depth,
+    name="walktime"
+)
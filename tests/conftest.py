@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The modules read their settings at import: keep the tests off Postgres and background threads
+os.environ.setdefault("FORECAST_STORE", "false")
+os.environ.setdefault("PREFS_CACHE_NOTIFY", "false")
+os.environ.setdefault("BEST_WALKS", "false")
+os.environ.setdefault("PREFETCH_DEMAND", "false")
+os.environ.setdefault("SHARED_FORECASTS", "false")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
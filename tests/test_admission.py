@@ -0,0 +1,120 @@
+import asyncio
+import time
+import pytest
+from admission import CircuitBreaker, CircuitOpenError, ConcurrencyLimit, CLOSED, HALF_OPEN, OPEN
+
+
+class Rejected(Exception):
+    pass
+
+
+def failing():
+    raise ConnectionError("down")
+
+
+def breaker(name):
+    return CircuitBreaker(failure_threshold=2, reset_timeout=0.05, name=name,
+                          is_failure=lambda error: not isinstance(error, Rejected))
+
+
+def open_breaker(name):
+    circuit = breaker(name)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            circuit.call(failing)
+    assert circuit.stats()["state"] == OPEN
+    return circuit
+
+
+def test_opens_after_consecutive_failures():
+    circuit = breaker("test_opens")
+    with pytest.raises(ConnectionError):
+        circuit.call(failing)
+    assert circuit.stats()["state"] == CLOSED
+    assert circuit.call(lambda: "ok") == "ok"
+    # A success resets the count
+    with pytest.raises(ConnectionError):
+        circuit.call(failing)
+    assert circuit.stats()["state"] == CLOSED
+    with pytest.raises(ConnectionError):
+        circuit.call(failing)
+    assert circuit.stats()["state"] == OPEN
+    with pytest.raises(CircuitOpenError):
+        circuit.call(lambda: "not called")
+    assert circuit.stats()["short_circuited"] == 1
+
+
+def test_rejected_requests_dont_count():
+    circuit = breaker("test_rejected")
+    for _ in range(3):
+        with pytest.raises(Rejected):
+            circuit.call(lambda: (_ for _ in ()).throw(Rejected()))
+    assert circuit.stats()["state"] == CLOSED
+
+
+def test_successful_trial_closes():
+    circuit = open_breaker("test_trial_closes")
+    time.sleep(0.06)
+    circuit.allow()
+    assert circuit.stats()["state"] == HALF_OPEN
+    # Only one trial at a time
+    with pytest.raises(CircuitOpenError):
+        circuit.allow()
+    circuit.record_success()
+    assert circuit.stats()["state"] == CLOSED
+
+
+def test_failed_trial_reopens():
+    circuit = open_breaker("test_trial_reopens")
+    time.sleep(0.06)
+    with pytest.raises(ConnectionError):
+        circuit.call(failing)
+    assert circuit.stats()["state"] == OPEN
+    with pytest.raises(CircuitOpenError):
+        circuit.call(lambda: "not called")
+
+
+def test_interrupted_trial_lets_another_through():
+    circuit = open_breaker("test_trial_interrupted")
+    time.sleep(0.06)
+    with pytest.raises(KeyboardInterrupt):
+        circuit.call(lambda: (_ for _ in ()).throw(KeyboardInterrupt()))
+    assert circuit.call(lambda: "ok") == "ok"
+    assert circuit.stats()["state"] == CLOSED
+
+
+def test_unreported_trial_times_out():
+    circuit = open_breaker("test_trial_times_out")
+    time.sleep(0.06)
+    circuit.allow()
+    with pytest.raises(CircuitOpenError):
+        circuit.allow()
+    time.sleep(0.06)
+    circuit.allow()
+    assert circuit.stats()["state"] == HALF_OPEN
+
+
+def test_concurrency_limit_deadline():
+    limit = ConcurrencyLimit(1, deadline=0.05, name="test_limit")
+    with limit.admit() as admitted:
+        assert admitted
+        with limit.admit() as second:
+            assert not second
+    with limit.admit(received_at=time.monotonic() - 1) as late:
+        assert not late
+    assert limit.stats() == {"admitted": 1, "expired": 2, "degraded": 0}
+
+
+def test_async_concurrency_limit_deadline():
+    limit = ConcurrencyLimit(1, deadline=0.05, name="test_async_limit")
+
+    async def run():
+        async with limit.admit_async() as admitted:
+            assert admitted
+            async with limit.admit_async() as second:
+                assert not second
+        async with limit.admit_async() as again:
+            assert again
+
+    asyncio.run(run())
+    assert limit.stats() == {"admitted": 2, "expired": 1, "degraded": 0}
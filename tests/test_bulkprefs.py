@@ -0,0 +1,50 @@
+import io
+import bulkprefs
+
+
+class FakeDatabase():
+    """
+    Records the statements of a bulk import and whether its transaction is still open
+    """
+
+    def __init__(self, events):
+        self.events = events
+
+    def __enter__(self):
+        self.events.append("begin")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.events.append("commit")
+
+    def execute_values(self, query, rows, batch_size):
+        self.events.append(("write", [row[0] for row in rows]))
+
+    def query(self, query, args=None):
+        pass
+
+
+def test_invalid_records_are_skipped_and_caches_invalidated_after_commit(monkeypatch):
+    events = []
+    monkeypatch.setattr(bulkprefs, "PGDatabase", lambda: FakeDatabase(events))
+    monkeypatch.setattr(bulkprefs.locations, "try_resolve_location", lambda location: location.lower())
+    monkeypatch.setattr(bulkprefs.prefscache, "invalidate", lambda key: events.append(("invalidate", key)))
+    monkeypatch.setattr(bulkprefs, "mark_written", lambda key: events.append(("mark_written", key)))
+    csv_file = io.StringIO(
+        "user_id,team_id,location,units,ideal_temp\n"
+        "U1,T1,Boston,f,70\n"
+        "U2,T1,Boston,f,warm\n"
+        "U3,T1,Paris,kelvin,20\n"
+        ",T1,Paris,c,20\n"
+        "U1,T1,Paris,c,21\n"
+    )
+    stats = bulkprefs.upsert_user_prefs(bulkprefs.read_csv(csv_file), batch_size=10)
+    assert stats["rows"] == 1
+    assert stats["invalid"] == 3
+    assert events == ["begin", ("write", ["U1_T1"]), "commit", ("mark_written", "U1_T1"), ("invalidate", "U1_T1")]
+
+
+def test_parse_record():
+    assert bulkprefs.parse_record({"user_id": "U1", "team_id": "T1", "location": "Boston", "units": "", "ideal_temp": ""}) == (
+        "U1_T1", "U1", "T1", "Boston", None, None)
+    assert bulkprefs.parse_record({"user_id": "U1", "team_id": "T1", "ideal_temp": 72})[4] == 72
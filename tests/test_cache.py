@@ -0,0 +1,108 @@
+import time
+import threading
+import pytest
+from cache import TTLCache
+
+
+def slow_loader(started, release, value, calls):
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return value, 1
+    return load
+
+
+def test_concurrent_misses_share_one_load():
+    cache = TTLCache(ttl=60, max_entries=10, max_bytes=10)
+    started, release, calls = threading.Event(), threading.Event(), []
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get("k", slow_loader(started, release, "v", calls))))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    # Let the followers reach the flight before the leader finishes
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["v"] * 8
+    assert len(calls) == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["coalesced"] == 7
+    assert cache.peek("k") == "v"
+
+
+def test_load_error_reaches_waiters_and_isnt_cached():
+    cache = TTLCache(ttl=60, max_entries=10, max_bytes=10)
+
+    def fail():
+        raise ValueError("unavailable")
+
+    with pytest.raises(ValueError):
+        cache.get("k", fail)
+    assert cache.peek("k") is None
+    assert cache.get("k", lambda: ("v", 1)) == "v"
+
+
+@pytest.mark.parametrize("write", [
+    lambda cache: cache.put("k", "new", 1),
+    lambda cache: cache.invalidate("k"),
+    lambda cache: cache.clear()
+])
+def test_write_during_load_wins(write):
+    cache = TTLCache(ttl=60, max_entries=10, max_bytes=10)
+    started, release, calls = threading.Event(), threading.Event(), []
+    results = []
+    reader = threading.Thread(target=lambda: results.append(cache.get("k", slow_loader(started, release, "old", calls))))
+    reader.start()
+    started.wait(5)
+    write(cache)
+    expected = cache.peek("k")
+    release.set()
+    reader.join()
+    # The reader gets what it read, but doesn't replace what was written meanwhile
+    assert results == ["old"]
+    assert cache.peek("k") == expected
+
+
+def test_external_load_skipped_after_invalidate():
+    cache = TTLCache(ttl=60, max_entries=10, max_bytes=10)
+    flight = cache.begin_load("k")
+    cache.invalidate("k")
+    cache.end_load("k", flight, ("old", 1))
+    assert cache.peek("k") is None
+
+    flight = cache.begin_load("k")
+    cache.end_load("k", flight, ("new", 1))
+    assert cache.peek("k") == "new"
+
+
+def test_entries_expire():
+    cache = TTLCache(ttl=0.05, max_entries=10, max_bytes=10)
+    cache.put("k", "v", 1)
+    assert cache.peek("k") == "v"
+    time.sleep(0.06)
+    assert cache.peek("k") is None
+
+
+def test_loader_ttl_shortens_expiry():
+    cache = TTLCache(ttl=60, max_entries=10, max_bytes=10)
+    assert cache.get("short", lambda: ("v", 1, 0.05)) == "v"
+    assert cache.get("none", lambda: ("v", 1, 0)) == "v"
+    assert cache.peek("none") is None
+    time.sleep(0.06)
+    assert cache.peek("short") is None
+
+
+def test_bounded_by_entries_and_bytes():
+    cache = TTLCache(ttl=60, max_entries=2, max_bytes=10)
+    for key in ("a", "b", "c"):
+        cache.put(key, key, 1)
+    assert cache.peek("a") is None
+    assert cache.peek("c") == "c"
+    cache.put("big", "big", 9)
+    assert cache.stats()["bytes"] <= 10
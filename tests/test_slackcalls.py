@@ -0,0 +1,76 @@
+import time
+import threading
+import slackcalls
+from slackcalls import SlackCallQueue
+
+
+class Response():
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_calls_with_the_same_key_are_coalesced_and_serialized():
+    queue = SlackCallQueue(workers=4, max_queue_depth=10, max_retries=0, name="test-coalesce")
+    release = threading.Event()
+    sent = []
+
+    def publish(version, wait=False):
+        def call():
+            sent.append(("start", version))
+            if wait:
+                release.wait(5)
+            sent.append(("end", version))
+        return call
+
+    queue.submit("views.publish", "T1", publish(1, wait=True), coalesce_key=("views.publish", "U1"))
+    wait_for(lambda: sent)
+    # While version 1 is in flight, later versions wait and replace each other
+    for version in (2, 3, 4):
+        queue.submit("views.publish", "T1", publish(version), coalesce_key=("views.publish", "U1"))
+    time.sleep(0.05)
+    assert sent == [("start", 1)]
+    release.set()
+    wait_for(lambda: queue.stats()["sent"] == 2)
+    assert sent == [("start", 1), ("end", 1), ("start", 4), ("end", 4)]
+    assert queue.stats()["coalesced"] == 2
+
+
+def test_calls_without_a_key_all_run():
+    queue = SlackCallQueue(workers=2, max_queue_depth=10, max_retries=0, name="test-nokey")
+    sent = []
+    for index in range(5):
+        queue.submit("chat.postMessage", "T1", lambda index=index: sent.append(index))
+    wait_for(lambda: queue.stats()["sent"] == 5)
+    assert sorted(sent) == list(range(5))
+
+
+def test_server_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(slackcalls, "slack_call_retry_backoff", 0.01)
+    queue = SlackCallQueue(workers=1, max_queue_depth=10, max_retries=3, name="test-retry")
+    responses = [Response(503), Response(500), Response(200)]
+    queue.submit("respond", "T1", lambda: responses.pop(0))
+    wait_for(lambda: queue.stats()["sent"] == 1)
+    assert queue.stats()["retried"] == 2
+
+
+def test_full_queue_rejects():
+    queue = SlackCallQueue(workers=1, max_queue_depth=1, max_retries=0, name="test-full")
+    release = threading.Event()
+    queue.submit("respond", "T1", lambda: release.wait(5))
+    wait_for(lambda: queue.stats()["pending"] == 0)
+    queue.submit("respond", "T1", lambda: None)
+    try:
+        queue.submit("respond", "T1", lambda: None)
+        assert False, "expected QueueFullError"
+    except slackcalls.QueueFullError:
+        pass
+    finally:
+        release.set()
@@ -0,0 +1,26 @@
+import json
+import pytest
+from views import home_tab_content, home_tab_json, empty_user_prefs
+
+
+@pytest.mark.parametrize("user_prefs", [
+    {"location": "90210", "ideal_temp": 72, "units": "f"},
+    {"location": 'Saint-Étienne "centre" \\ 5e', "ideal_temp": 21, "units": "c"},
+    empty_user_prefs
+])
+@pytest.mark.parametrize("update_status", [None, "successful_update", "error_update", "error_update_ideal_temp", "degraded"])
+def test_home_tab_json_matches_home_tab_content(user_prefs, update_status):
+    view_json, view_hash = home_tab_json(user_prefs, update_status)
+    view = json.loads(view_json)
+    expected = home_tab_content(user_prefs, update_status)
+    assert view.pop("private_metadata") == view_hash
+    expected.pop("private_metadata", None)
+    assert view == expected
+
+
+def test_home_tab_hash_changes_with_content():
+    _, view_hash = home_tab_json({"location": "90210", "ideal_temp": 72, "units": "f"}, None)
+    _, same_hash = home_tab_json({"location": "90210", "ideal_temp": 72, "units": "f"}, None)
+    _, other_hash = home_tab_json({"location": "90210", "ideal_temp": 73, "units": "f"}, None)
+    assert view_hash == same_hash
+    assert view_hash != other_hash
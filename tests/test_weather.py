@@ -0,0 +1,51 @@
+import io
+import json
+import numpy as np
+import pytest
+import weather
+from benchmark import synthetic_forecast
+from forecast import Forecast, column_fields
+
+
+@pytest.fixture(scope="module")
+def response():
+    return synthetic_forecast()
+
+
+@pytest.mark.parametrize("units", ["f", "c"])
+@pytest.mark.parametrize("ideal_temp", [-10, 20, 55, 72, 95])
+def test_vectorized_scores_match_scalar(response, units, ideal_temp):
+    for day in response["forecast"]["forecastday"]:
+        hours = day["hour"]
+        expected = [weather.get_weather_score(hour, {"units": units, "ideal_temp": ideal_temp}) for hour in hours]
+        scores = weather.get_weather_scores(weather.hours_to_columns(hours), ideal_temp, units)
+        np.testing.assert_allclose(scores, expected)
+
+
+def test_vectorized_scores_for_many_users(response):
+    hours = response["forecast"]["forecastday"][0]["hour"]
+    ideal_temps = [50, 72, 20]
+    units = ["f", "f", "c"]
+    scores = weather.get_weather_scores(weather.hours_to_columns(hours), np.array(ideal_temps), np.array(units))
+    assert scores.shape == (3, len(hours))
+    for row, ideal_temp, unit in zip(scores, ideal_temps, units):
+        np.testing.assert_allclose(row, [weather.get_weather_score(hour, {"units": unit, "ideal_temp": ideal_temp}) for hour in hours])
+
+
+def test_from_stream_matches_from_response(response):
+    parsed = Forecast.from_response(response)
+    streamed = Forecast.from_stream(io.BytesIO(json.dumps(response).encode()))
+    assert streamed.to_dict() == parsed.to_dict()
+    for streamed_day, parsed_day in zip(streamed.days, parsed.days):
+        for field in column_fields:
+            np.testing.assert_array_equal(streamed_day.columns[field], parsed_day.columns[field])
+
+
+def test_from_stream_rejects_responses_without_location():
+    with pytest.raises(Exception):
+        Forecast.from_stream(io.BytesIO(b'{"error": {"code": 1006, "message": "No matching location found."}}'))
+
+
+def test_normalize_location():
+    assert weather.normalize_location("  New   York ,  NY ") == "new york,ny"
+    assert weather.normalize_location("40.71280, -74.00601") == "40.71,-74.01"
@@ -0,0 +1,411 @@
+import os
+import re
+import json
+import hashlib
+import functools
+from instrumentation import timed
+
+# Number of distinct rendered Home tab views kept in memory
+home_tab_cache_size = int(os.environ.get("HOME_TAB_CACHE_SIZE", 4096))
+
+
+def home_tab_content(user_prefs, update_status):
+    """
+    Returns the home tab view content based on user preferences and whether the last action was successful
+
+    Arguments:
+      user_prefs -- user preferences (dictionary)
+      update_status -- update status used to relay success/failure
+    """
+
+    view = {
+        "type": "home",
+        "callback_id": "home_view",
+
+        # body of the view
+        "blocks": [
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "*Weather App Settings*"
+                }
+            },
+            {
+                "type": "divider"
+            },
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "Enter your location to set your default weather location!"
+                }
+            },
+            {
+                "type": "input",
+                "element": {
+                    "type": "plain_text_input",
+                    "action_id": "location_submit",
+                    "initial_value": user_prefs["location"] or '',
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "examples: 90210 | Beverly Hills, CA | 34.0736,118.4004"
+                    }
+                },
+                "label": {
+                    "type": "plain_text",
+                    "text": "Location",
+                    "emoji": False
+                },
+                "block_id": "location_block"
+            },
+            {
+                "type": "input",
+                "element": {
+                    "type": "plain_text_input",
+                    "action_id": "ideal_temperature_submit",
+                    "initial_value": str(user_prefs["ideal_temp"]) if user_prefs["ideal_temp"] else '',
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "00"
+                    }
+                },
+                "label": {
+                    "type": "plain_text",
+                    "text": "Your ideal walking temperature",
+                    "emoji": False
+                },
+                "block_id": "ideal_temp_block"
+            },
+            {
+                "type": "input",
+                "element": {
+                    "type": "static_select",
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "Temperature Units",
+                        "emoji": True
+                    },
+                    "options": [
+                        {
+                            "text": {
+                                "type": "plain_text",
+                                "text": "Fahrenheit (°F)",
+                                "emoji": True
+                            },
+                            "value": "f"
+                        },
+                        {
+                            "text": {
+                                "type": "plain_text",
+                                "text": "Celsius (°C)",
+                                "emoji": True
+                            },
+                            "value": "c"
+                        }
+                    ],
+                    "action_id": "units_submit",
+                    "initial_option": {
+                        "value": user_prefs["units"] if user_prefs["units"] else "f",
+                        "text": {
+                            "type": "plain_text",
+                            "text": "Celsius (°C)" if user_prefs["units"] == "c" else "Fahrenheit (°F)",
+                            "emoji": True
+                        }
+                    }
+                },
+                "label": {
+                    "type": "plain_text",
+                    "text": "Temperature Units",
+                    "emoji": True
+                },
+                "block_id": "units_block"
+            },
+            {
+                "type": "actions",
+                "elements": [
+                    {
+                        "type": "button",
+                        "text": {
+                            "type": "plain_text",
+                            "text": "Save Preferences",
+                            "emoji": True
+                        },
+                        "value": "save_preferences",
+                        "action_id": "save_preferences",
+                        "style": "primary"
+                    }
+                ],
+                "block_id": "save_preferences"
+            }
+        ]
+    }
+
+    if update_status == "successful_update":
+        view["blocks"].append({
+            "type": "section",
+            "text": {
+                "type": "plain_text",
+                "text": ":white_check_mark: Preferences updated successfully!",
+                "emoji": True
+            }
+        })
+    if update_status == "error_update":
+        view["blocks"].append({
+            "type": "section",
+            "text": {
+                "type": "plain_text",
+                "text": ":exclamation: Error updating preferences! Reload the Home tab and try again.",
+                "emoji": True
+            }
+        })
+    if update_status == "error_update_ideal_temp":
+        view["blocks"].append({
+            "type": "section",
+            "text": {
+                "type": "plain_text",
+                "text": ":exclamation: Error updating preferences! Ideal Temperature must be an integer (e.g., 72, NOT 72.5 or 72F)",
+                "emoji": True
+            }
+        })
+    if update_status == "degraded":
+        view["blocks"].append({
+            "type": "section",
+            "text": {
+                "type": "plain_text",
+                "text": ":hourglass: Walk Time is busy right now, so your saved preferences aren't shown. Reopen the Home tab in a minute.",
+                "emoji": True
+            }
+        })
+
+    return view
+
+
+# User-specific values spliced into the pre-serialized Home tab
+home_tab_fields = ("location", "ideal_temp", "units_option", "status", "private_metadata")
+empty_user_prefs = {"location": "", "ideal_temp": None, "units": ""}
+
+
+def build_home_tab_template():
+    """
+    Serializes the Home tab view once, with placeholders for the user-specific values, and splits it
+    into static chunks. Rendering a view is then a string join rather than building and serializing the dict.
+    Returns the chunks, the field that goes after each chunk, and a digest of the template.
+    """
+    view = home_tab_content(user_prefs=empty_user_prefs, update_status=None)
+    tokens = {name: f"@@{name}@@" for name in home_tab_fields}
+    blocks = {block.get("block_id"): block for block in view["blocks"]}
+    blocks["location_block"]["element"]["initial_value"] = tokens["location"]
+    blocks["ideal_temp_block"]["element"]["initial_value"] = tokens["ideal_temp"]
+    blocks["units_block"]["element"]["initial_option"] = tokens["units_option"]
+    view["blocks"].append(tokens["status"])
+    view["private_metadata"] = tokens["private_metadata"]
+    serialized = json.dumps(view)
+
+    markers = {json.dumps(token): name for name, token in tokens.items()}
+    # The status block is optional, so its placeholder takes the comma before it along
+    del markers[json.dumps(tokens["status"])]
+    markers[", " + json.dumps(tokens["status"])] = "status"
+    chunks = []
+    fields = []
+    position = 0
+    for match in re.finditer("|".join(re.escape(marker) for marker in markers), serialized):
+        chunks.append(serialized[position:match.start()])
+        fields.append(markers[match.group(0)])
+        position = match.end()
+    chunks.append(serialized[position:])
+    return chunks, fields, hashlib.sha1(serialized.encode()).hexdigest()
+
+
+home_tab_chunks, home_tab_chunk_fields, home_tab_digest = build_home_tab_template()
+home_tab_base_blocks = len(home_tab_content(user_prefs=empty_user_prefs, update_status=None)["blocks"])
+
+
+@functools.lru_cache(maxsize=None)
+def home_tab_units_option_json(units):
+    view = home_tab_content(user_prefs={**empty_user_prefs, "units": units}, update_status=None)
+    for block in view["blocks"]:
+        if block.get("block_id") == "units_block":
+            return json.dumps(block["element"]["initial_option"])
+
+
+@functools.lru_cache(maxsize=None)
+def home_tab_status_json(update_status):
+    view = home_tab_content(user_prefs=empty_user_prefs, update_status=update_status)
+    return "".join(", " + json.dumps(block) for block in view["blocks"][home_tab_base_blocks:])
+
+
+@functools.lru_cache(maxsize=home_tab_cache_size)
+def render_home_tab_json(location, ideal_temp, units, update_status):
+    """
+    Memoized renderer behind home_tab_json
+    """
+    values = {
+        "location": json.dumps(location or ''),
+        "ideal_temp": json.dumps(str(ideal_temp) if ideal_temp else ''),
+        "units_option": home_tab_units_option_json(units),
+        "status": home_tab_status_json(update_status)
+    }
+    view_hash = hashlib.sha1("\x1f".join(
+        [home_tab_digest] + [values[name] for name in home_tab_fields[:-1]]).encode()).hexdigest()
+    values["private_metadata"] = json.dumps(view_hash)
+    parts = []
+    for chunk, field in zip(home_tab_chunks, home_tab_chunk_fields):
+        parts.append(chunk)
+        parts.append(values[field])
+    parts.append(home_tab_chunks[-1])
+    return "".join(parts), view_hash
+
+
+@timed("view.build", view="home_tab")
+def home_tab_json(user_prefs, update_status):
+    """
+    Returns the serialized Home tab view, identical to home_tab_content apart from its private_metadata,
+    along with a hash of its content. The hash is also stored as the view's private_metadata, so the
+    view a user is looking at tells us whether publishing again would change anything.
+
+    Arguments:
+      user_prefs -- user preferences (dictionary)
+      update_status -- update status used to relay success/failure
+    """
+    return render_home_tab_json(user_prefs["location"], user_prefs["ideal_temp"], user_prefs["units"], update_status)
+
+
+@timed("view.build", view="walktime")
+def walktime_blocks(best_walk, units, team_id, api_app_id, stale=False):
+    """
+    Returns the /walktime response blocks for a best walk
+
+    Arguments:
+      best_walk -- best walk information as returned by weather.get_best_walk
+      units -- the user's temperature units
+      team_id -- Slack team ID, used to link to the Home tab
+      api_app_id -- Slack app ID, used to link to the Home tab
+      stale -- whether the best walk is the last known one (see bestwalks.last_known), which adds a note saying so
+    """
+
+    # Shorthand for disgusting ternary operator usage that we'll use later
+    c = units == "c"
+
+    # Walks on a later day than today also show the date (Slack renders it as e.g. "tomorrow")
+    date_format = "{date_short_pretty} at {time}" if best_walk.get("day") else "{time}"
+
+    response_intro_markdown = f"""
+  The best time to walk in *{best_walk['location']['name']}* is *<!date^{best_walk['best_walk_hour']['time_epoch']}^{date_format}|{best_walk['best_walk_hour']['time']} (local time)>*:
+  \n\n
+  """
+
+    # The output below changes based on whether the user's units are set to C or F. /walktime arbitrarily defaults to Fahrenheit
+    response_weather_markdown = f"""
+*{best_walk['best_walk_hour']['condition']['text']}*
+*{best_walk['best_walk_hour']['temp_c'] if c else best_walk['best_walk_hour']['temp_f']}{'°C' if c else '°F'}*
+Feels like {best_walk['best_walk_hour']['feelslike_c'] if c else best_walk['best_walk_hour']['feelslike_f']}{'°C' if c else '°F'}, 
+Chance of Rain: {best_walk['best_walk_hour']['chance_of_rain']}%
+  """
+
+    response_footnotes = f"""
+Note: Walking time is shown in your current Slack timezone. This time will be offset by a time zone difference if your configured location is in a different time zone.
+\n\n
+Set your location and other preferences in the <slack://app?team={team_id}&id={api_app_id}&tab=home|Home tab of this App>.
+  """
+
+    blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": response_intro_markdown
+            }
+        },
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": response_weather_markdown
+            },
+            "accessory": {
+                "type": "image",
+                "image_url": f"https:{best_walk['best_walk_hour']['condition']['icon']}",
+                "alt_text": "Current condition icon"
+            }
+        },
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": response_footnotes
+            }
+        }
+    ]
+
+    # Runner-up hours, best first
+    other_hours = best_walk.get("top_walk_hours", [])[1:]
+    if other_hours:
+        other_times = ", ".join(
+            f"<!date^{hour['time_epoch']}^{date_format}|{hour['time']}>" for hour in other_hours)
+        blocks.insert(2, {
+            "type": "context",
+            "elements": [
+                {
+                    "type": "mrkdwn",
+                    "text": f"Other good times: {other_times}"
+                }
+            ]
+        })
+
+    if stale:
+        blocks.insert(0, {
+            "type": "context",
+            "elements": [
+                {
+                    "type": "mrkdwn",
+                    "text": ":hourglass: Weather forecasts are slow to load right now, so this is based on an earlier forecast."
+                }
+            ]
+        })
+
+    return blocks
+
+
+def read_walktime_day(text):
+    """
+    Reads which day the user asked for in the /walktime command text.
+    Returns 0 for today (the default) and 1 for tomorrow.
+
+    Arguments:
+      text -- the text the user typed after /walktime
+    """
+    if (text or "").strip().lower() == "tomorrow":
+        return 1
+    return 0
+
+
+def read_home_tab_form(view_state):
+    """
+    Reads the preferences the user entered in the Home tab.
+    Returns the preferences and the update status to show the user.
+
+    Arguments:
+      view_state -- the "state" of the submitted Home tab view
+    """
+    values = view_state["values"]
+    location = values["location_block"]["location_submit"]["value"]
+    # Check if the user selected anything
+    if values["units_block"]["units_submit"]["selected_option"]:
+        units = values["units_block"]["units_submit"]["selected_option"]["value"]
+    else:
+        units = None
+    ideal_temp = values["ideal_temp_block"]["ideal_temperature_submit"]["value"]
+    update_status = "successful_update"
+
+    # If the ideal temperature isn't an integer, we throw it out and let the user know
+    # TODO: Accept floating point numbers
+    if not ideal_temp or not ideal_temp.isdigit():
+        ideal_temp = None
+        update_status = "error_update_ideal_temp"
+
+    return {
+        "location": location,
+        "units": units,
+        "ideal_temp": ideal_temp
+    }, update_status
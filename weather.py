@@ -1,11 +1,45 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import MaxRetryError, ResponseError
 import os
+import re
+import time
+import heapq
 import logging
+import numpy as np
+from cache import TTLCache
+from forecast import Forecast
+import forecaststore
+import sharedforecasts
+from instrumentation import timed
+from admission import CircuitBreaker
 
 logging.basicConfig(level=logging.ERROR)
 
 weather_api_key = os.environ.get("WEATHERAPI_KEY")
 weatherurl = "https://api.weatherapi.com/v1/forecast.json"
+# Forecast cache settings. WeatherAPI only refreshes its hourly forecasts a few times an hour.
+forecast_cache_ttl = float(os.environ.get("FORECAST_CACHE_TTL", 900))
+forecast_cache_max_entries = int(os.environ.get("FORECAST_CACHE_MAX_ENTRIES", 1000))
+forecast_cache_max_bytes = int(os.environ.get("FORECAST_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# HTTP client settings for WeatherAPI requests (timeouts in seconds)
+weather_connect_timeout = float(os.environ.get("WEATHERAPI_CONNECT_TIMEOUT", 3.05))
+weather_read_timeout = float(os.environ.get("WEATHERAPI_READ_TIMEOUT", 5))
+weather_retries = int(os.environ.get("WEATHERAPI_RETRIES", 2))
+weather_retry_backoff = float(os.environ.get("WEATHERAPI_RETRY_BACKOFF", 0.3))
+weather_pool_size = int(os.environ.get("WEATHERAPI_POOL_SIZE", 10))
+# Retries wait at most this long (in seconds). When WeatherAPI asks to wait longer with Retry-After,
+# the fetch fails right away instead, and counts against the circuit breaker.
+weather_max_retry_after = float(os.environ.get("WEATHERAPI_MAX_RETRY_AFTER", 2))
+# Circuit breaker settings: after this many failed fetches in a row, WeatherAPI isn't called for
+# WEATHERAPI_BREAKER_RESET seconds, and requests get a degraded response instead of waiting on timeouts
+weather_breaker_failures = int(os.environ.get("WEATHERAPI_BREAKER_FAILURES", 5))
+weather_breaker_reset = float(os.environ.get("WEATHERAPI_BREAKER_RESET", 30))
+# Number of forecast days fetched (and cached) per location, including today
+forecast_days = int(os.environ.get("FORECAST_DAYS", 3))
+# Number of best walk hours returned, best first
+walk_top_k = int(os.environ.get("WALKTIME_TOP_K", 3))
 default_userprefs = {
     "ideal_temp": 72,
     "units": "f",
@@ -13,47 +47,225 @@ default_userprefs = {
 }
 
 
-def get_weather(location):
+forecast_cache = TTLCache(
+    ttl=forecast_cache_ttl,
+    max_entries=forecast_cache_max_entries,
+    max_bytes=forecast_cache_max_bytes
+)
+
+# Shared by the worker processes of a dyno, between each worker's forecast cache and the forecast store
+shared_forecasts = sharedforecasts.SharedForecastCache(
+    path=sharedforecasts.shared_forecasts_path,
+    slots=sharedforecasts.shared_forecasts_slots,
+    max_days=forecast_days,
+    ttl=forecast_cache_ttl
+) if sharedforecasts.shared_forecasts_enabled else None
+
+
+class WeatherAPIError(Exception):
+    """
+    Raised when WeatherAPI answers with an error status, e.g. 400 for an unknown location
+    """
+
+    def __init__(self, status_code, text):
+        super().__init__("Undesired response code: %i \n %s" % (status_code, text))
+        self.status_code = status_code
+
+
+# Unknown locations are the user's problem, not a sign that WeatherAPI is down
+weather_breaker = CircuitBreaker(
+    failure_threshold=weather_breaker_failures,
+    reset_timeout=weather_breaker_reset,
+    name="weatherapi",
+    is_failure=lambda error: not isinstance(error, WeatherAPIError) or error.status_code == 429 or error.status_code >= 500
+)
+
+coordinates_pattern = re.compile(r"^(-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?)$")
+
+
+def normalize_location(location):
     """
-    Retrieves hourly weather conditions from WeatherAPI.com
+    Normalizes a free-form location so equivalent inputs share a cache key.
+    Case and whitespace are ignored and coordinates are rounded to two decimal places (about 1 km).
 
     Arguments:
       location -- A string representing your location. Weather API can handle a lot of things like city name, postal code, or coordinates
     """
-    response = requests.get(
+    normalized = " ".join(location.lower().split())
+    normalized = re.sub(r"\s*,\s*", ",", normalized)
+    match = coordinates_pattern.match(normalized)
+    if match:
+        normalized = "%.2f,%.2f" % (float(match.group(1)), float(match.group(2)))
+    return normalized
+
+
+class CappedRetry(Retry):
+    """
+    Retry that gives up instead of sleeping when Retry-After asks for more than WEATHERAPI_MAX_RETRY_AFTER seconds
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry_after = self.get_retry_after(response) if response is not None else None
+        if retry_after is not None and retry_after > weather_max_retry_after:
+            raise MaxRetryError(_pool, url, ResponseError(f"Retry-After of {retry_after:.0f}s"))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def create_session():
+    """
+    Builds the keep-alive HTTP session used for every WeatherAPI request.
+    Failed requests are retried with exponential backoff on connection errors, 429 and 5xx responses,
+    waiting at most WEATHERAPI_MAX_RETRY_AFTER seconds between attempts.
+    """
+    retry = CappedRetry(
+        total=weather_retries,
+        backoff_factor=weather_retry_backoff,
+        backoff_max=weather_max_retry_after,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=weather_pool_size,
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.headers.update({
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive"
+    })
+    return session
+
+
+session = create_session()
+
+
+def _reset_session_after_fork():
+    # Keep-alive connections opened by the parent process must not be shared with it
+    global session
+    session = create_session()
+
+
+os.register_at_fork(after_in_child=_reset_session_after_fork)
+
+
+@timed("weather.fetch")
+def fetch_weather(location):
+    """
+    Retrieves hourly weather conditions from WeatherAPI.com, bypassing the forecast cache.
+    Returns the response parsed into a Forecast and the Forecast's size in bytes.
+    The body is parsed as it downloads (see Forecast.from_stream), so the full response is never held in memory.
+
+    Arguments:
+      location -- A string representing your location. Weather API can handle a lot of things like city name, postal code, or coordinates
+    """
+    with session.get(
         url=weatherurl,
         params={
             'key': weather_api_key,
             'q': location,
+            'days': forecast_days,
             'alerts': "no"
-        }
-    )
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise Exception("Undesired response code: %i \n %s" %
-                        (response.status_code, response.text))
+        },
+        timeout=(weather_connect_timeout, weather_read_timeout),
+        stream=True
+    ) as response:
+        if response.status_code == 200:
+            # Let urllib3 undo the gzip encoding while ijson reads
+            response.raw.decode_content = True
+            weather_info = Forecast.from_stream(response.raw)
+            return weather_info, weather_info.nbytes
+        else:
+            raise WeatherAPIError(response.status_code, response.text)
+
+
+def guarded_fetch_weather(location):
+    """
+    fetch_weather behind the WeatherAPI circuit breaker: raises CircuitOpenError without calling WeatherAPI
+    while it is failing
+
+    Arguments:
+      location -- A string representing your location. Weather API can handle a lot of things like city name, postal code, or coordinates
+    """
+    return weather_breaker.call(fetch_weather, location)
+
+
+def get_weather(location):
+    """
+    Retrieves hourly weather conditions from WeatherAPI.com, served from the forecast cache, the forecasts
+    shared by the other workers (see sharedforecasts.py) or the Postgres forecast store (see forecaststore.py) when possible.
+    Returns a Forecast (see forecast.py), which is shared between callers and must not be modified.
+
+    Arguments:
+      location -- A string representing your location. Weather API can handle a lot of things like city name, postal code, or coordinates
+    """
+    key = normalize_location(location)
+    return forecast_cache.get(key, lambda: load_forecast(key))
+
+
+def load_forecast(key):
+    """
+    Loads a forecast missing from this worker's forecast cache. Returns the forecast, its size in bytes,
+    and how long it may be cached, or None for the cache's TTL.
+
+    Arguments:
+      key -- normalized location
+    """
+    def load():
+        return forecaststore.load(key, guarded_fetch_weather, on_refresh=share_forecast)
+    if shared_forecasts is None:
+        return load()
+    return shared_forecasts.load(key, load)
+
+
+def share_forecast(location, weather_info, size):
+    """
+    Stores a freshly fetched forecast, e.g. by a background refresh, in this worker's cache and for the other workers,
+    replacing the stale forecast they were served meanwhile
+    """
+    forecast_cache.put(location, weather_info, size)
+    if shared_forecasts is not None:
+        shared_forecasts.store(location, weather_info)
 
 
-def get_hourly_conditions(location):
+def get_hourly_conditions(location, day=0):
     """
     Uses the get_weather function to retrieve the weather conditions but parse out the hourly forecast and only return the relevant data for the rest of the day
 
     Arguments:
       location -- A string representing your location. Weather API can handle a lot of things like city name, postal code, or coordinates
+      day -- forecast day, 0 for today and 1 for tomorrow, up to FORECAST_DAYS - 1
     """
-    weather_info = get_weather(location)
-    hours = weather_info["forecast"]["forecastday"][0]["hour"]
-    remaining_hours = []
-    for hour in hours:
-        if hour["time_epoch"] >= weather_info["location"]["localtime_epoch"]:
-            remaining_hours.append(hour)
-    logging.debug(f"Total forecast hours: %i", (len(hours)))
+    return parse_hourly_conditions(get_weather(location), day)
+
+
+def parse_hourly_conditions(weather_info, day=0):
+    """
+    Selects the hours left in a day out of a forecast.
+    The hours are shared HourRecords and "columns" holds their fields as arrays, ready for get_weather_scores.
+
+    Arguments:
+      weather_info -- Forecast as returned by get_weather
+      day -- forecast day, 0 for today and 1 for tomorrow, up to FORECAST_DAYS - 1
+    """
+    if day >= len(weather_info.days):
+        return {"hour": [], "columns": {}, "location": weather_info.location, "current": weather_info.current}
+    forecast_day = weather_info.days[day]
+    # The forecast may have come from the cache, so don't trust its localtime to be current
+    now = max(weather_info.location.get("localtime_epoch", 0), int(time.time()))
+    remaining = np.flatnonzero(forecast_day.columns["time_epoch"] >= now)
+    remaining_hours = [forecast_day.hours[index] for index in remaining.tolist()]
+    logging.debug(f"Total forecast hours: %i", (len(forecast_day.hours)))
     logging.debug(f"Remaining hours: %i", (len(remaining_hours)))
     return {
         "hour": remaining_hours,
-        "location": weather_info["location"],
-        "current": weather_info["current"]
+        "columns": {field: column[remaining] for field, column in forecast_day.columns.items()},
+        "location": weather_info.location,
+        "current": weather_info.current
     }
 
 
@@ -122,6 +334,70 @@ def get_weather_score(hour, userprefs=default_userprefs):
     return score
 
 
+# Hour fields read by the scoring functions
+score_fields = ("chance_of_rain", "chance_of_snow", "feelslike_f", "feelslike_c", "wind_mph")
+
+
+def hours_to_columns(hours):
+    """
+    Converts a list of hour dictionaries into the columnar arrays used by get_weather_scores.
+    Forecasts from get_weather already carry these arrays, see parse_hourly_conditions.
+
+    Arguments:
+      hours -- list of WeatherAPI hour dictionaries
+    """
+    return {
+        field: np.fromiter((hour[field] for hour in hours), dtype=np.float64, count=len(hours))
+        for field in score_fields
+    }
+
+
+def get_weather_scores(columns, ideal_temps, units):
+    """
+    Vectorized version of get_weather_score that scores every hour against one or many users' preferences in a single pass.
+    Returns the same scores as get_weather_score.
+
+    When ideal_temps and units are scalars the result is an array with one score per hour.
+    When they are arrays (one entry per user) the result has one row per user and one column per hour.
+
+    Arguments:
+      columns -- hour fields as arrays, as returned by hours_to_columns
+      ideal_temps -- ideal temperature, or an array of ideal temperatures
+      units -- temperature units ("f" or "c"), or an array of units
+    """
+    single_user = np.ndim(ideal_temps) == 0 and np.ndim(units) == 0
+    ideal = np.atleast_1d(np.asarray(ideal_temps, dtype=np.float64))[:, np.newaxis]
+    # Anything other than "f" is scored as Celsius, like get_weather_score does
+    celsius = (np.atleast_1d(np.asarray(units)) != "f")[:, np.newaxis]
+
+    # Rain Adjustments
+    score = 0 - columns["chance_of_rain"]
+    score = score - columns["chance_of_snow"]
+
+    # Temperature Adjustments, with the same thresholds and multipliers as get_weather_score
+    feelslike_f = columns["feelslike_f"]
+    multiplier_f = np.where((feelslike_f < ideal - 20) | (feelslike_f > ideal + 10), 2.0, 1.0)
+    feelslike_c = columns["feelslike_c"]
+    multiplier_c = np.where((feelslike_c < ideal - 11.11) | (feelslike_c > ideal + 5.55), 3.6, 1.8)
+    temperature_penalty = np.where(
+        celsius,
+        np.abs(multiplier_c * (ideal - feelslike_c)),
+        np.abs(multiplier_f * (ideal - feelslike_f))
+    )
+    score = score - temperature_penalty
+
+    # Wind Speed Adjustments
+    wind_mph = columns["wind_mph"]
+    multiplier_wind = np.select(
+        [wind_mph > 33, wind_mph > 30, wind_mph > 25, wind_mph > 20, wind_mph > 10],
+        [10, 5, 2, 1, 0.5],
+        default=0.25
+    )
+    score = score - multiplier_wind * wind_mph
+
+    return score[0] if single_user else score
+
+
 def check_key_value(dict, key):
     """
     Utility function that ensures that the desired key is present
@@ -142,30 +418,148 @@ def safe_user_prefs_defaults(user_prefs):
     Arguments:
       user_prefs -- User preferences as a dictionary
     """
+    has_location = check_key_value(user_prefs, 'location')
     return {
-        "location": '90210' if not check_key_value(user_prefs, 'location') else user_prefs['location'],
+        "location": '90210' if not has_location else user_prefs['location'],
+        # The canonical location only applies to the location it was resolved from
+        "canonical_location": user_prefs['canonical_location'] if has_location and check_key_value(user_prefs, 'canonical_location') else None,
         "units": 'f' if not check_key_value(user_prefs, 'units') else user_prefs['units'],
         "ideal_temp": 72 if not check_key_value(user_prefs, 'ideal_temp') else user_prefs['ideal_temp']
     }
 
 
-def get_best_walk(prefs):
+def forecast_location(user_prefs):
     """
-    Wrapper function that retrieves the best walk based on user preferences
+    Returns the location to fetch the forecast for: the canonical location when it has been resolved
+    (see locations.py), so every user in the same place shares one forecast, otherwise the raw location
+
+    Arguments:
+      user_prefs -- User preferences as a dictionary, already passed through safe_user_prefs_defaults
+    """
+    return user_prefs["canonical_location"] or user_prefs["location"]
+
+
+def get_best_walk(prefs, day=0, top_k=None):
+    """
+    Wrapper function that retrieves the best walk based on user preferences.
+    Starting from the requested day, each forecast day is searched in turn until one has hours left,
+    so late-evening requests roll over to tomorrow. Every day comes from the same cached forecast.
 
     Arguments:
       prefs -- User preferences as a dictionary
+      day -- first forecast day to search, 0 for today and 1 for tomorrow
+      top_k -- number of best hours to return, defaults to WALKTIME_TOP_K
     """
     user_prefs = safe_user_prefs_defaults(prefs)
-    conditions = get_hourly_conditions(user_prefs["location"])
-    for hour in conditions["hour"]:
-        hour["weather_score"] = get_weather_score(hour, user_prefs)
-        logging.debug(
-            f"{hour['time']} – {hour['feelslike_f']}°F – Wind: {hour['wind_mph']} MPH – Rain: {hour['will_it_rain']} - Chance of Rain: {hour['chance_of_rain']} - Score: {hour['weather_score']}")
-    best_walk = max(conditions["hour"], key=lambda x: x["weather_score"])
+    return search_best_walk(get_weather(forecast_location(user_prefs)), user_prefs, day, top_k)
+
+
+def search_best_walk(weather_info, user_prefs, day=0, top_k=None):
+    """
+    Searches the forecast days of a Forecast for the best walk, starting from day.
+    Raises ValueError if no hours are left within the forecast horizon.
+
+    Arguments:
+      weather_info -- Forecast as returned by get_weather
+      user_prefs -- User preferences as a dictionary, already passed through safe_user_prefs_defaults
+      day -- first forecast day to search, 0 for today and 1 for tomorrow
+      top_k -- number of best hours to return, defaults to WALKTIME_TOP_K
+    """
+    for search_day in range(day, len(weather_info.days)):
+        conditions = parse_hourly_conditions(weather_info, search_day)
+        if conditions["hour"]:
+            best_walk_info = find_best_walk(conditions, user_prefs, top_k)
+            best_walk_info["day"] = search_day
+            return best_walk_info
+    raise ValueError("No forecast hours left within %i forecast days" % forecast_days)
+
+
+@timed("walk.score")
+def find_best_walk(conditions, user_prefs, top_k=None):
+    """
+    Scores every remaining hour and returns the best one, along with the top_k best hours.
+    A heap selects the top hours without sorting the whole forecast.
+
+    Arguments:
+      conditions -- hourly conditions as returned by get_hourly_conditions
+      user_prefs -- User preferences as a dictionary, already passed through safe_user_prefs_defaults
+      top_k -- number of best hours to return, defaults to WALKTIME_TOP_K
+    """
+    hours = conditions["hour"]
+    if not hours:
+        raise ValueError("No forecast hours left to score")
+    scores = get_weather_scores(conditions["columns"], user_prefs["ideal_temp"], user_prefs["units"])
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for hour, score in zip(hours, scores.tolist()):
+            logging.debug(
+                f"{hour.time} – {hour.feelslike_f}°F – Wind: {hour.wind_mph} MPH – Rain: {hour.will_it_rain} - Chance of Rain: {hour.chance_of_rain} - Score: {score}")
+    # nlargest keeps the first of equally good hours first, just like max()
+    top = heapq.nlargest(top_k or walk_top_k, range(len(hours)), key=scores.__getitem__)
+    # Only the selected hours are turned back into dictionaries for the response
+    top_walk_hours = [dict(hours[index].to_dict(), weather_score=float(scores[index])) for index in top]
     best_walk_info = {
-        "best_walk_hour": best_walk,
+        "best_walk_hour": top_walk_hours[0],
+        "top_walk_hours": top_walk_hours,
         "location": conditions["location"],
         "current": conditions["current"]
     }
     return best_walk_info
+
+
+def search_best_walks(weather_info, prefs_list, day=0, top_k=1):
+    """
+    Multi-user counterpart of search_best_walk: finds the best walk for every user sharing one forecast,
+    scoring all of them in a single vectorized pass.
+    Raises ValueError if no hours are left within the forecast horizon.
+
+    Arguments:
+      weather_info -- Forecast as returned by get_weather
+      prefs_list -- list of User preferences dictionaries, already passed through safe_user_prefs_defaults
+      day -- first forecast day to search, 0 for today and 1 for tomorrow
+      top_k -- number of best hours to return per user
+    """
+    for search_day in range(day, len(weather_info.days)):
+        conditions = parse_hourly_conditions(weather_info, search_day)
+        if conditions["hour"]:
+            best_walks = find_best_walks(conditions, prefs_list, top_k)
+            for best_walk_info in best_walks:
+                best_walk_info["day"] = search_day
+            return best_walks
+    raise ValueError("No forecast hours left within %i forecast days" % forecast_days)
+
+
+@timed("walk.score", users="many")
+def find_best_walks(conditions, prefs_list, top_k=1):
+    """
+    Returns the best hour, along with the top_k best hours, for each of several users' preferences,
+    in the same order as prefs_list
+
+    Arguments:
+      conditions -- hourly conditions as returned by get_hourly_conditions
+      prefs_list -- list of User preferences dictionaries, already passed through safe_user_prefs_defaults
+      top_k -- number of best hours to return per user
+    """
+    hours = conditions["hour"]
+    if not hours:
+        raise ValueError("No forecast hours left to score")
+    scores = get_weather_scores(
+        conditions["columns"],
+        [user_prefs["ideal_temp"] for user_prefs in prefs_list],
+        [user_prefs["units"] for user_prefs in prefs_list]
+    )
+    if top_k == 1:
+        top = np.argmax(scores, axis=1)[:, np.newaxis]
+    else:
+        # A stable sort keeps the first of equally good hours first, like find_best_walk
+        top = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+    best_walks = []
+    for row, row_top in zip(scores, top.tolist()):
+        # Each user gets their own scored copies of their best hours
+        top_walk_hours = [dict(hours[index].to_dict(), weather_score=float(row[index])) for index in row_top]
+        best_walks.append({
+            "best_walk_hour": top_walk_hours[0],
+            "top_walk_hours": top_walk_hours,
+            "location": conditions["location"],
+            "current": conditions["current"]
+        })
+    return best_walks